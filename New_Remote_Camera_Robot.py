@@ -9,14 +9,13 @@
 #  Modified by Jim Harris to eliminate nipple.js and allow robot control with a standard joystick.
 #  Please direct support requests to user "jimrh" at https://forum.dexterindustries.com
 
+import hmac
 import os
 import signal
 import sys
 import logging
-from time import sleep
-
-#  This grabs my modified version of EasyGoPiGo3 instead of the standard package
-sys.path.insert(0, "/home/pi/Project_Files/Projects/GoPiGo3/Software/Python")
+import json
+from time import sleep, monotonic, time
 
 from werkzeug.datastructures import ResponseCacheControl
 
@@ -24,17 +23,44 @@ from werkzeug.datastructures import ResponseCacheControl
 assert sys.version_info[0:1] == (3,)
 
 # imports needed for web server
-from flask import Flask, jsonify, render_template, request, Response, send_from_directory, url_for
+from flask import Flask, jsonify, render_template, request, Response, url_for
 from werkzeug.serving import make_server
-from gopigo3 import FirmwareVersionError
-from easygopigo3 import EasyGoPiGo3
+
+#  The WebSocket control channel needs the flask-sock package, (pip3 install flask-sock).
+#  Without it the browser falls back to sending every command as a POST to /robot.
+try:
+    from flask_sock import Sock
+except ImportError:
+    Sock = None
+
+#  The GoPiGo3 (or the simulator) is reached through a hardware backend.
+#  See robot_hardware.py
+import robot_hardware
+from robot_hardware import FirmwareVersionError
+from robot_servo import ServoActuator
+from robot_motors import MotorOutput
+from robot_control_loop import DriveControlLoop
+from robot_stream_broadcaster import PART_TRAILER, StreamBroadcaster, part_header
+from robot_telemetry import TelemetryPublisher
+from robot_metrics import registry as metrics
+from robot_command_log import CommandRecorder, CommandLogError
+from robot_state import RobotState
+from robot_control_payload import PAYLOAD_MIMETYPE, decode_command
+from robot_startup import StartupError, StartupSequence, wait_for_http
+from robot_video_recorder import VideoArchive, VideoRecorder
+from robot_video_process import HEARTBEAT_INTERVAL, SharedVideoStatus, VideoProcess
+from robot_async_server import AsyncRobotServer
+from robot_profiler import ProfilerBusyError, StackSampler, save_profile_in_background
+from robot_sensors import CPU_TEMPERATURE_PATH, Sensor, SensorSampler, read_cpu_temperature
+from robot_camera import create_frame_source
+from robot_controller_lease import ControllerLease
+from robot_static import StaticAssetCache
 
 # imports needed for stream server
-import io
-import picamera
 import socketserver
 from threading import Condition, Thread, Event
 from http import server
+from urllib.parse import urlsplit, parse_qs
 
 logging.basicConfig(level = logging.WARNING)
 
@@ -42,7 +68,21 @@ logging.basicConfig(level = logging.WARNING)
 HOST = "0.0.0.0"
 WEB_PORT = 5000
 STREAM_PORT = 5002  #  Changed from 5001 so that nginx can listen to the outside world on that port
+CONTROL_LOOP_RATE = 50  #  How many times a second the drive control loop runs, (0 = no control loop)
+COMMAND_TIMEOUT = 0.75  #  Stop the robot if no command has arrived for this many seconds
+TELEMETRY_MAX_RATE = 10  #  Default maximum telemetry events per second for each browser
+CAMERA_READY_TIMEOUT = 10  #  Seconds to wait for the camera's first frame at startup
+LEASE_TIMEOUT = 10  #  Seconds without a command before another browser may take control of the robot
+SNAPSHOT_TIMEOUT = 10  #  Default seconds /snapshot.jpg?after=N waits for a newer frame
+SNAPSHOT_MAX_TIMEOUT = 30
+ASYNC_SERVER_WORKERS = 2  #  Threads the asyncio server, (ROBOT_ASYNC_SERVER=1), runs Flask requests in
+PROFILE_SIGNAL_SECONDS = 10  #  How long SIGUSR1 profiles the robot for
+VIDEO_PROCESS_STALL_TIMEOUT = 5  #  Seconds without a heartbeat or a frame before the video process is restarted
+BATTERY_INTERVAL = 2  #  Default seconds between battery voltage readings, (ROBOT_BATTERY_INTERVAL)
+CPU_TEMPERATURE_INTERVAL = 5  #  Default seconds between processor temperature readings, (ROBOT_CPU_TEMPERATURE_INTERVAL)
+SENSOR_HISTORY = 60  #  Readings of each sensor kept for /robot/sensors
 app = Flask(__name__, static_url_path='')
+sock = Sock(app) if Sock is not None else None
 
 ##############################
 ### Basic Global Variables ###
@@ -52,47 +92,23 @@ app = Flask(__name__, static_url_path='')
 
 #  The main robot_data structure to hold all the necessary information that can be passed back and forth
 #  to the various functions and methods.
+#
+#  It is shared by the web server's request threads, the drive control loop and the head routines,
+#  so every change to it is made inside "with robot.writing():", and anything that needs several
+#  values that belong together uses robot.snapshot().  See robot_state.py
 
-robot = {
-    "controller_status": "Disconnected",
-    "motion_state": "Waiting for Joystick",
-    "direction": "None",
-    "time_stamp": 0,  # a large integer that, (sometimes), becomes a float (shrug shoulders)
-    "x_axis": 0.00,  #  x-axis < 0, joystick pushed left - x-axis > 0, joystick pushed right
-    "y_axis": 0.00,  # y-axis < 0, joystick pushed forward - y-axis > 0 , joystick pullled back
-    "head_x_axis": 0.00,  #  head x and y axes mirror the joystick x and y axes
-    "head_y_axis": 0.00,  #  if the pinky-switch, (head motion enable), is pressed
-    "force": 0.00,  #  force is the absolute value of the y-axis deflection
-    "trigger_1": 0,   # Partial primary trigger press (motion enabled)
-    "trigger_2": 0,   # Full primary trigger press enables a faster, (turbo), speed
-    "head_enable": 0,  #  The "pinky switch" is used as a head-motion-enable switch. The value is captured here.
-    "normal_speed": 150,  #  Max speed if the trigger is pressed half-way
-    "turbo_speed": 300,  #  Max speed if the trigger is fully pressed
-    "speed": 0,  # this represents the currently selected maximum, either normal or turbo speed
-    "desired_speed": 0,  #  This is the adjusted speed based on joystick force.
-    "differential_speed": 0,  #  This is the fractional part of the desired speed used for making turns.
-    "vcenter": 95,  #  The "calibrated" positions for Charlie's head 
-    "hcenter": 86,  #  to be centered in both axes.
-    "vposition": 92,  #  The current angular setting for the vertical angle servo
-    "hposition": 88,  #  The current angular setting for the horizontal angle servo
-    "reverse_speed_offset": 0.50,
-    "servo_step_size": 5
-    }
+robot = RobotState()
 
 # Set the movement step size
 # servo_step_size = int(5)
 
-# Directory Path can change depending on where you install this file.  Non-standard installations
-# may require you to change this directory.
-#
-# If you install this in directory "x", both "static" and "templates"
-# should be subdirectories of directory "x".
+# Both "static" and "templates" must be subdirectories of the directory this file is in.
 # Example: This file is placed in /home/pi/project. Then you should place both
 # "static" and "templates" one directory below it - /home/pi/project/templates and
 # /home/pi/project/static
 #
-#  TODO:  Figure out how to make this self-referencing so that the user can put this wherever he wants.
-directory_path = "/home/pi/Project_Files/Projects/New_Remote_Camera_Robot/static"
+# The path is worked out from where this file is, so the project can be installed anywhere.
+directory_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
 
 ##################################
 ### End Basic Global Constants ###
@@ -100,37 +116,124 @@ directory_path = "/home/pi/Project_Files/Projects/New_Remote_Camera_Robot/static
 
 # for triggering the shutdown procedure when a signal is detected
 keyboard_trigger = Event()
+
+#  "kill -USR1 <pid>" profiles the robot for PROFILE_SIGNAL_SECONDS, (see robot_profiler.py),
+#  and saves the result in ROBOT_PROFILE_DIR, (default /tmp), even if the web server is stuck.
+def profile_signal_handler(signum, frame):
+    save_profile_in_background(os.environ.get("ROBOT_PROFILE_DIR", "/tmp"), PROFILE_SIGNAL_SECONDS)
+
 def signal_handler(signal, frame):
     logging.info("Signal detected. Stopping threads.")
-    my_gopigo3.stop()
+    if my_gopigo3.initialized():
+        motors.stop(force = True)
     keyboard_trigger.set()
 
-#  Create instance of the EasyGoPiGo class so that we
+#  Create instance of the robot's hardware backend so that we
 #  can use the GoPiGo functionality.
-try:
-    my_gopigo3 = EasyGoPiGo3(use_mutex = True)
-except IOError:
-    logging.critical("GoPiGo3 is not detected.")
-    sys.exit(1)
-except FirmwareVersionError:
-    logging.critical("GoPiGo3 firmware needs to be updated")
-    sys.exit(2)
-except Exception:
-    logging.critical("Unexpected error when initializing GoPiGo3 object")
-    sys.exit(3)
+#  By default this is the real GoPiGo3, (an EasyGoPiGo3 object).
+#  Set ROBOT_BACKEND=simulated to run without a robot.
+#
+#  Nothing talks to the hardware until it is first used, (or the "hardware" startup phase
+#  asks for it), so importing this module is quick.  See LazyHardware in robot_hardware.py
+def create_hardware():
+    backend = robot_hardware.create_backend()
+
+    #  Set sane eye colors - "255" is insanely bright and wastes energy.
+    backend.left_eye_color = (0, 80, 80)
+    backend.right_eye_color = (0, 80, 80)
+
+    #  Set the absolute maximum speed for the robot
+    #  If you try to set a speed greater than this, it won't go any faster no matter what value you send.
+    backend.set_speed(robot.settings.turbo_speed)
+    return backend
+
+my_gopigo3 = robot_hardware.LazyHardware(create_hardware, "GoPiGo3")
+
+#  All wheel speed changes go through "motors", which skips writes that wouldn't
+#  change anything and updates both wheels together.  See robot_motors.py
+motors = MotorOutput(my_gopigo3)
+
+#  The drive control loop, (see robot_control_loop.py), is started with the servers.
+#  Until then, process_robot_commands sets the wheel speeds itself.
+control_loop = None
+
+#  If ROBOT_COMMAND_LOG is set, every command is recorded there so that the driving
+#  session can be replayed later.  See robot_command_log.py
+command_recorder = None
+
+#  If ROBOT_VIDEO_DIR is set, the camera's frames are recorded there, and can be played
+#  back from the stream server.  See robot_video_recorder.py
+video_recorder = None
+video_archive = None
+
+#  If ROBOT_VIDEO_PROCESS=1, the camera, the stream server and the video recorder run in a
+#  child process, (see run_video_process below), so that the video can't hold up the driving.
+#  See robot_video_process.py
+video_process = None
+
+#  If ROBOT_ASYNC_SERVER=1, the page, static files, /robot, the video stream and telemetry are
+#  all served on WEB_PORT by one asyncio event loop instead of the two threaded servers.
+#  See robot_async_server.py
+use_async_server = False
+
+#  Where the time goes, (see robot_metrics.py and the /metrics route).
+#  The motors, servos, control loop and stream broadcaster add their own metrics.
+command_request_seconds = {
+    transport: metrics.histogram("robot_command_request_seconds",
+                                 "Time taken to handle one joystick command, from request to response",
+                                 labels = {"transport": transport})
+    for transport in ("post", "websocket")
+}
+process_commands_seconds = metrics.histogram("robot_process_commands_seconds",
+                                             "Time taken by process_robot_commands")
+frames_published_total = metrics.counter("robot_stream_frames_published_total",
+                                         "Camera frames published by StreamingOutput, (rate() of this is the frame rate)")
+
+#  Which browser is driving the robot.  Commands from anyone else, or older than the last
+#  one accepted, are dropped before they reach process_robot_commands.
+#  See robot_controller_lease.py and the /robot/lease route.
+lease = ControllerLease(LEASE_TIMEOUT)
+
+#  The robot's state as reported to the browsers by the /telemetry route.
+#  See robot_telemetry.py
+telemetry = TelemetryPublisher()
+
+#  The battery voltage and the processor's temperature are read in the background, each at its
+#  own rate, and the battery isn't read while the motors are being written, (they share the
+#  GoPiGo3's SPI bus).
+#  Every reading goes to the telemetry subscribers, and /robot/sensors has the recent history,
+#  so nothing that reports them ever reads the hardware.  See robot_sensors.py
+def read_battery():
+    if not my_gopigo3.initialized():
+        return None
+    return my_gopigo3.get_voltage_battery()
+
+sensor_list = [Sensor("battery_volts", read_battery,
+                      float(os.environ.get("ROBOT_BATTERY_INTERVAL", BATTERY_INTERVAL)),
+                      history = SENSOR_HISTORY, uses_hardware = True)]
+if os.path.exists(CPU_TEMPERATURE_PATH):
+    sensor_list.append(Sensor("cpu_temperature", read_cpu_temperature,
+                              float(os.environ.get("ROBOT_CPU_TEMPERATURE_INTERVAL", CPU_TEMPERATURE_INTERVAL)),
+                              history = SENSOR_HISTORY, digits = 1))
+sensors = SensorSampler(sensor_list, hardware_lock = motors.lock, on_update = telemetry.update)
+
+#  The static files and rendered pages, kept in memory with gzip copies and ETags.
+#  See robot_static.py
+static_assets = StaticAssetCache(directory_path)
+pages = StaticAssetCache(os.path.join(os.path.dirname(directory_path), "templates"))
 
 #  Instantiate "servo" objects
-servo1 = my_gopigo3.init_servo("SERVO1")
-servo2 = my_gopigo3.init_servo("SERVO2")
+servo1 = robot_hardware.LazyHardware(lambda: my_gopigo3.init_servo("SERVO1"), "SERVO1")
+servo2 = robot_hardware.LazyHardware(lambda: my_gopigo3.init_servo("SERVO2"), "SERVO2")
 
-#  Set sane eye colors - "255" is insanely bright and wastes energy.
-my_gopigo3.left_eye_color = (0, 80, 80)
-my_gopigo3.right_eye_color = (0, 80, 80)
+#  The head servos are moved by their own thread so that head
+#  movement never holds up a web request.  See robot_servo.py
+#  The thread is started by start_head, not here: the video process imports this module too.
+head = ServoActuator(servo1, servo2)
 
-
-#  Set the absolute maximum speed for the robot
-#  If you try to set a speed greater than this, it won't go any faster no matter what value you send.
-my_gopigo3.set_speed(robot["turbo_speed"])
+#  The services are started concurrently by the startup sequence in __main__,
+#  (see robot_startup.py), which /ready reports on.
+startup = StartupSequence()
 
 #####################################
 ##  Global head movement routines  ##
@@ -140,43 +243,41 @@ my_gopigo3.set_speed(robot["turbo_speed"])
 #  This is used by all the other head movement
 #  routines to move the head to a specified
 #  vertical and horizontal position
-
-def move_head(hpos, vpos):
-    servo1.rotate_servo(hpos)
-    servo2.rotate_servo(vpos)
-    sleep(0.25)
-    servo1.disable_servo()
-    servo2.disable_servo()
+#
+#  The movement itself is done by the "head" ServoActuator thread, so this returns
+#  immediately unless "wait" is True, in which case it waits for the head to get there.
+#  The new position is remembered in robot.head, (the servos are told outside the write section).
+
+def move_head(hpos, vpos, wait = False):
+    with robot.writing():
+        robot.head.hposition = hpos
+        robot.head.vposition = vpos
+    head.move_to(hpos, vpos)
+    if wait:
+        head.wait_settled()
     return(0)
 
 # Center Charlie's head
-def center_head():
-    move_head(robot["hcenter"], robot["vcenter"])
-
-    #  reset position variables to prevent unintentional head "drift" in subsequent commands.
-    robot["vposition"] = robot["vcenter"]
-    robot["hposition"] = robot["hcenter"]
+#  (this also resets the position variables to prevent unintentional head "drift" in subsequent commands)
+def center_head(wait = False):
+    move_head(robot.settings.hcenter, robot.settings.vcenter, wait)
     return(0)
 
 # Shake Charlie's head - just to prove he's alive! ;)
 def shake_head():
 #    print("Shaking Charlie's Head From Side To Side\n")
-    robot["hposition"] = 110
-    move_head(robot["hposition"], robot["vposition"])
-    robot["hposition"] = 84
-    move_head(robot["hposition"], robot["vposition"])
+    move_head(110, robot.head.vposition, wait = True)
+    move_head(84, robot.head.vposition, wait = True)
 
 #    print("Centering Charlie's head horizontally\n")
-    center_head()
+    center_head(wait = True)
 
 #    print("Moving Charlie's Head Up And Down\n")
-    robot["vposition"] = 110
-    move_head(robot["hposition"], robot["vposition"])
-    robot["vposition"] = 66
-    move_head(robot["hposition"], robot["vposition"])
+    move_head(robot.head.hposition, 110, wait = True)
+    move_head(robot.head.hposition, 66, wait = True)
 
 #    print("Re-centering Charlie's head vertically\n")
-    center_head()
+    center_head(wait = True)
     return(0)
 
 
@@ -203,8 +304,31 @@ def create_CORS_response():
 
 @app.route("/robot", methods = ["POST"])
 def get_args():
+    start = monotonic()
     # get the query
-    args = request.args
+    #  (or the packed binary version of it, see robot_control_payload.py)
+    if request.mimetype == PAYLOAD_MIMETYPE:
+        try:
+            args = decode_command(request.get_data())
+        except ValueError as e:
+            resp = Response(str(e), status = 400, mimetype = "text/plain")
+            resp.headers.add("Access-Control-Allow-Origin", "*")
+            return(resp)
+    else:
+        args = request.args
+
+    #  Only the browser holding the lease may drive, and only with its newest command
+    try:
+        rejected = lease.check(request.headers.get("X-Robot-Lease"), command_seq(args))
+    except ValueError as e:
+        resp = Response(str(e), status = 400, mimetype = "text/plain")
+        resp.headers.add("Access-Control-Allow-Origin", "*")
+        return(resp)
+    if rejected is not None:
+        resp = jsonify({"rejected": rejected})
+        resp.status_code = 409
+        resp.headers.add("Access-Control-Allow-Origin", "*")
+        return(resp)
 
 #  Print out the received values of the arg-list so I can verify they're correct.
 #    print(args, "\n")
@@ -214,7 +338,9 @@ def get_args():
     process_robot_commands(args)
 
     #  After doing all that work, send a response.
-    resp = Response()
+    #  The response says when the command was received and processed, and how long
+    #  the latest command took to reach the motors, so the browser can measure the latency.
+    resp = Response(json.dumps(command_ack(args, start, monotonic())))
 
     #  Allow CORS (Cross Origin Resource Sharing) during POST
     #  Note that this is overkill, like chmod 777.  Right now I want it to **WORK**
@@ -231,19 +357,181 @@ def get_args():
     resp.mimetype = "application/json"
     resp.status = "OK"
     resp.status_code = 200
+    command_request_seconds["post"].observe(monotonic() - start)
+    return(resp)
+
+#  The persistent control channel.
+#  The browser opens one WebSocket and sends each joystick update as a JSON "frame"
+#  containing the same fields as the /robot query string, plus a sequence number.
+#  Every frame is acknowledged, (the same acknowledgement as the POST's response, see command_ack),
+#  so the browser knows the command was handled and how long it took.
+#  A binary frame is the packed version of the same command, (see robot_control_payload.py).
+#  The /robot POST above is kept as the fallback if the WebSocket can't be opened.
+#  The browser's lease token, if it has one, is given when the WebSocket is opened, (/robot_ws?lease=token).
+#  A frame that is rejected by the lease is acknowledged with the reason, (see robot_controller_lease.py).
+if sock is not None:
+    @sock.route("/robot_ws")
+    def robot_websocket(ws):
+        token = request.args.get("lease")
+        while True:
+            message = ws.receive()
+            start = monotonic()
+            try:
+                if isinstance(message, bytes):
+                    args = decode_command(message)
+                else:
+                    args = json.loads(message)
+                    if not isinstance(args, dict):
+                        raise ValueError("a control frame must be a JSON object")
+                rejected = lease.check(token, command_seq(args))
+                if rejected is not None:
+                    ws.send(json.dumps({"seq": args.get("seq"), "rejected": rejected}))
+                    continue
+                process_robot_commands(args)
+            except (ValueError, KeyError, TypeError) as e:
+                logging.warning("Bad control frame received: %s", str(e))
+                ws.send(json.dumps({"error": str(e)}))
+                continue
+            ws.send(json.dumps(command_ack(args, start, monotonic())))
+            command_request_seconds["websocket"].observe(monotonic() - start)
+
+#  The acknowledgement for a command: its sequence number and time_stamp, when the robot received
+#  and finished processing it, (monotonic() seconds, only differences between them mean anything),
+#  and the sequence number of the latest command applied to the motors, ("actuated_seq"), with when
+#  and how quickly that one was applied.  With the drive control loop running, that's usually the
+#  previous command, (this one is applied on the loop's next step), so the browser matches them up by seq.
+def command_ack(args, received, processed):
+    drive = robot.snapshot().drive
+    return {
+        "seq": command_seq(args),
+        "time_stamp": int(args["time_stamp"]),
+        "received": round(received, 6),
+        "processed": round(processed, 6),
+        "actuated_seq": drive.actuated_seq,
+        "actuated": round(drive.actuated_time, 6),
+        "actuation_ms": round(drive.actuation_lag * 1000.0, 3),
+    }
+
+#  The sequence number of a command, (None if it hasn't got one).
+def command_seq(args):
+    seq = args.get("seq")
+    if seq is None:
+        return None
+    try:
+        return int(seq)
+    except ValueError:
+        raise ValueError("seq must be a number")
+
+#  The controller lease.
+#  POST asks for it, (?takeover=1 takes it from whoever has it), and returns the token to send
+#  with every command, (the X-Robot-Lease header, or /robot_ws?lease=token), or 409 if another
+#  browser is driving.  DELETE gives it up, and GET shows who has it.
+@app.route("/robot/lease", methods = ["GET", "POST", "DELETE"])
+def robot_lease():
+    token = request.headers.get("X-Robot-Lease")
+    status_code = 200
+    if request.method == "POST":
+        new_token = lease.acquire(takeover = request.args.get("takeover") == "1")
+        if new_token is None:
+            status_code = 409
+        else:
+            token = new_token
+    elif request.method == "DELETE":
+        lease.release(token)
+    status = lease.status(token)
+    if request.method == "POST" and status_code == 200:
+        status["token"] = token
+    resp = jsonify(status)
+    resp.status_code = status_code
+    resp.headers.add("Access-Control-Allow-Origin", "*")
+    resp.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+    return(resp)
+
+#  Server-Sent Events stream of the robot's state.
+#  /telemetry?max_rate=N limits the stream to N events a second.
+@app.route("/telemetry")
+def telemetry_stream():
+    max_rate = request.args.get("max_rate", TELEMETRY_MAX_RATE, type = float)
+    resp = Response(telemetry.stream(max_rate), mimetype = "text/event-stream")
+    resp.headers.add("Access-Control-Allow-Origin", "*")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"  #  ask nginx not to buffer the stream
+    return(resp)
+
+#  All the metrics, in the Prometheus text format.
+@app.route("/metrics")
+def metrics_page():
+    resp = Response(metrics.render(), mimetype = "text/plain")
+    resp.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    resp.headers["Cache-Control"] = "no-cache"
+    return(resp)
+
+#  The latest battery voltage and processor temperature, and their recent history, from the
+#  sensor sampler's cache, (this never reads the hardware).
+@app.route("/robot/sensors")
+def robot_sensors():
+    resp = jsonify(sensors.status())
+    resp.headers["Cache-Control"] = "no-cache"
+    return(resp)
+
+#  Whether the robot can be driven yet, and how far each startup phase has got.
+#  200 once it is drivable, 503 until then.
+@app.route("/ready")
+def ready():
+    status = startup.status()
+    resp = jsonify(status)
+    resp.status_code = 200 if status["drivable"] else 503
+    resp.headers.add("Access-Control-Allow-Origin", "*")
+    resp.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+    return(resp)
+
+#  Profile the running robot, (see robot_profiler.py).
+#  Only available if ROBOT_PROFILE_TOKEN is set, and the request has "Authorization: Bearer <token>".
+#  /debug/profile?seconds=10&rate=100 samples every thread's stack "rate" times a second for
+#  "seconds", then returns the stacks, (collapsed, for flamegraph.pl or speedscope), and the CPU
+#  time each thread used, as JSON.  &format=collapsed returns just the stacks, as text.
+@app.route("/debug/profile")
+def debug_profile():
+    token = os.environ.get("ROBOT_PROFILE_TOKEN")
+    if not token:
+        return Response("Profiling is not enabled", status = 404, mimetype = "text/plain")
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), "Bearer " + token):
+        resp = Response("A profile token is needed", status = 401, mimetype = "text/plain")
+        resp.headers["WWW-Authenticate"] = "Bearer"
+        return(resp)
+    try:
+        sampler = StackSampler(request.args.get("seconds", 10.0, type = float), request.args.get("rate", 100.0, type = float))
+        profile = sampler.run()
+    except ValueError as e:
+        return Response(str(e), status = 400, mimetype = "text/plain")
+    except ProfilerBusyError as e:
+        return Response(str(e), status = 409, mimetype = "text/plain")
+    if request.args.get("format") == "collapsed":
+        resp = Response(profile["collapsed"], mimetype = "text/plain")
+    else:
+        resp = jsonify(profile)
+    resp.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     return(resp)
 
 @app.route("/")
 def index():
     return page("index.html")
 
+#  The templates only depend on how the robot was started, so each page is only rendered
+#  once and then served from the cache like the static files.
+#  "stream_on_this_port" is True when the video stream is served by this server, (the asyncio
+#  server), rather than the stream server, (through nginx on port 5001).
 @app.route("/<string:page_name>")
 def page(page_name):
-    return render_template("{}".format(page_name))
+    asset = pages.assets.get(page_name)
+    if asset is None:
+        html = render_template("{}".format(page_name), stream_on_this_port = use_async_server and output is not None)
+        asset = pages.add(page_name, html.encode("utf-8"), "text/html; charset=utf-8")
+    return pages.response(asset, request)
 
 @app.route("/static/<path:path>")
 def send_static(path):
-    return send_from_directory(directory_path, path)
+    return static_assets.send(path, request)
 
 #####################################
 ##    Speed Calculation Routines   ##
@@ -324,178 +612,263 @@ def round_up(x, digits=2):
     else:
         return (val)
 
+#  drive_robot sets the wheel speeds from the latest joystick values in "robot".
+#  It is called by the drive control loop every tick, (or directly by process_robot_commands
+#  if the loop isn't running), so it must give the same answer every time it is called with
+#  the same joystick values.  The wheels are only written, (and a message printed), when the
+#  speeds actually change.
+
+def drive_robot():
+    #  The wheel speeds are worked out inside the write section, and the motors are only told
+    #  once it's over, so a snapshot() never waits for an SPI call.
+    stop = False  #  True to stop the motors
+    wheels = None  #  or (left, right) degrees per second to set them to
+    message = None  #  printed if the motors actually changed
+    with robot.writing():
+    #  Enable "Turbo" speed
+        if robot.command.trigger_2 == 1:
+            robot.drive.speed = robot.settings.turbo_speed
+        else:
+            robot.drive.speed = robot.settings.normal_speed
+
+    ############################
+    ##    Motion Selection    ##
+    ############################
+    #  Depending on the position of the x and y axes
+    #  and the state of trigger_1, we determine
+    #  **IF** the robot should be moving,
+    #  and **WHAT DIRECTION** it should be moving in.
+    #
+        if robot.command.force == 0 or robot.command.trigger_1 == 0:
+            stop = True
+            message = "Robot Stopped. . .\n"
+
+        elif robot.command.trigger_1 == 1 and robot.command.y_axis < 0:
+            # We're moving forward - either straight, left, or right.
+        
+            # if we're not moving directly forward, the inside wheel must be slower
+            # than the outside wheel by some percentage.
+
+            # When moving to the left, the left wheel must be moving slower than
+            # the right wheel by some percentage, depending on the sharpness of the turn.
+            # "motors.set_wheels" allows the wheels to be set to individual speeds.
+            if robot.command.x_axis < 0:  #  Moving fowrard to the left
+                robot.drive.desired_speed = int(calc_desired_speed(robot.drive.speed, robot.command.force))
+                robot.drive.differential_speed = int(calculate_differential_speed(robot.drive.desired_speed, robot.command.x_axis))
+                wheels = (robot.drive.differential_speed, robot.drive.desired_speed)
+                message = "The robot is moving forward to the left\n"
+
+                # Moving to the right, we apply the same logic as before, but swap wheels.
+            elif robot.command.x_axis > 0:  #  Moving fowrard to the right
+                robot.drive.desired_speed = int(calc_desired_speed(robot.drive.speed, robot.command.force))
+                robot.drive.differential_speed = int(calculate_differential_speed(robot.drive.desired_speed, robot.command.x_axis))
+                wheels = (robot.drive.desired_speed, robot.drive.differential_speed)
+                message = "The robot is moving forward to the right\n"
+
+            else:  # Moving directly forward
+                robot.drive.desired_speed = int(calc_desired_speed(robot.drive.speed, robot.command.force))
+                wheels = (robot.drive.desired_speed, robot.drive.desired_speed)
+                message = "The robot is moving forward straight ahead\n"
+
+        elif robot.command.trigger_1 == 1 and robot.command.y_axis > 0:
+            # We're moving backward
+            #  This is the exact same logic and calculation as moving forward
+            #  Except that it's "backwards" (bad pun!)
+            #  We do this by changing the sign of the speed requested.
+
+            # if we're not moving directly backward, the inside wheel must be slower
+            # than the outside wheel by some percentage.
+
+            #  reduce maximum reverse speed to 1/2 forward speed
+            robot.drive.speed = robot.drive.speed * robot.settings.reverse_speed_offset
+
+            if robot.command.x_axis < 0:  #  Moving backward to the left
+                # Moving to the left, the left wheel must be moving slower than
+                # the right wheel by some percentage.
+                robot.drive.desired_speed = int(calc_desired_speed(robot.drive.speed, robot.command.force))
+                robot.drive.differential_speed = int(calculate_differential_speed(robot.drive.desired_speed, robot.command.x_axis))
+                wheels = (-robot.drive.differential_speed, -robot.drive.desired_speed)
+                message = "The robot is moving backward to the left\n"
+
+            elif robot.command.x_axis > 0:  #  Moving backward to the right
+                # Moving to the right, we apply the same logic, but swap wheels.
+                robot.drive.desired_speed = int(calc_desired_speed(robot.drive.speed, robot.command.force))
+                robot.drive.differential_speed = int(calculate_differential_speed(robot.drive.desired_speed, robot.command.x_axis))
+                wheels = (-robot.drive.desired_speed, -robot.drive.differential_speed)
+                message = "The robot is moving backward to the right\n"
+
+            else:  #  Moving directly backward.
+                robot.drive.desired_speed = int(calc_desired_speed(robot.drive.speed, robot.command.force))
+                wheels = (-robot.drive.desired_speed, -robot.drive.desired_speed)
+                message = "The robot is moving straight backward\n"
+
+        command_time = robot.command.command_time
+        seq = robot.command.seq
+
+    if stop:
+        if motors.stop():
+            print(message)
+    elif wheels is not None:
+        if motors.set_wheels(*wheels):
+            print(message)
+
+    #  How long the latest command took to reach the motors, (reported back to the browser)
+    if robot.drive.actuated_command_time != command_time:
+        with robot.writing():
+            robot.drive.actuated_command_time = command_time
+            robot.drive.actuated_seq = seq
+            robot.drive.actuated_time = monotonic()
+            robot.drive.actuation_lag = robot.drive.actuated_time - command_time
+
+    publish_telemetry()
+    return
+
+#  Tell the telemetry subscribers what the robot is doing.
+#  Nothing is sent unless one of these values has changed.
+def publish_telemetry():
+    state = robot.snapshot()
+    telemetry.update({
+        "controller_status": state.command.controller_status,
+        "motion_state": state.command.motion_state,
+        "direction": state.command.direction,
+        "time_stamp": state.command.time_stamp,
+        "moving": not motors.stopped and (motors.left_dps != 0 or motors.right_dps != 0),
+        "desired_speed": state.drive.desired_speed,
+        "differential_speed": state.drive.differential_speed,
+        "left_dps": motors.left_dps,
+        "right_dps": motors.right_dps,
+        "hposition": state.head.hposition,
+        "vposition": state.head.vposition,
+    })
+
+#  Called by the drive control loop when the browser has gone quiet for too long.
+def command_timeout():
+    if motors.stop():
+        print("No commands received for", COMMAND_TIMEOUT, "seconds - Robot Stopped. . .\n")
+
 def process_robot_commands(args):
-    robot["controller_status"] = str(args["controller_status"])
-    robot["motion_state"] = str(args["motion_state"])
-    robot["direction"] = str(args["angle_dir"])
-    robot["time_stamp"] = int(args["time_stamp"])
-    robot["x_axis"] = float(args["x_axis"])
-    robot["y_axis"] = float(args["y_axis"])
-    robot["head_x_axis"] = float(args["head_x_axis"])
-    robot["head_y_axis"] = float(args["head_y_axis"])
-    robot["force"] = float(args["force"])
-    robot["trigger_1"] = int(args["trigger_1"])
-    robot["trigger_2"] = int(args["trigger_2"])
-    robot["head_enable"] = int(args["head_enable"])
-
-#  This reduces the x_axis sensitivity
-#  Select a number that allows the x_axis to do what is necessary,
-#  without undue "toouchyness"
-    robot["x_axis"] = robot["x_axis"] * 0.50  #  reduces sensitivity by a pre-defined factor
-
-#  Enable "Turbo" speed
-    if robot["trigger_2"] == 1:
-        robot["speed"] = robot["turbo_speed"]
-    else:
-        robot["speed"] = robot["normal_speed"]
+    start = monotonic()
+    #  Only the new values are worked out and stored inside the write section.  Recording the
+    #  command, the motors and the head servos are all dealt with once it's over.
+    head_target = None  #  (horizontal, vertical) to move the head to
+    #  Parse and check everything first, so a bad command raises before anything is stored,
+    #  and the write section is only assignments.
+    seq = command_seq(args)
+    controller_status = str(args["controller_status"])
+    motion_state = str(args["motion_state"])
+    direction = str(args["angle_dir"])
+    time_stamp = int(args["time_stamp"])
+    x_axis = float(args["x_axis"])
+    y_axis = float(args["y_axis"])
+    head_x_axis = float(args["head_x_axis"])
+    head_y_axis = float(args["head_y_axis"])
+    force = float(args["force"])
+    trigger_1 = int(args["trigger_1"])
+    trigger_2 = int(args["trigger_2"])
+    head_enable = int(args["head_enable"])
+
+    #  This reduces the x_axis sensitivity
+    #  Select a number that allows the x_axis to do what is necessary,
+    #  without undue "toouchyness"
+    x_axis = x_axis * 0.50  #  reduces sensitivity by a pre-defined factor
 
     # Insist on sane values
-    if (abs(robot["x_axis"])) < 0.20: # provide a little bit of dead-zone for the x_axis
-        robot["x_axis"] = 0
+    if (abs(x_axis)) < 0.20: # provide a little bit of dead-zone for the x_axis
+        x_axis = 0
 
-    if robot["x_axis"] > 1:
-        robot["x_axis"] = 1
+    if x_axis > 1:
+        x_axis = 1
 
-    elif robot["x_axis"] < -1:
-        robot["x_axis"] = -1
+    elif x_axis < -1:
+        x_axis = -1
 
-    elif robot["y_axis"] > 1:
-        robot["y_axis"] = 1
+    elif y_axis > 1:
+        y_axis = 1
 
-    elif robot["y_axis"] < -1:
-        robot["y_axis"] - -1
+    elif y_axis < -1:
+        y_axis - -1
 
-    elif robot["force"] > 1:
-        robot["force"] = 1
+    elif force > 1:
+        force = 1
 
     else:
         pass
 
-
-############################
-##    Motion Selection    ##
-############################
-#  Depending on the position of the x and y axes
-#  and the state of trigger_1, we determine
-#  **IF** the robot should be moving,
-#  and **WHAT DIRECTION** it should be moving in.
-#
-    if robot["force"] == 0 or robot["trigger_1"] == 0:
-        my_gopigo3.stop()
-        print("Robot Stopped. . .\n")
-
-    elif robot["trigger_1"] == 1 and robot["y_axis"] < 0:
-        # We're moving forward - either straight, left, or right.
-        print("The robot is ", end="")
-        
-        # if we're not moving directly forward, the inside wheel must be slower
-        # than the outside wheel by some percentage.
-
-        # When moving to the left, the left wheel must be moving slower than
-        # the right wheel by some percentage, depending on the sharpness of the turn.
-        # "set_motor_dps" allows the wheels to be set to individual speeds.
-        if robot["x_axis"] < 0:  #  Moving fowrard to the left
-            robot["desired_speed"] = int(calc_desired_speed(robot["speed"], robot["force"]))
-            robot["differential_speed"] = int(calculate_differential_speed(robot["desired_speed"], robot["x_axis"]))
-            my_gopigo3.set_motor_dps(my_gopigo3.MOTOR_RIGHT, robot["desired_speed"])
-            my_gopigo3.set_motor_dps(my_gopigo3.MOTOR_LEFT, robot["differential_speed"])
-            print("moving forward to the left\n")
-
-            # Moving to the right, we apply the same logic as before, but swap wheels.
-        elif robot["x_axis"] > 0:  #  Moving fowrard to the right
-            robot["desired_speed"] = int(calc_desired_speed(robot["speed"], robot["force"]))
-            robot["differential_speed"] = int(calculate_differential_speed(robot["desired_speed"], robot["x_axis"]))
-            my_gopigo3.set_motor_dps(my_gopigo3.MOTOR_LEFT, robot["desired_speed"])
-            my_gopigo3.set_motor_dps(my_gopigo3.MOTOR_RIGHT, robot["differential_speed"])
-            print("moving forward to the right\n")
-
-        else:  # Moving directly forward
-            robot["desired_speed"] = int(calc_desired_speed(robot["speed"], robot["force"]))
-            my_gopigo3.set_motor_dps(my_gopigo3.MOTOR_LEFT, robot["desired_speed"])
-            my_gopigo3.set_motor_dps(my_gopigo3.MOTOR_RIGHT, robot["desired_speed"])
-            print("moving forward straight ahead\n")
-
-    elif robot["trigger_1"] == 1 and robot["y_axis"] > 0:
-        # We're moving backward
-        #  This is the exact same logic and calculation as moving forward
-        #  Except that it's "backwards" (bad pun!)
-        #  We do this by changing the sign of the speed requested.
-
-        # if we're not moving directly backward, the inside wheel must be slower
-        # than the outside wheel by some percentage.
-        print("The robot is: ", end="")
-
-        #  reduce maximum reverse speed to 1/2 forward speed
-        robot["speed"] = robot["speed"] * robot["reverse_speed_offset"]
-
-        if robot["x_axis"] < 0:  #  Moving backward to the left
-            # Moving to the left, the left wheel must be moving slower than
-            # the right wheel by some percentage.
-            robot["desired_speed"] = int(calc_desired_speed(robot["speed"], robot["force"]))
-            robot["differential_speed"] = int(calculate_differential_speed(robot["desired_speed"], robot["x_axis"]))
-            my_gopigo3.set_motor_dps(my_gopigo3.MOTOR_RIGHT, -robot["desired_speed"])
-            my_gopigo3.set_motor_dps(my_gopigo3.MOTOR_LEFT, -robot["differential_speed"])
-            print("moving backward to the left\n")
-
-        elif robot["x_axis"] > 0:  #  Moving backward to the right
-            # Moving to the right, we apply the same logic, but swap wheels.
-            robot["desired_speed"] = int(calc_desired_speed(robot["speed"], robot["force"]))
-            robot["differential_speed"] = int(calculate_differential_speed(robot["desired_speed"], robot["x_axis"]))
-            my_gopigo3.set_motor_dps(my_gopigo3.MOTOR_LEFT, -robot["desired_speed"])
-            my_gopigo3.set_motor_dps(my_gopigo3.MOTOR_RIGHT, -robot["differential_speed"])
-            print("moving backward to the right\n")
-
-        else:  #  Moving directly backward.
-            robot["desired_speed"] = int(calc_desired_speed(robot["speed"], robot["force"]))
-            my_gopigo3.set_motor_dps(my_gopigo3.MOTOR_LEFT, -robot["desired_speed"])
-            my_gopigo3.set_motor_dps(my_gopigo3.MOTOR_RIGHT, -robot["desired_speed"])
-            print("moving straight backward\n")
-
-#  If we're not receiving movement messages, maybe it's a head motion request?
-    if robot["motion_state"] == "ArrowUp":
+    if motion_state not in ("ArrowUp", "ArrowDown", "ArrowRight", "ArrowLeft", "Home", "Escape"):
+        motion_state = "unknown"
+    #    print("\nUnknown (ignored) key pressed\n")
+
+    with robot.writing():
+        robot.command.seq = seq
+        robot.command.controller_status = controller_status
+        robot.command.motion_state = motion_state
+        robot.command.direction = direction
+        robot.command.time_stamp = time_stamp
+        robot.command.x_axis = x_axis
+        robot.command.y_axis = y_axis
+        robot.command.head_x_axis = head_x_axis
+        robot.command.head_y_axis = head_y_axis
+        robot.command.force = force
+        robot.command.trigger_1 = trigger_1
+        robot.command.trigger_2 = trigger_2
+        robot.command.head_enable = head_enable
+
+        #  Remember when this command arrived, for the drive control loop's watchdog.
+        robot.command.command_time = monotonic()
+
+        #  If we're not receiving movement messages, maybe it's a head motion request?
+        if motion_state == "ArrowUp":
+            robot.head.vposition += robot.settings.servo_step_size
+            head_target = (robot.head.hposition, robot.head.vposition)
+
+        elif motion_state == "ArrowDown":
+            robot.head.vposition -= robot.settings.servo_step_size
+            head_target = (robot.head.hposition, robot.head.vposition)
+
+        elif motion_state == "ArrowRight":
+            robot.head.hposition += robot.settings.servo_step_size
+            if robot.head.hposition >= 180:
+                robot.head.hposition = 180
+            head_target = (robot.head.hposition, robot.head.vposition)
+
+        elif motion_state == "ArrowLeft":
+            robot.head.hposition -= robot.settings.servo_step_size
+            if robot.head.hposition <= 0:
+                robot.head.hposition = 0
+            head_target = (robot.head.hposition, robot.head.vposition)
+
+    if command_recorder is not None:
+        command_recorder.record(args)
+
+    #  When the drive control loop is running, it sets the wheel speeds from the values
+    #  we've just stored.  Otherwise, (e.g. when benchmarking), we do it here.
+    if control_loop is None:
+        drive_robot()
+
+    if motion_state == "ArrowUp":
         print("\nmoving head up\n")
-        robot["vposition"] += robot["servo_step_size"]
-        move_head(robot["hposition"], robot["vposition"])
-#        print(f"robot["vposition"] is {robot["vposition"]} - robot["hposition"] is {robot["hposition"]}\n")
-
-    elif robot["motion_state"] == "ArrowDown":
+    elif motion_state == "ArrowDown":
         print("\nmoving head down\n")
-        robot["vposition"] -= robot["servo_step_size"]
-        move_head(robot["hposition"], robot["vposition"])
-#        print(f"robot["vposition"] is {robot["vposition"]} - robot["hposition"] is {robot["hposition"]}\n")
-
-    elif robot["motion_state"] == "ArrowRight":
+    elif motion_state == "ArrowRight":
         print("\nmoving head right\n")
-        robot["hposition"] += robot["servo_step_size"]
-        if robot["hposition"] >= 180:
-            robot["hposition"] = 180
-        move_head(robot["hposition"], robot["vposition"])
-#        print(f"robot["vposition"] is {robot["vposition"]} - robot["hposition"] is {robot["hposition"]}\n")
-
-    elif robot["motion_state"] == "ArrowLeft":
+    elif motion_state == "ArrowLeft":
         print("\nmoving head left\n")
-        robot["hposition"] -= robot["servo_step_size"]
-        if robot["hposition"] <= 0:
-            robot["hposition"] = 0
-        move_head(robot["hposition"], robot["vposition"])
-#        print(f"robot["vposition"] is {robot["vposition"]} - robot["hposition"] is {robot["hposition"]}\n")
-
-    elif robot["motion_state"] == "Home":
+    elif motion_state == "Home":
         print("\nCentering Head\n")
         center_head()
-        servo1.disable_servo()
-        servo2.disable_servo()
-#        print(f"robot["vposition"] is {robot["vposition"]} - robot["hposition"] is {robot["hposition"]}\n")
-
-    elif robot["motion_state"] == "Escape":
+    elif motion_state == "Escape":
         print("A \"shutdown\" command was recieved from the browser.\n")
         print("Now requesting the server to start shutting down.\n")
-        my_gopigo3.stop()
-        keyboard_trigger.set()        
+        motors.stop(force = True)
+        keyboard_trigger.set()
 
-    else:
-        robot["motion_state"] = "unknown"
-#        print("\nUnknown (ignored) key pressed\n")
+    #  (the new position is already in robot.head, this tells the servos)
+    if head_target is not None:
+        head.move_to(*head_target)
+    #    print(f"robot.head.vposition is {robot.head.vposition} - robot.head.hposition is {robot.head.hposition}\n")
+
+    publish_telemetry()
+    process_commands_seconds.observe(monotonic() - start)
     return
 
 
@@ -510,7 +883,8 @@ class WebServerThread(Thread):
     '''
     def __init__(self, app, host, port):
         Thread.__init__(self)
-        self.srv = make_server(host, port, app)
+        #  threaded, so a connected WebSocket doesn't block every other request
+        self.srv = make_server(host, port, app, threaded = True)
 #        self.srv = make_server(host, port, app, ssl_context=("/usr/local/share/ca-certificates/extra/combined.crt", "/usr/local/share/ca-certificates/extra/www.gopigo3.com.key"))
         self.ctx = app.app_context()
         self.ctx.push()
@@ -527,131 +901,489 @@ class WebServerThread(Thread):
 ### Video Streaming Stuff ###
 #############################
 
+class FrameSlot(object):
+    '''
+    One slot in StreamingOutput's frame ring.
+    "data" is preallocated and reused, only the first "length" bytes are the frame.
+    "view" is a memoryview of "data", (writing through it avoids a temporary copy).
+    '''
+    __slots__ = ("data", "view", "length", "sequence")
+
+    def __init__(self, size):
+        self.data = bytearray(size)
+        self.view = memoryview(self.data)
+        self.length = 0
+        self.sequence = 0
+
 class StreamingOutput(object):
     '''
     Class to which the video output is written to.
     The buffer of this class is then read by StreamingHandler continuously.
+
+    Frames are written into a ring of preallocated slots instead of a BytesIO that is
+    copied for every frame.  When a frame is complete it is "published" as a read-only
+    memoryview of its slot, ("frame"), along with its sequence number, ("sequence"),
+    so readers can send it straight from the slot without copying it.
+    A slot is only reused after all the other slots have been filled, so a reader has
+    (slots - 1) frame times to finish with a frame.  A reader that may need longer, (a
+    stream client on a slow link), holds the frame, (hold), until it's done, (release),
+    and a held slot is given a new buffer instead of being overwritten.
+    Functions added with add_listener are called with (sequence, frame) for every
+    published frame, in the camera's thread, so they must be quick.
     '''
-    def __init__(self):
-        self.frame = None
-        self.buffer = io.BytesIO()
+    def __init__(self, slots = 8, slot_size = 256 * 1024):
+        self.slots = [FrameSlot(slot_size) for i in range(slots)]
+        self.write_slot = 0  #  the slot the camera is currently writing into
+        self.write_length = 0
+        self.sequence = 0  #  sequence number of the latest published frame
+        self.frame = None  #  memoryview of the latest published frame
+        self.snapshot_sequence = 0  #  sequence number of the frame copied by snapshot()
+        self.snapshot_frame = None
         self.condition = Condition()
+        self.listeners = []
+        self.held = {}  #  {sequence: number of holds} of the frames still being read
+
+    #  Keep the frame "sequence" from being overwritten until it's released.
+    #  Returns False if it has already been overwritten, (or is being).
+    def hold(self, sequence):
+        with self.condition:
+            slot = self.slots[(sequence - 1) % len(self.slots)]
+            if slot.sequence != sequence or slot is self.slots[self.write_slot]:
+                return False
+            self.held[sequence] = self.held.get(sequence, 0) + 1
+            return True
+
+    def release(self, sequence):
+        with self.condition:
+            holds = self.held.pop(sequence, 0) - 1
+            if holds > 0:
+                self.held[sequence] = holds
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
 
     def write(self, buf):
-        if buf.startswith(b"\xff\xd8"):
-            # New frame, copy the existing buffer's content and notify all
+        if buf.startswith(b"\xff\xd8") and self.write_length > 0:
+            # New frame, publish the slot holding the previous one and notify all
             # clients it's available
-            self.buffer.truncate()
+            slot = self.slots[self.write_slot]
+            slot.length = self.write_length
             with self.condition:
-                self.frame = self.buffer.getvalue()
+                self.sequence += 1
+                slot.sequence = self.sequence
+                self.frame = slot.view[:slot.length].toreadonly()
+                self.write_slot = (self.write_slot + 1) % len(self.slots)
+                self.write_length = 0
+                slot = self.slots[self.write_slot]
+                if slot.sequence in self.held:
+                    #  Someone is still reading the frame in the next slot, so leave them
+                    #  its buffer, and write into a new one.
+                    slot.data = bytearray(len(slot.data))
+                    slot.view = memoryview(slot.data)
                 self.condition.notify_all()
-            self.buffer.seek(0)
-        return self.buffer.write(buf)
+            frames_published_total.inc()
+            for listener in self.listeners:
+                listener(self.sequence, self.frame)
+
+        slot = self.slots[self.write_slot]
+        end = self.write_length + len(buf)
+        if end > len(slot.data):
+            #  Frame is bigger than the slot.  Readers may still hold views of the old
+            #  buffer, (so it can't be resized), so give this slot a new, bigger one.
+            data = bytearray(max(end, 2 * len(slot.data)))
+            view = memoryview(data)
+            view[:self.write_length] = slot.view[:self.write_length]
+            slot.data = data
+            slot.view = view
+        slot.view[self.write_length:end] = buf
+        self.write_length = end
+        return len(buf)
+
+    #  Return the latest (sequence, frame) pair once there is a frame newer than "after",
+    #  or (sequence, None) if there isn't one within "timeout" seconds.
+    #  The frame is a copy, (bytes), that can be kept for as long as needed.  The copy is made
+    #  once per frame and shared by everyone that asks for the same frame.
+    #  An "after" newer than the latest frame, (the camera was restarted), doesn't wait.
+    def snapshot(self, after = 0, timeout = None):
+        with self.condition:
+            if after <= self.sequence:
+                self.condition.wait_for(lambda: self.sequence > after, timeout)
+            if self.sequence == 0 or self.sequence == after:
+                return self.sequence, None
+            if self.snapshot_sequence != self.sequence:
+                self.snapshot_sequence = self.sequence
+                self.snapshot_frame = bytes(self.frame)
+            return self.snapshot_sequence, self.snapshot_frame
+
+#  The ETag of the camera frame with this sequence number, (for /snapshot.jpg).
+def frame_etag(sequence):
+    return '"frame-{}"'.format(sequence)
 
 class StreamingHandler(server.BaseHTTPRequestHandler):
     '''
     Implementing GET request for the video stream.
+    Once the response headers are sent, the connection is handed over to the
+    stream broadcaster, which sends the frames to every viewer from one thread.
+
+    /stream.mjpg?fps=N limits that viewer to N frames per second.
+    /stream_stats.json returns the frames sent and dropped for every viewer.
+    /snapshot.jpg returns the latest frame as a single JPEG, with its sequence number
+    in the X-Frame-Sequence header.  /snapshot.jpg?after=N waits, (up to "timeout" seconds,
+    default 10), for a frame newer than N, and returns 204 if there isn't one by then,
+    (or 304 if the request's If-None-Match is that latest frame's ETag).
+
+    If the video is being recorded:
+    /recordings.json lists the recorded segments.
+    /recording.jpg?t=T returns the frame recorded at time T, (seconds since the epoch,
+    or a negative number of seconds before now).
+    /recording.mjpg?t=T&speed=S plays the recording from time T at S times the recorded pace.
     '''
     def do_GET(self):
-        if self.path == "/stream.mjpg":
+        url = urlsplit(self.path)
+        if url.path == "/stream.mjpg":
+            try:
+                max_fps = float(parse_qs(url.query).get("fps", ["0"])[0])
+            except ValueError:
+                self.send_error(400, "fps must be a number")
+                return
             self.send_response(200)
             self.send_header("Age", 0)
             self.send_header("Cache-Control", "no-cache, private")
             self.send_header("Pragma", "no-cache")
             self.send_header("Content-Type", "multipart/x-mixed-replace; boundary=FRAME")
             self.end_headers()
-            try:
-                while True:
-                    with output.condition:
-                        output.condition.wait()
-                        frame = output.frame
-                    self.wfile.write(b"--FRAME\r\n")
-                    self.send_header("Content-Type", "image/jpeg")
-                    self.send_header("Content-Length", len(frame))
-                    self.end_headers()
-                    self.wfile.write(frame)
-                    self.wfile.write(b"\r\n")
-            except Exception as e:
-                logging.warning(
-                    "Removed streaming client %s: %s",
-                    self.client_address, str(e))
+            self.close_connection = True
+            self.server.detach(self.connection)
+            broadcaster.add_client(self.connection, self.client_address, max_fps if max_fps > 0 else None)
+        elif url.path == "/snapshot.jpg":
+            self.send_snapshot(parse_qs(url.query))
+        elif url.path in ("/recordings.json", "/recording.jpg", "/recording.mjpg"):
+            if video_archive is None:
+                self.send_error(404, "The video is not being recorded")
+            else:
+                self.send_recording(url.path, parse_qs(url.query))
+        elif url.path == "/stream_stats.json":
+            body = json.dumps({"clients": broadcaster.client_stats()}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", len(body))
+            self.send_header("Cache-Control", "no-cache, private")
+            self.end_headers()
+            self.wfile.write(body)
         else:
             self.send_error(404)
             self.end_headers()
 
+    def send_snapshot(self, query):
+        try:
+            after = int(query.get("after", ["0"])[0])
+            timeout = min(float(query.get("timeout", [str(SNAPSHOT_TIMEOUT)])[0]), SNAPSHOT_MAX_TIMEOUT)
+        except ValueError:
+            self.send_error(400, "after and timeout must be numbers")
+            return
+        sequence, frame = output.snapshot(after, max(timeout, 0))
+        if frame is None:
+            if sequence == 0:
+                self.send_error(503, "No frame from the camera yet")
+                return
+            #  Nothing newer arrived in time.  "304 Not Modified" only answers a conditional
+            #  request for the frame the browser already has, anything else gets "204 No Content".
+            self.send_response(304 if frame_etag(sequence) in self.headers.get("If-None-Match", "") else 204)
+            self.send_header("ETag", frame_etag(sequence))
+            self.send_header("X-Frame-Sequence", sequence)
+            self.send_header("Cache-Control", "no-cache, private")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", len(frame))
+        self.send_header("ETag", frame_etag(sequence))
+        self.send_header("X-Frame-Sequence", sequence)
+        self.send_header("Cache-Control", "no-cache, private")
+        self.end_headers()
+        self.wfile.write(frame)
+
+    def send_recording(self, path, query):
+        if path == "/recordings.json":
+            body = json.dumps({"segments": video_archive.describe()}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", len(body))
+            self.send_header("Cache-Control", "no-cache, private")
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        try:
+            timestamp = float(query.get("t", ["0"])[0])
+            speed = float(query.get("speed", ["1"])[0])
+        except ValueError:
+            self.send_error(400, "t and speed must be numbers")
+            return
+        if timestamp <= 0:
+            timestamp += time()
+
+        if path == "/recording.jpg":
+            recorded = video_archive.frame_at(timestamp)
+            if recorded is None:
+                self.send_error(404, "Nothing was recorded then")
+                return
+            frame_time, frame = recorded
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", len(frame))
+            self.send_header("X-Frame-Time", "{:.3f}".format(frame_time))
+            self.end_headers()
+            self.wfile.write(frame)
+            return
+
+        #  Played back from this handler's thread, at the recorded pace, (gaps of more
+        #  than a second, where nothing was recorded, are skipped).
+        self.send_response(200)
+        self.send_header("Cache-Control", "no-cache, private")
+        self.send_header("Content-Type", "multipart/x-mixed-replace; boundary=FRAME")
+        self.end_headers()
+        self.close_connection = True
+        previous_time = None
+        try:
+            for frame_time, frame in video_archive.frames(timestamp):
+                if previous_time is not None and speed > 0:
+                    sleep(min(max(frame_time - previous_time, 0.0), 1.0) / speed)
+                previous_time = frame_time
+                self.wfile.write(part_header(len(frame)))
+                self.wfile.write(frame)
+                self.wfile.write(PART_TRAILER)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
 class StreamingServer(socketserver.ThreadingMixIn, server.HTTPServer):
     allow_reuse_address = True
     daemon_threads = True
+    request_queue_size = 32  #  the default of 5 drops connections when several viewers connect at once
 
-#############################
-### Aggregating all calls ###
-#############################
+    def __init__(self, *args, **kwargs):
+        server.HTTPServer.__init__(self, *args, **kwargs)
+        self.detached = set()
 
-if __name__ == "__main__":
-    # registering both types of termination signals
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
+    #  Connections handed to the stream broadcaster must not be closed when the request ends.
+    def detach(self, request):
+        self.detached.add(request)
+
+    def shutdown_request(self, request):
+        if request in self.detached:
+            self.detached.discard(request)
+            return
+        server.HTTPServer.shutdown_request(self, request)
 
-print("\nNew Remote Camera Robot is starting with the following default values:")
-print("Robot Maximum Speed = ", robot["turbo_speed"],"rotational degrees/second.")
-print("Robot Normal Speed = ", robot["normal_speed"],"rotational degrees/second.")
-print("Robot Reverse Speeds are set to", robot["reverse_speed_offset"], "times the forward speeds.\n")
-#  Make sure nginx is started before starting anything else
-if (os.system("sudo systemctl restart nginx")) != 0:
-    logging.error("Nginx did not start properly, exiting.")
-    sys.exit(1)
-else:
+#############################
+###    Startup Phases     ###
+#############################
+#
+#  Each of these is run in its own thread by the startup sequence, (see robot_startup.py),
+#  and returns once its part of the robot is really ready, (or raises StartupError).
+
+# the services, once they have been started
+webserver = None
+camera = None
+stream = None
+streamserver = None
+output = None
+broadcaster = None
+
+def start_nginx():
+    if (os.system("sudo systemctl restart nginx")) != 0:
+        raise StartupError("Nginx did not start properly, exiting.", 1)
     print("The nginx proxy/secure context wrapper service has successfully started")
     print("and is listening for HTTPS connections on port 443.\n")
 
-# firing up the video camera (pi camera)
-    camera = picamera.PiCamera()
+def start_hardware():
+    try:
+        my_gopigo3.get()
+        servo1.get()
+        servo2.get()
+    except IOError:
+        raise StartupError("GoPiGo3 is not detected.", 1)
+    except FirmwareVersionError:
+        raise StartupError("GoPiGo3 firmware needs to be updated", 2)
+    except ValueError as e:
+        raise StartupError(str(e), 4)
+    except Exception:
+        raise StartupError("Unexpected error when initializing GoPiGo3 object", 3)
+    print("The GoPiGo3 was initialized in", round(my_gopigo3.init_seconds, 3), "seconds.")
+
+# the camera writes its frames here, and the stream broadcaster sends them to the viewers,
+# (the asyncio server sends them itself, so it doesn't need one)
+def start_video_output():
+    global output, broadcaster
     output = StreamingOutput()
-    camera.resolution="800x600"
-    camera.framerate=30
-#    camera.rotation=180
-    camera.meter_mode="average"
-    camera.awb_mode="auto"
-    camera.start_recording(output, format="mjpeg")
-    stream = StreamingServer((HOST, STREAM_PORT), StreamingHandler)
-    sleep(0.25)
+    if use_async_server:
+        return
+    broadcaster = StreamBroadcaster(output)
+    broadcaster.start()
+    output.add_listener(broadcaster.publish)
+
+# recording the video, if asked to
+def start_video_recorder():
+    global video_recorder, video_archive
+    if not os.environ.get("ROBOT_VIDEO_DIR"):
+        return
+    try:
+        video_recorder = VideoRecorder(os.environ["ROBOT_VIDEO_DIR"],
+                                       max_bytes = int(os.environ.get("ROBOT_VIDEO_MAX_MB", "1024")) * 1024 * 1024,
+                                       max_fps = float(os.environ.get("ROBOT_VIDEO_FPS", "0")))
+        video_recorder.start()
+        output.add_listener(video_recorder.publish)
+        video_archive = VideoArchive(os.environ["ROBOT_VIDEO_DIR"])
+        print("Recording the video to", os.environ["ROBOT_VIDEO_DIR"])
+    except (OSError, ValueError) as e:
+        logging.error("Unable to record the video: %s", str(e))
+
+# firing up the video camera, (the pi camera, or the frame source
+# selected by ROBOT_CAMERA, see robot_camera.py)
+def start_camera():
+    global camera
+    try:
+        camera = create_frame_source()
+    except (IOError, ValueError) as e:
+        raise StartupError(str(e), 5)
+    camera.start(output)
+
+    #  The camera is ready when it has produced its first frame
+    with output.condition:
+        if not output.condition.wait_for(lambda: output.sequence > 0, CAMERA_READY_TIMEOUT):
+            raise StartupError("The camera has not produced a frame", 5)
     print("The streaming camera process has started successfully\n")
 
-    # starting the video streaming server
+# starting the video streaming server
+def start_stream_server(port = STREAM_PORT):
+    global stream, streamserver
+    stream = StreamingServer((HOST, port), StreamingHandler)
     streamserver = Thread(target = stream.serve_forever)
     streamserver.start()
-    sleep(0.25)
-    print("The streaming server has started successfully on port ", STREAM_PORT)
-
-    # starting the web server
-    webserver = WebServerThread(app, HOST, WEB_PORT)
+    wait_for_http(port, "/stream_stats.json")
+    print("The streaming server has started successfully on port ", port)
+
+# starting the camera, the stream server and the video recorder in their own process,
+# (see run_video_process), instead of the "camera" and "stream server" phases
+def start_video_process(port = STREAM_PORT):
+    global video_process
+    video_process = VideoProcess(run_video_process, args = (port,), start_timeout = CAMERA_READY_TIMEOUT,
+                                 stall_timeout = VIDEO_PROCESS_STALL_TIMEOUT)
+    video_process.start()
+    if video_process.shared.wait(0, CAMERA_READY_TIMEOUT) == 0:
+        raise StartupError("The video process has not produced a frame", 5)
+    wait_for_http(port, "/stream_stats.json")
+    print("The video process has started successfully, streaming on port ", port, "\n")
+
+# The video process itself, (started by VideoProcess in robot_video_process.py).
+# Runs the camera, the stream server and the video recorder, and publishes the sequence number
+# of every frame to the SharedVideoStatus "status_name", until the main process stops it,
+# (SIGTERM), or goes away.
+def run_video_process(status_name, port = STREAM_PORT):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  #  Ctrl-C is for the main process, which stops us
+    stopping = Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    parent = os.getppid()
+    shared = SharedVideoStatus(status_name)
+    shared.beat()
+
+    start_video_output()
+    output.add_listener(shared.publish)
+    start_video_recorder()
+    try:
+        start_camera()
+        start_stream_server(port)
+    except StartupError as e:
+        logging.critical("The video process failed to start: %s", str(e))
+        shutdown_video()
+        shared.close()
+        sys.exit(e.exit_code)
+
+    while not stopping.wait(HEARTBEAT_INTERVAL) and os.getppid() == parent:
+        shared.beat()
+    shutdown_video()
+    shared.close()
+
+# starting the web server, (the threaded werkzeug server, or the asyncio server
+# which also serves the video stream and telemetry, see robot_async_server.py)
+def start_web_server():
+    global webserver
+    #  Read and compress the static files now, so the first page load doesn't have to
+    static_assets.preload()
+    if use_async_server:
+        webserver = AsyncRobotServer(app, HOST, WEB_PORT, output = output, static_assets = static_assets,
+                                     pages = pages, telemetry = telemetry, telemetry_max_rate = TELEMETRY_MAX_RATE,
+                                     workers = ASYNC_SERVER_WORKERS)
+    else:
+        webserver = WebServerThread(app, HOST, WEB_PORT)
     webserver.start()
-    sleep(0.25)
+    wait_for_http(WEB_PORT, "/ready")
     print("The flask web server has started successfully on port ", WEB_PORT, "\n")
 
-    # Shaking Charlie's head to indicate startup
+# starting the drive control loop
+def start_control_loop():
+    global control_loop
+    if CONTROL_LOOP_RATE <= 0:
+        return
+    control_loop = DriveControlLoop(drive_robot, command_timeout, lambda: robot.command.command_time,
+                                    rate = CONTROL_LOOP_RATE, timeout = COMMAND_TIMEOUT)
+    control_loop.start()
+    while control_loop.ticks == 0 and control_loop.is_alive():
+        sleep(0.001)
+    print("The drive control loop has started at", CONTROL_LOOP_RATE, "times a second.")
+
+# reading the battery and the temperature in the background
+def start_sensors():
+    sensors.start()
+    print("The sensors are being read every", ", ".join("{} seconds, ({})".format(sensor.interval, sensor.name)
+                                                       for sensor in sensors.sensors))
+
+# Shaking Charlie's head to indicate startup
+# (this doesn't hold anything up, the robot can already be driven)
+# the head servos' thread, (move_head, shake_head and the arrow keys need it)
+def start_head():
+    if head.ident is None:
+        head.start()
+
+def signal_startup():
     print("Charlie is signalling that the startup command has successfully run by shaking his head.\n")
     shake_head()
-    sleep(0.25)  #  Give head time to get centered.
-    print("Joystick_Data_Test is now listening for browser connections.\n")
-
-    # and run the flask server untill a keyboard event is set
-    # or the escape key is pressed
-    while not keyboard_trigger.is_set():
-        sleep(0.25)
-
-    # until some keyboard event is detected
-    print("\n ==========================\n\n")
-    print("A \"shutdown\" command event was received!\n")
 
+# Stop the camera, the stream server and the video recorder, (in whichever process they run).
+def shutdown_video():
+    if camera is not None and camera.recording:
+        camera.stop()
+    if video_recorder is not None:
+        video_recorder.stop()
+        print(video_recorder.frames_recorded, "frames were recorded to", video_recorder.directory,
+              "and", video_recorder.frames_dropped, "were dropped")
+    if stream is not None:
+        stream.shutdown()
+    if broadcaster is not None:
+        broadcaster.stop()
+    if streamserver is not None:
+        streamserver.join()
+
+# Stop whatever was started.  Anything that didn't start is skipped.
+def shutdown_services():
     # begin shutdown procedure
-    webserver.shutdown()
-    camera.stop_recording()
-    stream.shutdown()
+    if webserver is not None:
+        webserver.shutdown()
+    if control_loop is not None:
+        control_loop.stop()
+        print("Drive control loop statistics:", control_loop.stats())
+    if command_recorder is not None:
+        command_recorder.close()
+        print(command_recorder.records, "commands were recorded to", command_recorder.path)
+    if video_process is not None:
+        video_process.stop()
+        print("The video process was restarted", video_process.restarts, "times.")
+    shutdown_video()
+    sensors.stop()
 
     # and finalize shutting them down
-    webserver.join()
-    streamserver.join()
+    if webserver is not None:
+        webserver.join()
     print("All web and streaming services have successfully shut down.\n")
 
     print("Shutting down nginx proxy. . .\n")
@@ -661,10 +1393,83 @@ else:
     sleep(0.25)
 
     # Center Charlie's Head on shutdown
-    shake_head()
-    sleep(0.25)  #  Give head time to get centered.
-    my_gopigo3.stop()  # Just in case. . .
+    if my_gopigo3.initialized():
+        shake_head()
+        sleep(0.25)  #  Give head time to get centered.
+        motors.stop(force = True)  # Just in case. . .
+    head.stop()
     print("Charlie is signalling that shutdown has successfully completed by shaking his head.\n")
+
+#############################
+### Aggregating all calls ###
+#############################
+
+if __name__ == "__main__":
+    # registering both types of termination signals
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+    signal.signal(signal.SIGUSR1, profile_signal_handler)
+
+    print("\nNew Remote Camera Robot is starting with the following default values:")
+    print("Robot Maximum Speed = ", robot.settings.turbo_speed,"rotational degrees/second.")
+    print("Robot Normal Speed = ", robot.settings.normal_speed,"rotational degrees/second.")
+    print("Robot Reverse Speeds are set to", robot.settings.reverse_speed_offset, "times the forward speeds.\n")
+
+    # the video, (and recording it, if asked to), runs in this process, unless it has its own
+    isolate_video = os.environ.get("ROBOT_VIDEO_PROCESS", "0") == "1"
+    use_async_server = os.environ.get("ROBOT_ASYNC_SERVER", "0") == "1"
+    if not isolate_video:
+        start_video_output()
+        start_video_recorder()
+
+    # recording the commands, if asked to
+    if os.environ.get("ROBOT_COMMAND_LOG"):
+        try:
+            command_recorder = CommandRecorder(os.environ["ROBOT_COMMAND_LOG"])
+            print("Recording all commands to", os.environ["ROBOT_COMMAND_LOG"])
+        except (OSError, CommandLogError) as e:
+            logging.error("Unable to record commands: %s", str(e))
+
+    # so the first /telemetry subscriber gets a complete state
+    publish_telemetry()
+    start_head()
+
+    #  Everything starts at once, except where one thing needs another.
+    #  The robot is drivable, (/ready), as soon as the "required" phases are ready.
+    startup.add("nginx", start_nginx, required = True)
+    startup.add("hardware", start_hardware, required = True, exit_code = 3)
+    startup.add("control loop", start_control_loop, after = ("hardware",), required = True)
+    startup.add("web server", start_web_server, required = True)
+    if isolate_video:
+        startup.add("video process", start_video_process, exit_code = 5)
+    else:
+        startup.add("camera", start_camera, exit_code = 5)
+        if not use_async_server:
+            startup.add("stream server", start_stream_server)
+    startup.add("sensors", start_sensors, after = ("hardware",))
+    startup.add("head", signal_startup, after = ("hardware",))
+    startup.start()
+    startup.wait()
+    print(startup.report(), "\n")
+
+    failed = startup.failure()
+    if failed is not None:
+        logging.critical("Startup failed in the %s phase: %s", failed.name, str(failed.error))
+        shutdown_services()
+        sys.exit(StartupSequence.exit_code(failed))
+
+    print("Joystick_Data_Test is now listening for browser connections.\n")
+
+    # and run the flask server untill a keyboard event is set
+    # or the escape key is pressed
+    while not keyboard_trigger.is_set():
+        sleep(0.25)
+
+    # until some keyboard event is detected
+    print("\n ==========================\n\n")
+    print("A \"shutdown\" command event was received!\n")
+
+    shutdown_services()
     sleep(0.25)
 
     print("New Remote Camera Robot has fully shut down - exiting.\n")
@@ -0,0 +1,208 @@
+#
+#  New Remote Camera Robot - asyncio server benchmark
+#
+#  Compares the two ways of serving the robot, (simulated GoPiGo3, synthetic camera):
+#    * threaded - werkzeug for the page and /robot, plus the stream server for the video,
+#                 (a thread for every connection)
+#    * async    - everything on one port from one asyncio event loop, (ROBOT_ASYNC_SERVER=1,
+#                 see robot_async_server.py)
+#  with the same load on each: a client sending joystick commands at a fixed rate, stream viewers,
+#  telemetry subscribers, and a browser loading the page and its static files over and over.
+#  It reports, for each:
+#    * the latency of /robot and of the page and static file requests, (p50/p95/p99)
+#    * the frames per second each stream viewer received
+#    * the most threads and open file descriptors the server process had, and its CPU use
+#
+#  Usage:  python3 benchmarks/bench_async_server.py [--modes threaded,async] [--stream-clients 4]
+#                  [--telemetry-clients 2] [--rate 50] [--seconds S] [--spi-cost SECONDS] [--json]
+
+import argparse
+import http.client
+import logging
+import multiprocessing
+import os
+import resource
+import socket
+import threading
+from time import monotonic, sleep
+
+from bench_common import driving_session, load_robot_module, quiet, report, summarize
+from bench_control_load import run_client
+from bench_stream_fanout import run_viewers
+from robot_camera import SyntheticFrameSource
+
+PAGE_FILES = ["/", "/static/style.css", "/static/throttle.js", "/static/jquery-3.6.0.min.js",
+              "/static/New_Remote_Camera_Robot.js", "/static/gamepad_config.json"]
+
+
+#  A browser loading the page and its files over one keep-alive connection, (revalidating,
+#  like a reload), until "end".  Runs in its own process.
+def run_page_loads(port, start_at, seconds, results):
+    sleep(max(0.0, start_at - monotonic()))
+    end = start_at + seconds
+    etags = {}
+    latencies = []
+    connection = http.client.HTTPConnection("127.0.0.1", port)
+    while monotonic() < end:
+        for path in PAGE_FILES:
+            headers = {"Accept-Encoding": "gzip"}
+            if path in etags:
+                headers["If-None-Match"] = etags[path]
+            started = monotonic()
+            connection.request("GET", path, headers = headers)
+            response = connection.getresponse()
+            response.read()
+            latencies.append(monotonic() - started)
+            if response.getheader("ETag"):
+                etags[path] = response.getheader("ETag")
+        sleep(0.05)
+    connection.close()
+    results.put(latencies)
+
+
+#  Telemetry subscribers, reading their streams until "seconds" have passed.
+def run_telemetry(port, clients, seconds, results):
+    sockets = []
+    for i in range(clients):
+        sock = socket.create_connection(("127.0.0.1", port))
+        sock.sendall(b"GET /telemetry HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        sock.settimeout(0.1)
+        sockets.append(sock)
+    events = 0
+    end = monotonic() + seconds
+    while monotonic() < end:
+        for sock in sockets:
+            try:
+                events += sock.recv(65536).count(b"\n\n")
+            except socket.timeout:
+                pass
+    for sock in sockets:
+        sock.close()
+    results.put(events)
+
+
+#  Start the servers for "mode".  Returns (web port, stream port, a function that stops them).
+def start_servers(robot_module, mode):
+    output = robot_module.StreamingOutput()
+    robot_module.output = output
+    source = SyntheticFrameSource(fps = 30, frame_size = 50000)
+    if mode == "async":
+        server = robot_module.AsyncRobotServer(robot_module.app, "127.0.0.1", 0, output = output,
+                                               static_assets = robot_module.static_assets, pages = robot_module.pages,
+                                               telemetry = robot_module.telemetry,
+                                               workers = robot_module.ASYNC_SERVER_WORKERS)
+        server.start()
+        source.start(output)
+
+        def stop():
+            source.stop()
+            server.shutdown()
+            server.join()
+
+        return server.server_port, server.server_port, stop
+
+    webserver = robot_module.WebServerThread(robot_module.app, "127.0.0.1", 0)
+    webserver.daemon = True
+    webserver.start()
+    broadcaster = robot_module.StreamBroadcaster(output)
+    broadcaster.start()
+    output.add_listener(broadcaster.publish)
+    robot_module.broadcaster = broadcaster
+
+    class QuietStreamingHandler(robot_module.StreamingHandler):
+        def log_message(self, format, *args):
+            pass
+
+    stream = robot_module.StreamingServer(("127.0.0.1", 0), QuietStreamingHandler)
+    threading.Thread(target = stream.serve_forever, daemon = True).start()
+    source.start(output)
+
+    def stop():
+        source.stop()
+        stream.shutdown()
+        stream.server_close()
+        broadcaster.stop()
+        webserver.shutdown()
+
+    return webserver.srv.server_port, stream.server_port, stop
+
+
+def run(robot_module, mode, stream_clients, telemetry_clients, rate, seconds):
+    web_port, stream_port, stop = start_servers(robot_module, mode)
+    viewer_results = multiprocessing.Queue()
+    telemetry_results = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    page_results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target = run_viewers, args = (stream_port, stream_clients, seconds + 1.0, viewer_results)),
+        multiprocessing.Process(target = run_telemetry, args = (web_port, telemetry_clients, seconds + 1.0, telemetry_results)),
+    ]
+    for process in processes:
+        process.start()
+    sleep(0.5)  #  let the viewers and subscribers connect
+
+    start_at = monotonic() + 0.5
+    processes.append(multiprocessing.Process(target = run_client, args = (web_port, "post", driving_session(400),
+                                                                          rate, start_at, seconds, results)))
+    processes.append(multiprocessing.Process(target = run_page_loads, args = (web_port, start_at, seconds, page_results)))
+    for process in processes[2:]:
+        process.start()
+
+    sleep(max(0.0, start_at - monotonic()))
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    max_threads = 0
+    max_fds = 0
+    while monotonic() < start_at + seconds:
+        max_threads = max(max_threads, threading.active_count())
+        max_fds = max(max_fds, len(os.listdir("/proc/self/fd")))
+        sleep(0.1)
+    latencies, service_times, errors = results.get()
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+    page_latencies = page_results.get()
+    frames = viewer_results.get()
+    telemetry_events = telemetry_results.get()
+    for process in processes:
+        process.join()
+    stop()
+
+    result = {"robot_" + key: value for key, value in summarize(latencies).items() if key != "count"}
+    result.update({"page_" + key: value for key, value in summarize(page_latencies).items() if key != "count"})
+    result["errors"] = errors
+    result["stream_fps_per_client"] = sum(viewer[0] for viewer in frames) / float(stream_clients) / (seconds + 1.0)
+    result["telemetry_events"] = telemetry_events
+    result["max_threads"] = max_threads
+    result["max_open_fds"] = max_fds
+    cpu = (usage_after.ru_utime - usage_before.ru_utime) + (usage_after.ru_stime - usage_before.ru_stime)
+    result["server_cpu_percent"] = cpu / seconds * 100.0
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Compare the threaded servers with the asyncio server")
+    parser.add_argument("--modes", default = "threaded,async", help = "comma separated: threaded, async")
+    parser.add_argument("--stream-clients", type = int, default = 4, help = "video stream viewers")
+    parser.add_argument("--telemetry-clients", type = int, default = 2, help = "telemetry subscribers")
+    parser.add_argument("--rate", type = float, default = 50, help = "commands per second")
+    parser.add_argument("--seconds", type = float, default = 5.0, help = "seconds per mode")
+    parser.add_argument("--spi-cost", type = float, default = 0.0004,
+                        help = "simulated seconds per SPI call")
+    parser.add_argument("--json", action = "store_true", help = "machine-readable output")
+    options = parser.parse_args()
+
+    robot_module = load_robot_module(spi_call_cost = options.spi_cost)
+    logging.getLogger().setLevel(logging.ERROR)  #  every viewer leaving is logged as a warning
+    robot_module.static_assets.preload()
+
+    results = {}
+    with quiet():
+        robot_module.publish_telemetry()
+        for mode in options.modes.split(","):
+            results[mode] = run(robot_module, mode, options.stream_clients, options.telemetry_clients,
+                                options.rate, options.seconds)
+
+    report("Servers, {:g} commands/s, {} stream viewers, {} telemetry subscribers, (simulated GoPiGo3, {} s/SPI call)".format(
+           options.rate, options.stream_clients, options.telemetry_clients, options.spi_cost), results, options.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+#
+#  New Remote Camera Robot - shared benchmark helpers
+#
+#  Everything in the benchmarks directory runs against the simulated GoPiGo3,
+#  (see robot_hardware.py), so it can be run on any Linux machine:
+#
+#    python3 benchmarks/bench_robot_commands.py
+#
+#  load_robot_module() sets ROBOT_BACKEND=simulated and imports New_Remote_Camera_Robot.
+#  Importing it doesn't touch the hardware: the backend is only created, (from ROBOT_BACKEND),
+#  the first time it is used, (see LazyHardware in robot_hardware.py).  Use load_robot_module()
+#  rather than importing the module directly, so the simulator is chosen before that happens.
+
+import contextlib
+import io
+import json
+import logging
+import os
+import sys
+from time import perf_counter
+
+#  Make the project directory importable no matter where the benchmark is started from.
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_DIR not in sys.path:
+    sys.path.insert(0, PROJECT_DIR)
+
+
+#  Import New_Remote_Camera_Robot using the simulated hardware backend.
+def load_robot_module(spi_call_cost = None):
+    os.environ["ROBOT_BACKEND"] = "simulated"
+    if spi_call_cost is not None:
+        os.environ["ROBOT_SIM_SPI_COST"] = str(spi_call_cost)
+    import New_Remote_Camera_Robot
+    New_Remote_Camera_Robot.start_head()
+
+    #  werkzeug logs every request, which would swamp the results
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    return New_Remote_Camera_Robot
+
+
+#  process_robot_commands is chatty.  Benchmarks measure the work, not the terminal.
+def quiet():
+    return contextlib.redirect_stdout(io.StringIO())
+
+
+#  A joystick message, in the same form the browser sends it.
+def joystick_command(x_axis = 0.0, y_axis = 0.0, trigger_1 = 0, trigger_2 = 0,
+                     motion_state = "Stopped", time_stamp = 0):
+    return {
+        "controller_status": "Connected",
+        "motion_state": motion_state,
+        "angle_dir": "None",
+        "time_stamp": str(int(time_stamp)),
+        "x_axis": str(x_axis),
+        "y_axis": str(y_axis),
+        "head_x_axis": "0",
+        "head_y_axis": "0",
+        "force": str(abs(y_axis)),
+        "trigger_1": str(trigger_1),
+        "trigger_2": str(trigger_2),
+        "head_enable": "0",
+    }
+
+
+#  A short, repeatable driving session: accelerate, cruise, turn both ways, back up and stop.
+def driving_session(length = 200):
+    commands = []
+    for i in range(length):
+        phase = (i * 8) // length
+        if phase == 0:
+            command = joystick_command(y_axis = -round(0.1 + 0.8 * i * 8 / length, 2), trigger_1 = 1)
+        elif phase in (1, 2):
+            command = joystick_command(y_axis = -0.9, trigger_1 = 1)
+        elif phase == 3:
+            command = joystick_command(x_axis = -0.8, y_axis = -0.6, trigger_1 = 1)
+        elif phase == 4:
+            command = joystick_command(x_axis = 0.8, y_axis = -0.6, trigger_1 = 1, trigger_2 = 1)
+        elif phase == 5:
+            command = joystick_command(y_axis = 0.5, trigger_1 = 1)
+        elif phase == 6:
+            command = joystick_command(x_axis = 0.6, y_axis = 0.5, trigger_1 = 1)
+        else:
+            command = joystick_command()
+        command["time_stamp"] = str(1000 + i * 16)
+        commands.append(command)
+    return commands
+
+
+#  Summarize a list of latencies, (in seconds), as milliseconds.
+def summarize(latencies):
+    if not latencies:
+        return {"count": 0}
+    ordered = sorted(latencies)
+    count = len(ordered)
+
+    def percentile(p):
+        return ordered[min(count - 1, int(p / 100.0 * count))] * 1000.0
+
+    return {
+        "count": count,
+        "mean_ms": sum(ordered) / count * 1000.0,
+        "p50_ms": percentile(50),
+        "p95_ms": percentile(95),
+        "p99_ms": percentile(99),
+        "max_ms": ordered[-1] * 1000.0,
+    }
+
+
+#  Run "function" once per item in "items" and return the per-call latencies and the elapsed time.
+def time_calls(function, items):
+    latencies = []
+    start = perf_counter()
+    for item in items:
+        t0 = perf_counter()
+        function(item)
+        latencies.append(perf_counter() - t0)
+    return latencies, perf_counter() - start
+
+
+#  Print results as a readable table, or as JSON if "as_json" is set.
+def report(title, results, as_json = False):
+    if as_json:
+        print(json.dumps({"benchmark": title, "results": results}, indent = 2, sort_keys = True))
+        return
+    print("\n" + title)
+    print("=" * len(title))
+    for name, values in results.items():
+        print("  " + name)
+        for key in sorted(values):
+            value = values[key]
+            if isinstance(value, float):
+                print("    {:<22} {:12.4f}".format(key, value))
+            else:
+                print("    {:<22} {:>12}".format(key, value))
@@ -0,0 +1,77 @@
+#
+#  New Remote Camera Robot - control channel benchmark
+#
+#  Compares the two ways the browser can send joystick commands to the robot:
+#    * one HTTP POST to /robot per command, (a new connection each time, like the browser)
+#    * one JSON frame per command over the persistent /robot_ws WebSocket
+#
+#  A real Flask server is started on localhost using the simulated GoPiGo3,
+#  and each command is sent and acknowledged before the next one is sent.
+#
+#  Usage:  python3 benchmarks/bench_control_channel.py [--commands N] [--json]
+#  The WebSocket half needs the flask-sock package.
+
+import argparse
+import http.client
+import json
+from urllib.parse import urlencode
+
+from bench_common import (driving_session, load_robot_module, quiet, report,
+                          summarize, time_calls)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark the /robot POST and /robot_ws WebSocket paths")
+    parser.add_argument("--commands", type = int, default = 1000, help = "commands per path")
+    parser.add_argument("--spi-cost", type = float, default = 0.0004,
+                        help = "simulated seconds per SPI call")
+    parser.add_argument("--json", action = "store_true", help = "machine-readable output")
+    options = parser.parse_args()
+
+    robot_module = load_robot_module(spi_call_cost = options.spi_cost)
+    webserver = robot_module.WebServerThread(robot_module.app, "127.0.0.1", 0)
+    webserver.daemon = True
+    webserver.start()
+    port = webserver.srv.server_port
+    commands = driving_session(options.commands)
+    results = {}
+
+    def post_command(command):
+        connection = http.client.HTTPConnection("127.0.0.1", port)
+        connection.request("POST", "/robot?" + urlencode(command))
+        connection.getresponse().read()
+        connection.close()
+
+    with quiet():
+        latencies, elapsed = time_calls(post_command, commands)
+    results["HTTP POST /robot"] = summarize(latencies)
+    results["HTTP POST /robot"]["commands_per_sec"] = len(commands) / elapsed
+
+    if robot_module.sock is None:
+        print("flask-sock is not installed, skipping the WebSocket benchmark")
+    else:
+        import simple_websocket
+        ws = simple_websocket.Client("ws://127.0.0.1:{}/robot_ws".format(port))
+        frames = []
+        for seq, command in enumerate(commands, 1):
+            frame = dict(command)
+            frame["seq"] = seq
+            frames.append(json.dumps(frame))
+
+        def send_frame(frame):
+            ws.send(frame)
+            ws.receive()
+
+        with quiet():
+            latencies, elapsed = time_calls(send_frame, frames)
+        ws.close()
+        results["WebSocket /robot_ws"] = summarize(latencies)
+        results["WebSocket /robot_ws"]["commands_per_sec"] = len(commands) / elapsed
+
+    webserver.shutdown()
+    report("Control channel latency (simulated GoPiGo3, {} s/SPI call)".format(options.spi_cost),
+           results, options.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+#
+#  New Remote Camera Robot - control load benchmark
+#
+#  Sends joystick commands to a real Flask server, (simulated GoPiGo3), at a fixed rate from
+#  each of several clients, optionally while viewers are watching the video stream, (synthetic
+#  frames, see robot_camera.py), served from the same process, and measures:
+#    * latency, from the time each command was due to be sent to its response arriving,
+#      (so a server that falls behind is charged for the commands waiting to be sent)
+#    * service time, from sending a command to its response arriving
+#    * the commands per second actually handled, and whether that kept up with the rate asked for
+#    * CPU time used by the server process
+#  For each transport, "sustainable_cps" is the highest rate that was kept up with, (95% of the
+#  commands asked for were handled in time).  A rate of 0 sends as fast as the responses come back,
+#  which gives "max_cps".
+#
+#  Each client, and the stream viewers, run in their own process, so that their work doesn't
+#  compete with the server for the GIL.  The clients send the commands of a driving session,
+#  (see bench_common.py), one HTTP request per command, like the browser.
+#
+#  Transports:
+#    * post      - the query string POST to /robot
+#    * binary    - the packed binary POST to /robot, (see robot_control_payload.py)
+#    * websocket - JSON frames over /robot_ws, (needs flask-sock)
+#
+#  Usage:  python3 benchmarks/bench_control_load.py [--rates 20,50,100,0] [--clients 1]
+#                  [--stream-clients 0,3] [--transports post] [--seconds S]
+#                  [--spi-cost SECONDS] [--json]
+
+import argparse
+import http.client
+import json
+import logging
+import multiprocessing
+import resource
+import threading
+from time import monotonic, sleep
+from urllib.parse import urlencode
+
+from bench_common import driving_session, load_robot_module, quiet, report, summarize
+from bench_stream_fanout import run_viewers
+from robot_camera import SyntheticFrameSource
+
+#  A rate is "kept up with" if at least this much of it was handled
+SUSTAINED_FRACTION = 0.95
+
+
+#  One client.  Runs in its own process, sending "commands" at "rate" a second,
+#  (0 = as fast as possible), from "start_at", (monotonic()), for "seconds".
+def run_client(port, transport, commands, rate, start_at, seconds, results):
+    from robot_control_payload import PAYLOAD_MIMETYPE, encode_command
+
+    if transport == "binary":
+        requests = [encode_command(command, seq) for seq, command in enumerate(commands, 1)]
+    elif transport == "websocket":
+        import simple_websocket
+        ws = simple_websocket.Client("ws://127.0.0.1:{}/robot_ws".format(port))
+        requests = [json.dumps(dict(command, seq = seq)) for seq, command in enumerate(commands, 1)]
+    else:
+        requests = ["/robot?" + urlencode(command) for command in commands]
+
+    def send(request):
+        if transport == "websocket":
+            ws.send(request)
+            ws.receive()
+            return
+        connection = http.client.HTTPConnection("127.0.0.1", port)
+        try:
+            if transport == "binary":
+                connection.request("POST", "/robot", request, {"Content-Type": PAYLOAD_MIMETYPE})
+            else:
+                connection.request("POST", request)
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                raise http.client.HTTPException("status {}".format(response.status))
+        finally:
+            connection.close()
+
+    latencies = []
+    service_times = []
+    errors = 0
+    sent = 0
+    sleep(max(0.0, start_at - monotonic()))
+    end = start_at + seconds
+    while True:
+        due = start_at + sent / rate if rate else monotonic()
+        if due >= end or monotonic() >= end:
+            break
+        now = monotonic()
+        if due > now:
+            sleep(due - now)
+        started = monotonic()
+        try:
+            send(requests[sent % len(requests)])
+        except (OSError, http.client.HTTPException):
+            errors += 1
+        finished = monotonic()
+        latencies.append(finished - due)
+        service_times.append(finished - started)
+        sent += 1
+    if transport == "websocket":
+        ws.close()
+    results.put((latencies, service_times, errors))
+
+
+#  The stream server, with synthetic frames, in this process.  Returns a function that stops it.
+def start_stream(robot_module):
+    output = robot_module.StreamingOutput()
+    broadcaster = robot_module.StreamBroadcaster(output)
+    broadcaster.start()
+    output.add_listener(broadcaster.publish)
+    robot_module.broadcaster = broadcaster
+
+    class QuietStreamingHandler(robot_module.StreamingHandler):
+        def log_message(self, format, *args):
+            pass
+
+    stream = robot_module.StreamingServer(("127.0.0.1", 0), QuietStreamingHandler)
+    threading.Thread(target = stream.serve_forever, daemon = True).start()
+    source = SyntheticFrameSource(fps = 30, frame_size = 50000)
+    source.start(output)
+
+    def stop():
+        source.stop()
+        stream.shutdown()
+        stream.server_close()
+        broadcaster.stop()
+
+    return stream.server_port, stop
+
+
+def run(robot_module, port, transport, rate, clients, stream_clients, seconds):
+    stop_stream = None
+    viewers = None
+    viewer_results = multiprocessing.Queue()
+    if stream_clients:
+        stream_port, stop_stream = start_stream(robot_module)
+        viewers = multiprocessing.Process(target = run_viewers,
+                                          args = (stream_port, stream_clients, seconds + 1.0, viewer_results))
+        viewers.start()
+        sleep(0.5)  #  let the viewers connect
+
+    results = multiprocessing.Queue()
+    start_at = monotonic() + 0.5
+    processes = []
+    for i in range(clients):
+        #  every client drives its own session, starting at a different point in it
+        commands = driving_session(400)
+        commands = commands[i * 37 % len(commands):] + commands[:i * 37 % len(commands)]
+        process = multiprocessing.Process(target = run_client,
+                                          args = (port, transport, commands, rate, start_at, seconds, results))
+        process.start()
+        processes.append(process)
+
+    sleep(max(0.0, start_at - monotonic()))
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    client_results = [results.get() for process in processes]
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+    for process in processes:
+        process.join()
+
+    stream_fps = None
+    if viewers is not None:
+        frames = viewer_results.get()
+        viewers.join()
+        stop_stream()
+        stream_fps = sum(viewer[0] for viewer in frames) / float(stream_clients) / (seconds + 1.0)
+
+    latencies = [latency for client in client_results for latency in client[0]]
+    service_times = [service for client in client_results for service in client[1]]
+    result = summarize(latencies)
+    service = summarize(service_times)
+    for key in ("p50_ms", "p99_ms"):
+        result["service_" + key] = service.get(key, 0.0)
+    result["errors"] = sum(client[2] for client in client_results)
+    handled = len(latencies) - result["errors"]
+    result["achieved_cps"] = handled / seconds
+    if rate:
+        result["offered_cps"] = float(rate * clients)
+        result["sustained"] = "yes" if handled >= SUSTAINED_FRACTION * rate * clients * seconds else "no"
+    cpu = (usage_after.ru_utime - usage_before.ru_utime) + (usage_after.ru_stime - usage_before.ru_stime)
+    result["server_cpu_percent"] = cpu / seconds * 100.0
+    if stream_fps is not None:
+        result["stream_fps_per_client"] = stream_fps
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Load test the /robot control endpoint")
+    parser.add_argument("--rates", default = "20,50,100,0",
+                        help = "comma separated commands per second for each client, (0 = as fast as possible)")
+    parser.add_argument("--clients", type = int, default = 1, help = "clients sending commands at once")
+    parser.add_argument("--stream-clients", default = "0,3",
+                        help = "comma separated numbers of video stream viewers to run alongside")
+    parser.add_argument("--transports", default = "post", help = "comma separated: post, binary, websocket")
+    parser.add_argument("--seconds", type = float, default = 3.0, help = "seconds per run")
+    parser.add_argument("--spi-cost", type = float, default = 0.0004,
+                        help = "simulated seconds per SPI call")
+    parser.add_argument("--json", action = "store_true", help = "machine-readable output")
+    options = parser.parse_args()
+
+    robot_module = load_robot_module(spi_call_cost = options.spi_cost)
+    logging.getLogger().setLevel(logging.ERROR)  #  every viewer leaving is logged as a warning
+    transports = options.transports.split(",")
+    if "websocket" in transports and robot_module.sock is None:
+        print("flask-sock is not installed, skipping the WebSocket transport")
+        transports.remove("websocket")
+
+    webserver = robot_module.WebServerThread(robot_module.app, "127.0.0.1", 0)
+    webserver.daemon = True
+    webserver.start()
+    port = webserver.srv.server_port
+
+    results = {}
+    with quiet():
+        for transport in transports:
+            for stream_clients in [int(count) for count in options.stream_clients.split(",")]:
+                summary = {"sustainable_cps": 0.0}
+                for rate in [float(rate) for rate in options.rates.split(",")]:
+                    name = "{}, {} clients at {}, {} stream viewers".format(
+                        transport, options.clients, "{:g}/s".format(rate) if rate else "max", stream_clients)
+                    result = run(robot_module, port, transport, rate, options.clients, stream_clients, options.seconds)
+                    results[name] = result
+                    if not rate:
+                        summary["max_cps"] = result["achieved_cps"]
+                    elif result["sustained"] == "yes":
+                        summary["sustainable_cps"] = max(summary["sustainable_cps"], result["achieved_cps"])
+                results["{}, {} stream viewers".format(transport, stream_clients)] = summary
+    webserver.shutdown()
+
+    report("Control load, {} clients, (simulated GoPiGo3, {} s/SPI call)".format(options.clients, options.spi_cost),
+           results, options.json)
+
+
+if __name__ == "__main__":
+    main()
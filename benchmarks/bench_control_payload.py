@@ -0,0 +1,96 @@
+#
+#  New Remote Camera Robot - control payload benchmark
+#
+#  Compares the three ways a joystick command can be encoded:
+#    * query string  - what $.param builds for the POST to /robot
+#    * JSON          - the WebSocket frame, (the same fields plus "seq")
+#    * packed binary - robot_control_payload.py, 22 bytes
+#  and measures, for the commands of a driving session:
+#    * bytes on the wire for the command itself, and for the whole HTTP request line and
+#      headers that differ between the query string and binary POSTs
+#    * time to parse a command into the numbers process_robot_commands uses
+#    * time for the whole /robot route, (Flask test client, simulated GoPiGo3)
+#
+#  Usage:  python3 benchmarks/bench_control_payload.py [--commands N] [--json]
+
+import argparse
+import json
+from time import perf_counter
+from urllib.parse import parse_qsl, urlencode
+
+from bench_common import driving_session, load_robot_module, quiet, report, time_calls, summarize
+
+
+#  The conversions process_robot_commands does on every command
+def convert(args):
+    return (str(args["controller_status"]), str(args["motion_state"]), str(args["angle_dir"]),
+            int(args["time_stamp"]), float(args["x_axis"]), float(args["y_axis"]),
+            float(args["head_x_axis"]), float(args["head_y_axis"]), float(args["force"]),
+            int(args["trigger_1"]), int(args["trigger_2"]), int(args["head_enable"]))
+
+
+def parse_time_ns(parse, encoded, repeat = 20):
+    start = perf_counter()
+    for i in range(repeat):
+        for item in encoded:
+            convert(parse(item))
+    return (perf_counter() - start) / (repeat * len(encoded)) * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark the control payload encodings")
+    parser.add_argument("--commands", type = int, default = 1000, help = "commands in the session")
+    parser.add_argument("--json", action = "store_true", help = "machine-readable output")
+    options = parser.parse_args()
+
+    robot_module = load_robot_module(spi_call_cost = 0)
+    from werkzeug.datastructures import MultiDict
+    from robot_control_payload import PAYLOAD_MIMETYPE, decode_command, encode_command
+
+    #  The browser sends the full time_stamp, (milliseconds since the page was loaded).
+    commands = driving_session(options.commands)
+    for i, command in enumerate(commands):
+        command["time_stamp"] = str(1234567 + i * 16)
+
+    query_strings = [urlencode(command) for command in commands]
+    json_frames = [json.dumps(dict(command, seq = seq)) for seq, command in enumerate(commands, 1)]
+    payloads = [encode_command(command, seq) for seq, command in enumerate(commands, 1)]
+
+    #  The parts of the HTTP request that differ between the two POSTs
+    def post_overhead(path, body = b"", content_type = None):
+        request = "POST {} HTTP/1.1\r\n".format(path)
+        if content_type:
+            request += "Content-Type: {}\r\nContent-Length: {}\r\n".format(content_type, len(body))
+        return len(request) + len(body)
+
+    results = {
+        "query string": {
+            "command_bytes": sum(len(q) for q in query_strings) / len(commands),
+            "request_bytes": sum(post_overhead("/robot?" + q) for q in query_strings) / len(commands),
+            "parse_ns": parse_time_ns(lambda q: MultiDict(parse_qsl(q)), query_strings),
+        },
+        "JSON frame": {
+            "command_bytes": sum(len(f) for f in json_frames) / len(commands),
+            "parse_ns": parse_time_ns(json.loads, json_frames),
+        },
+        "packed binary": {
+            "command_bytes": float(len(payloads[0])),
+            "request_bytes": sum(post_overhead("/robot", p, PAYLOAD_MIMETYPE) for p in payloads) / len(commands),
+            "parse_ns": parse_time_ns(decode_command, payloads),
+        },
+    }
+
+    #  The whole /robot route
+    client = robot_module.app.test_client()
+    with quiet():
+        latencies, elapsed = time_calls(lambda q: client.post("/robot?" + q), query_strings)
+        results["query string"].update(route_mean_ms = summarize(latencies)["mean_ms"])
+        latencies, elapsed = time_calls(
+            lambda p: client.post("/robot", data = p, content_type = PAYLOAD_MIMETYPE), payloads)
+        results["packed binary"].update(route_mean_ms = summarize(latencies)["mean_ms"])
+
+    report("Control payload encodings, {} commands".format(len(commands)), results, options.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#
+#  New Remote Camera Robot - metrics overhead benchmark
+#
+#  The metrics in robot_metrics.py are updated on the hot path, (every command, every
+#  SPI call, every frame sent), so they have to be cheap.  This measures:
+#    * nanoseconds per Histogram.observe(), Counter.inc() and Gauge.set()
+#    * the same observe() with 4 threads updating one histogram, (lock contention)
+#    * how long rendering /metrics takes with all of the robot's metrics registered
+#
+#  Usage:  python3 benchmarks/bench_metrics.py [--calls N] [--json]
+
+import argparse
+import threading
+from time import perf_counter
+
+from bench_common import load_robot_module, report
+
+
+def per_call_ns(function, calls):
+    start = perf_counter()
+    for i in range(calls):
+        function(0.0004)
+    return (perf_counter() - start) / calls * 1e9
+
+
+def threaded_ns(function, calls, threads):
+    workers = [threading.Thread(target = per_call_ns, args = (function, calls)) for i in range(threads)]
+    start = perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return (perf_counter() - start) / (calls * threads) * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark metric updates")
+    parser.add_argument("--calls", type = int, default = 200000, help = "updates per measurement")
+    parser.add_argument("--json", action = "store_true", help = "machine-readable output")
+    options = parser.parse_args()
+
+    robot_module = load_robot_module(spi_call_cost = 0)
+    import robot_metrics
+    registry = robot_metrics.MetricsRegistry()
+    histogram = registry.histogram("bench_seconds", "benchmark histogram")
+    counter = registry.counter("bench_total", "benchmark counter")
+    gauge = registry.gauge("bench_value", "benchmark gauge")
+
+    results = {
+        "baseline (empty call)": {"ns_per_call": per_call_ns(lambda value: None, options.calls)},
+        "Histogram.observe": {"ns_per_call": per_call_ns(histogram.observe, options.calls)},
+        "Counter.inc": {"ns_per_call": per_call_ns(counter.inc, options.calls)},
+        "Gauge.set": {"ns_per_call": per_call_ns(gauge.set, options.calls)},
+        "Histogram.observe, 4 threads": {"ns_per_call": threaded_ns(histogram.observe, options.calls // 4, 4)},
+    }
+
+    renders = 200
+    start = perf_counter()
+    for i in range(renders):
+        text = robot_module.metrics.render()
+    results["render /metrics"] = {
+        "us_per_render": (perf_counter() - start) / renders * 1e6,
+        "bytes": len(text),
+    }
+
+    report("Metric update cost, {} calls".format(options.calls), results, options.json)
+
+
+if __name__ == "__main__":
+    main()
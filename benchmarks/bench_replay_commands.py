@@ -0,0 +1,119 @@
+#
+#  New Remote Camera Robot - command log replay
+#
+#  Replays a command log, (recorded with ROBOT_COMMAND_LOG=file, see robot_command_log.py),
+#  through process_robot_commands on the simulated robot and measures:
+#    * commands per second, (as fast as possible), or how late each command was handled
+#      compared to when it was recorded, (--realtime)
+#    * latency of each process_robot_commands call
+#    * motor writes issued and suppressed, and SPI calls made
+#  With the same log and the same code, the motor writes are the same every run, so a
+#  change in behaviour shows up as well as a change in speed.
+#
+#  Without a log, --synthetic N records the standard driving session, (repeated to N commands),
+#  to a temporary file first.  --route sends each command through the /robot route instead.
+#
+#  Usage:  python3 benchmarks/bench_replay_commands.py [LOG] [--synthetic N] [--realtime]
+#                  [--max-gap S] [--route] [--json]
+
+import argparse
+import os
+import tempfile
+from time import perf_counter, sleep
+
+from bench_common import driving_session, load_robot_module, quiet, report, summarize
+
+
+def record_synthetic(path, count):
+    from robot_command_log import CommandRecorder
+    session = driving_session()
+    recorder = CommandRecorder(path)
+    for i in range(count):
+        command = dict(session[i % len(session)])
+        command["time_stamp"] = str(1000 + i * 50)
+        recorder.record(command, arrival_time = 1000.0 + i * 0.05)  #  20 commands a second
+    recorder.close()
+
+
+def replay(robot_module, log, realtime, max_gap, use_route):
+    if use_route:
+        client = robot_module.app.test_client()
+        handle = lambda command: client.post("/robot", query_string = command)
+    else:
+        handle = robot_module.process_robot_commands
+
+    latencies = []
+    lateness = []
+    start = perf_counter()
+    replay_time = 0.0  #  where we are in the recording, (with the long gaps shortened)
+    previous_arrival = None
+    with quiet():
+        for arrival_time, command in log:
+            if realtime:
+                if previous_arrival is not None:
+                    replay_time += min(max_gap, max(0.0, arrival_time - previous_arrival))
+                previous_arrival = arrival_time
+                wait = start + replay_time - perf_counter()
+                if wait > 0:
+                    sleep(wait)
+                lateness.append(max(0.0, perf_counter() - start - replay_time))
+            t0 = perf_counter()
+            handle(command)
+            latencies.append(perf_counter() - t0)
+    elapsed = perf_counter() - start
+
+    result = summarize(latencies)
+    result["commands_per_sec"] = len(latencies) / elapsed
+    result["elapsed_sec"] = elapsed
+    if realtime:
+        result["late_p99_ms"] = summarize(lateness)["p99_ms"] if lateness else 0.0
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Replay a recorded driving session")
+    parser.add_argument("log", nargs = "?", help = "command log to replay")
+    parser.add_argument("--synthetic", type = int, default = None,
+                        help = "record this many synthetic commands and replay them")
+    parser.add_argument("--realtime", action = "store_true", help = "replay at the recorded pace")
+    parser.add_argument("--max-gap", type = float, default = 1.0,
+                        help = "longest pause, in seconds, kept from the recording in --realtime")
+    parser.add_argument("--route", action = "store_true", help = "send the commands through the /robot route")
+    parser.add_argument("--spi-cost", type = float, default = None, help = "simulated seconds per SPI call")
+    parser.add_argument("--json", action = "store_true", help = "machine-readable output")
+    options = parser.parse_args()
+    if options.log is None and options.synthetic is None:
+        options.synthetic = 2000
+
+    robot_module = load_robot_module(spi_call_cost = options.spi_cost)
+    from robot_command_log import CommandLog
+
+    path = options.log
+    if options.synthetic:
+        handle, path = tempfile.mkstemp(suffix = ".cmdlog")
+        os.close(handle)
+        os.remove(path)
+        record_synthetic(path, options.synthetic)
+
+    try:
+        with CommandLog(path) as log:
+            robot_module.motors.stop(force = True)
+            robot_module.motors.reset_counters()
+            robot_module.my_gopigo3.reset()
+            result = replay(robot_module, log, options.realtime, options.max_gap, options.route)
+            stats = robot_module.motors.stats()
+            result["motor_writes_issued"] = stats["writes_issued"]
+            result["motor_writes_suppressed"] = stats["writes_suppressed"]
+            result["spi_calls"] = robot_module.my_gopigo3.call_count
+            title = "Replay of {} commands from {}{}".format(
+                len(log), "a synthetic session" if options.synthetic else path,
+                ", real time" if options.realtime else ", as fast as possible")
+    finally:
+        if options.synthetic:
+            os.remove(path)
+
+    report(title, {"route" if options.route else "process_robot_commands": result}, options.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+#
+#  New Remote Camera Robot - command processing benchmark
+#
+#  Measures how fast the robot can handle joystick commands using the simulated GoPiGo3:
+#    * process_robot_commands called directly
+#    * the /robot route, through Flask's test client, (no network)
+#    * move_head, (head movement keypresses), with and without waiting for the head to settle
+#
+#  Usage:  python3 benchmarks/bench_robot_commands.py [--commands N] [--spi-cost SECONDS] [--json]
+
+import argparse
+from urllib.parse import urlencode
+
+from bench_common import (driving_session, load_robot_module, quiet, report,
+                          summarize, time_calls)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark robot command processing")
+    parser.add_argument("--commands", type = int, default = 2000, help = "commands per run")
+    parser.add_argument("--spi-cost", type = float, default = 0.0004,
+                        help = "simulated seconds per SPI call")
+    parser.add_argument("--head-moves", type = int, default = 10, help = "move_head calls")
+    parser.add_argument("--json", action = "store_true", help = "machine-readable output")
+    options = parser.parse_args()
+
+    robot_module = load_robot_module(spi_call_cost = options.spi_cost)
+    backend = robot_module.my_gopigo3
+    commands = driving_session(options.commands)
+    results = {}
+
+    #  process_robot_commands on its own
+    backend.reset()
+    robot_module.motors.reset_counters()
+    with quiet():
+        latencies, elapsed = time_calls(robot_module.process_robot_commands, commands)
+    results["process_robot_commands"] = summarize(latencies)
+    results["process_robot_commands"].update({
+        "commands_per_sec": len(commands) / elapsed,
+        "spi_calls": backend.call_count,
+        "spi_time_ms": backend.spi_time * 1000.0,
+        "motor_writes_issued": robot_module.motors.writes_issued,
+        "motor_writes_suppressed": robot_module.motors.writes_suppressed,
+    })
+
+    #  The complete /robot route, without the network
+    client = robot_module.app.test_client()
+    query_strings = ["/robot?" + urlencode(command) for command in commands]
+    backend.reset()
+    with quiet():
+        latencies, elapsed = time_calls(client.post, query_strings)
+    results["/robot route"] = summarize(latencies)
+    results["/robot route"].update({
+        "commands_per_sec": len(commands) / elapsed,
+        "spi_calls": backend.call_count,
+    })
+
+    #  Head movement.  move_head returns as soon as the target is handed to the
+    #  servo actuator thread, so a burst of moves is coalesced into one movement.
+    positions = [(80 + (i % 3) * 5, 90) for i in range(options.head_moves)]
+    robot_module.head.wait_settled()
+    backend.reset()
+    latencies, elapsed = time_calls(lambda position: robot_module.move_head(*position), positions)
+    robot_module.head.wait_settled()
+    results["move_head (burst)"] = summarize(latencies)
+    results["move_head (burst)"]["spi_calls"] = backend.call_count
+
+    #  Waiting for each movement to finish, the way shake_head does.
+    backend.reset()
+    latencies, elapsed = time_calls(lambda position: robot_module.move_head(*position, wait = True), positions)
+    results["move_head (wait)"] = summarize(latencies)
+    results["move_head (wait)"]["spi_calls"] = backend.call_count
+
+    report("Robot command processing (simulated GoPiGo3, {} s/SPI call)".format(options.spi_cost),
+           results, options.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+#
+#  New Remote Camera Robot - robot state benchmark
+#
+#  Compares the slotted RobotState, (robot_state.py), with the plain dict it replaced:
+#    * reading and writing one value, (robot["x_axis"] vs robot.command.x_axis)
+#    * one command's worth of writes, with and without "with robot.writing():"
+#    * a consistent copy of everything, (dict(robot) vs robot.snapshot())
+#    * snapshot() while another thread is writing as fast as it can
+#
+#  Usage:  python3 benchmarks/bench_robot_state.py [--calls N] [--json]
+
+import argparse
+import threading
+from time import perf_counter
+
+from bench_common import report  #  (this also makes the project directory importable)
+from robot_state import RobotState
+
+
+#  The dict as it was before RobotState
+def make_dict():
+    return {
+        "controller_status": "Disconnected", "motion_state": "Waiting for Joystick", "direction": "None",
+        "time_stamp": 0, "x_axis": 0.00, "y_axis": 0.00, "head_x_axis": 0.00, "head_y_axis": 0.00,
+        "force": 0.00, "trigger_1": 0, "trigger_2": 0, "head_enable": 0, "normal_speed": 150,
+        "turbo_speed": 300, "speed": 0, "desired_speed": 0, "differential_speed": 0, "vcenter": 95,
+        "hcenter": 86, "vposition": 92, "hposition": 88, "reverse_speed_offset": 0.50,
+        "servo_step_size": 5, "command_time": 0.0,
+    }
+
+
+def ns_per_call(function, calls):
+    start = perf_counter()
+    function(calls)
+    return (perf_counter() - start) / calls * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark robot state access")
+    parser.add_argument("--calls", type = int, default = 200000, help = "operations per measurement")
+    parser.add_argument("--json", action = "store_true", help = "machine-readable output")
+    options = parser.parse_args()
+
+    robot_dict = make_dict()
+    robot = RobotState()
+    command = robot.command
+
+    def dict_read(calls):
+        for i in range(calls):
+            robot_dict["x_axis"]
+
+    def state_read(calls):
+        for i in range(calls):
+            robot.command.x_axis
+
+    def dict_write(calls):
+        for i in range(calls):
+            robot_dict["x_axis"] = 0.5
+
+    def state_write(calls):
+        for i in range(calls):
+            command.x_axis = 0.5
+
+    def dict_command(calls):
+        for i in range(calls):
+            robot_dict["x_axis"] = 0.5
+            robot_dict["y_axis"] = -0.5
+            robot_dict["force"] = 0.5
+            robot_dict["trigger_1"] = 1
+
+    def state_command(calls):
+        for i in range(calls):
+            with robot.writing():
+                command.x_axis = 0.5
+                command.y_axis = -0.5
+                command.force = 0.5
+                command.trigger_1 = 1
+
+    def dict_copy(calls):
+        for i in range(calls):
+            dict(robot_dict)
+
+    def state_snapshot(calls):
+        for i in range(calls):
+            robot.snapshot()
+
+    results = {}
+    for name, dict_function, state_function in (
+            ("read one value", dict_read, state_read),
+            ("write one value", dict_write, state_write),
+            ("write a command (4 values)", dict_command, state_command),
+            ("copy everything", dict_copy, state_snapshot)):
+        results[name] = {
+            "dict_ns": ns_per_call(dict_function, options.calls),
+            "robot_state_ns": ns_per_call(state_function, options.calls),
+        }
+
+    #  snapshot() against a busy writer: how long it takes, and that it is never torn
+    stop = threading.Event()
+
+    def writer():
+        value = 0
+        while not stop.is_set():
+            value += 1
+            with robot.writing():
+                command.x_axis = value
+                command.y_axis = -value
+
+    writer_thread = threading.Thread(target = writer, daemon = True)
+    writer_thread.start()
+    torn = 0
+    snapshots = options.calls // 10
+    start = perf_counter()
+    for i in range(snapshots):
+        state = robot.snapshot()
+        if state.command.x_axis != -state.command.y_axis:
+            torn += 1
+    elapsed = perf_counter() - start
+    stop.set()
+    writer_thread.join()
+    results["snapshot with a busy writer"] = {
+        "robot_state_ns": elapsed / snapshots * 1e9,
+        "torn_snapshots": torn,
+    }
+
+    report("Robot state access, {} operations".format(options.calls), results, options.json)
+
+
+if __name__ == "__main__":
+    main()
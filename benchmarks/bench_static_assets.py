@@ -0,0 +1,94 @@
+#
+#  New Remote Camera Robot - static asset benchmark
+#
+#  Loads the control page and everything it pulls in, (the files under static/ that
+#  index.html and New_Remote_Camera_Robot.js ask for), the way a browser does:
+#    * cold        - nothing cached, (first visit)
+#    * revalidate  - every file cached, so each request carries If-None-Match
+#  and compares the robot's routes, (robot_static.py), with the way they used to work:
+#  render_template and send_from_directory on every request, no compression.
+#
+#  Reports the bytes sent, (body only), and the time per page load.
+#
+#  Usage:  python3 benchmarks/bench_static_assets.py [--loads N] [--json]
+
+import argparse
+import os
+import re
+
+from bench_common import PROJECT_DIR, load_robot_module, quiet, report, time_calls, summarize
+
+
+#  The page and the files it loads
+def page_files():
+    with open(os.path.join(PROJECT_DIR, "templates", "index.html")) as index_file:
+        files = re.findall(r'(?:src|href)="(static/[^"]+)"', index_file.read())
+    return ["/"] + ["/" + name for name in files] + ["/static/gamepad_config.json"]
+
+
+#  The page and static routes as they were before the cache
+def uncached_app():
+    from flask import Flask, render_template, send_from_directory
+    app = Flask("uncached", root_path = PROJECT_DIR, static_folder = None)
+
+    @app.route("/")
+    def index():
+        return render_template("index.html")
+
+    @app.route("/static/<path:path>")
+    def send_static(path):
+        return send_from_directory(os.path.join(PROJECT_DIR, "static"), path)
+
+    return app
+
+
+def page_load(client, paths, etags = None):
+    sent = 0
+    for path in paths:
+        headers = {"Accept-Encoding": "gzip, deflate"}
+        if etags is not None and etags.get(path):
+            headers["If-None-Match"] = etags[path]
+        resp = client.get(path, headers = headers)
+        sent += len(resp.get_data())
+        if etags is not None and "ETag" in resp.headers:
+            etags[path] = resp.headers["ETag"]
+        resp.close()
+    return sent
+
+
+def measure(client, paths, loads):
+    etags = {}
+    cold_bytes = page_load(client, paths, etags)
+    latencies, elapsed = time_calls(lambda i: page_load(client, paths), range(loads))
+    cold = summarize(latencies)
+    revalidate_bytes = page_load(client, paths, etags)
+    latencies, elapsed = time_calls(lambda i: page_load(client, paths, dict(etags)), range(loads))
+    revalidate = summarize(latencies)
+    return {
+        "cold_bytes": cold_bytes,
+        "cold_mean_ms": cold["mean_ms"],
+        "revalidate_bytes": revalidate_bytes,
+        "revalidate_mean_ms": revalidate["mean_ms"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark serving the control page and its files")
+    parser.add_argument("--loads", type = int, default = 200, help = "page loads to time")
+    parser.add_argument("--json", action = "store_true", help = "machine-readable output")
+    options = parser.parse_args()
+
+    robot_module = load_robot_module(spi_call_cost = 0)
+    paths = page_files()
+
+    with quiet():
+        results = {
+            "uncached": measure(uncached_app().test_client(), paths, options.loads),
+            "asset cache": measure(robot_module.app.test_client(), paths, options.loads),
+        }
+
+    report("Control page load, {} requests each".format(len(paths)), results, options.json)
+
+
+if __name__ == "__main__":
+    main()
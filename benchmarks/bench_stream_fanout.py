@@ -0,0 +1,253 @@
+#
+#  New Remote Camera Robot - MJPEG fan-out benchmark
+#
+#  Serves a synthetic camera feed on /stream.mjpg to 1, 5 and 20 simulated viewers and measures:
+#    * frames per second received by each viewer, (the mean and the slowest viewer),
+#      and the MB per second received by all of them
+#    * latency from the camera starting to write a frame to a viewer receiving all of it,
+#      (this includes one frame time, a frame is only published when the next one starts),
+#      over all viewers and for the worst viewer
+#    * CPU time used by the server process, and how many threads it needed
+#
+#  Two servers are compared:
+#    * "thread per client" - the original StreamingHandler, (copied below as ThreadPerClientHandler)
+#    * "broadcaster"       - StreamingHandler handing its socket to the StreamBroadcaster
+#
+#  The frames come from a frame source, (see robot_camera.py): SyntheticFrameSource by default,
+#  or --replay FILE to use ReplayFrameSource with a real MJPEG file or video recording,
+#  (latency can only be measured with synthetic frames).
+#  The viewers run in a separate process so their work isn't counted as server CPU time.
+#  Each synthetic frame carries the time it was written, (time.monotonic() is the same
+#  clock in every process on Linux), so the viewers can work out the latency.
+#
+#  With --slow-kbps, one extra viewer reads at only that many kilobytes a second, like a viewer
+#  on marginal Wi-Fi, and its latency is reported separately.  With the broadcaster it should
+#  get fewer frames, but they should stay fresh.  --max-fps asks for /stream.mjpg?fps=N.
+#
+#  Usage:  python3 benchmarks/bench_stream_fanout.py [--clients 1,5,20] [--seconds S]
+#                  [--fps N] [--frame-size BYTES] [--resolution WxH] [--replay FILE]
+#                  [--slow-kbps KB] [--max-fps N] [--json]
+
+import argparse
+import logging
+import multiprocessing
+import resource
+import selectors
+import socket
+import threading
+from http import server
+from time import monotonic, sleep
+
+from bench_common import load_robot_module, report, summarize
+from robot_camera import ReplayFrameSource, SyntheticFrameSource, frame_timestamp
+
+class ThreadPerClientHandler(server.BaseHTTPRequestHandler):
+    '''
+    StreamingHandler as it was before the broadcaster, for comparison.
+    '''
+    def do_GET(self):
+        output = self.server.output
+        self.send_response(200)
+        self.send_header("Age", 0)
+        self.send_header("Cache-Control", "no-cache, private")
+        self.send_header("Pragma", "no-cache")
+        self.send_header("Content-Type", "multipart/x-mixed-replace; boundary=FRAME")
+        self.end_headers()
+        try:
+            while True:
+                with output.condition:
+                    output.condition.wait()
+                    frame = output.frame
+                self.wfile.write(b"--FRAME\r\n")
+                self.send_header("Content-Type", "image/jpeg")
+                self.send_header("Content-Length", len(frame))
+                self.end_headers()
+                self.wfile.write(frame)
+                self.wfile.write(b"\r\n")
+        except Exception:
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+#  The viewers.  Runs in its own process.
+#  If slow_kbps is set, one more viewer is added that only reads that many kilobytes a second.
+#  Latency is only measured if "latency" is set, (the frames carry the time they were written).
+def run_viewers(port, clients, seconds, results, slow_kbps = None, path = "/stream.mjpg", latency = True):
+    selector = selectors.DefaultSelector()
+    viewers = []
+    for i in range(clients + (1 if slow_kbps else 0)):
+        slow = i == clients
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if slow:
+            #  a small receive buffer, so the kernel doesn't hide how far behind the viewer is
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 32768)
+        sock.connect(("127.0.0.1", port))
+        sock.sendall("GET {} HTTP/1.1\r\nHost: localhost\r\n\r\n".format(path).encode("ascii"))
+        sock.setblocking(False)
+        viewer = {"buffer": bytearray(), "headers_done": False, "frames": 0, "bytes": 0, "latencies": [],
+                  "slow": slow, "next_read": 0.0}
+        viewers.append(viewer)
+        selector.register(sock, selectors.EVENT_READ, viewer)
+
+    #  Only count frames published after every viewer is connected
+    start = monotonic()
+    end = start + seconds
+    while monotonic() < end:
+        for key, events in selector.select(timeout = 0.005 if slow_kbps else 0.1):
+            viewer = key.data
+            if viewer["slow"]:
+                if monotonic() < viewer["next_read"]:
+                    continue
+                chunk = 4096
+                viewer["next_read"] = monotonic() + chunk / (slow_kbps * 1024.0)
+            else:
+                chunk = 262144
+            try:
+                data = key.fileobj.recv(chunk)
+            except BlockingIOError:
+                continue
+            if not data:
+                selector.unregister(key.fileobj)
+                continue
+            received = monotonic()
+            buffer = viewer["buffer"]
+            buffer += data
+            if not viewer["headers_done"]:
+                end_of_headers = buffer.find(b"\r\n\r\n")
+                if end_of_headers < 0:
+                    continue
+                del buffer[:end_of_headers + 4]
+                viewer["headers_done"] = True
+            while True:
+                end_of_headers = buffer.find(b"\r\n\r\n")
+                if end_of_headers < 0:
+                    break
+                headers = bytes(buffer[:end_of_headers]).split(b"\r\n")
+                length = [int(h.split(b":")[1]) for h in headers if h.lower().startswith(b"content-length")][0]
+                frame_end = end_of_headers + 4 + length + 2
+                if len(buffer) < frame_end:
+                    break
+                stamp = frame_timestamp(bytes(buffer[end_of_headers + 4:end_of_headers + 4 + 64])) if latency else None
+                if stamp is None:
+                    if received >= start:  #  a replayed frame, no latency
+                        viewer["frames"] += 1
+                        viewer["bytes"] += length
+                elif stamp[1] >= start:
+                    viewer["latencies"].append(received - stamp[1])
+                    viewer["frames"] += 1
+                    viewer["bytes"] += length
+                del buffer[:frame_end]
+
+    for key in list(selector.get_map().values()):
+        key.fileobj.close()
+    results.put([(viewer["frames"], viewer["bytes"], viewer["latencies"], viewer["slow"]) for viewer in viewers])
+
+
+def run(robot_module, handler, use_broadcaster, clients, seconds, source,
+        slow_kbps = None, path = "/stream.mjpg"):
+    output = robot_module.StreamingOutput()
+    broadcaster = None
+    if use_broadcaster:
+        broadcaster = robot_module.StreamBroadcaster(output)
+        broadcaster.start()
+        output.add_listener(broadcaster.publish)
+        robot_module.broadcaster = broadcaster
+    stream = robot_module.StreamingServer(("127.0.0.1", 0), handler)
+    stream.output = output
+    server_thread = threading.Thread(target = stream.serve_forever, daemon = True)
+    server_thread.start()
+
+    source.start(output)
+
+    results = multiprocessing.Queue()
+    viewers = multiprocessing.Process(target = run_viewers,
+                                      args = (stream.server_port, clients, seconds, results, slow_kbps, path,
+                                              isinstance(source, SyntheticFrameSource)))
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    viewers.start()
+    peak_threads = 0
+    while viewers.is_alive() and results.empty():
+        peak_threads = max(peak_threads, threading.active_count())
+        sleep(0.05)
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+    viewer_results = results.get()
+    viewers.join()
+
+    source.stop()
+    stream.shutdown()
+    stream.server_close()
+    if broadcaster is not None:
+        broadcaster.stop()
+
+    cpu = (usage_after.ru_utime - usage_before.ru_utime) + (usage_after.ru_stime - usage_before.ru_stime)
+    normal = [viewer for viewer in viewer_results if not viewer[3]]
+    latencies = [latency for frames, received, viewer_latencies, slow in normal for latency in viewer_latencies]
+    result = summarize(latencies)
+    result["count"] = sum(frames for frames, received, viewer_latencies, slow in normal)
+    result["fps_per_client"] = result["count"] / float(clients) / seconds
+    result["slowest_client_fps"] = min(frames for frames, received, viewer_latencies, slow in normal) / seconds
+    result["received_mb_per_second"] = sum(received for frames, received, viewer_latencies, slow in normal) / seconds / 1e6
+    if latencies:
+        per_client = [summarize(viewer_latencies) for frames, received, viewer_latencies, slow in normal if viewer_latencies]
+        result["worst_client_p50_ms"] = max(client["p50_ms"] for client in per_client)
+        result["worst_client_p95_ms"] = max(client["p95_ms"] for client in per_client)
+    result["server_cpu_percent"] = cpu / seconds * 100.0
+    result["server_threads"] = peak_threads
+    for frames, received, viewer_latencies, slow in viewer_results:
+        if slow:
+            slow_result = summarize(viewer_latencies)
+            result["slow_viewer_fps"] = frames / seconds
+            result["slow_viewer_p50_ms"] = slow_result.get("p50_ms", 0.0)
+            result["slow_viewer_max_ms"] = slow_result.get("max_ms", 0.0)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark MJPEG stream fan-out")
+    parser.add_argument("--clients", default = "1,5,20", help = "comma separated viewer counts")
+    parser.add_argument("--seconds", type = float, default = 5.0, help = "seconds per run")
+    parser.add_argument("--fps", type = int, default = 30, help = "frames per second from the camera")
+    parser.add_argument("--frame-size", type = int, default = 50000, help = "bytes per frame")
+    parser.add_argument("--resolution", default = "800x600", help = "size of the synthetic frames")
+    parser.add_argument("--replay", help = "MJPEG file or video recording to send instead of synthetic frames")
+    parser.add_argument("--slow-kbps", type = float, default = None,
+                        help = "add one viewer that reads this many KB/s")
+    parser.add_argument("--max-fps", type = float, default = None,
+                        help = "viewers ask the broadcaster for at most this many frames a second")
+    parser.add_argument("--json", action = "store_true", help = "machine-readable output")
+    options = parser.parse_args()
+
+    path = "/stream.mjpg"
+    if options.max_fps:
+        path += "?fps={}".format(options.max_fps)
+
+    robot_module = load_robot_module(spi_call_cost = 0)
+    logging.getLogger().setLevel(logging.ERROR)  #  every viewer leaving is logged as a warning
+
+    def make_source():
+        if options.replay:
+            return ReplayFrameSource(options.replay, options.fps)
+        return SyntheticFrameSource(options.resolution, options.fps, options.frame_size)
+
+    class QuietStreamingHandler(robot_module.StreamingHandler):
+        def log_message(self, format, *args):
+            pass
+
+    results = {}
+    for clients in [int(count) for count in options.clients.split(",")]:
+        results["thread per client, {} clients".format(clients)] = run(
+            robot_module, ThreadPerClientHandler, False, clients, options.seconds, make_source(),
+            options.slow_kbps)
+        results["broadcaster, {} clients".format(clients)] = run(
+            robot_module, QuietStreamingHandler, True, clients, options.seconds, make_source(),
+            options.slow_kbps, path)
+
+    frames = options.replay or "{} byte frames".format(options.frame_size)
+    report("MJPEG fan-out, {} fps, {}, latency is camera write to fully received".format(
+           options.fps, frames), results, options.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+#
+#  New Remote Camera Robot - StreamingOutput benchmark
+#
+#  Compares the frame ring in StreamingOutput with the original BytesIO version,
+#  (copied below as BytesIOStreamingOutput), by writing synthetic JPEG frames to each:
+#    * frames per second and MB per second through write()
+#    * peak memory allocated while writing, (measured with tracemalloc)
+#    * the same, with a reader taking each published frame, the way StreamingHandler does
+#
+#  Usage:  python3 benchmarks/bench_streaming_output.py [--frames N] [--frame-size BYTES] [--json]
+
+import argparse
+import io
+import os
+import tracemalloc
+from threading import Condition
+from time import perf_counter
+
+from bench_common import load_robot_module, report
+
+
+class BytesIOStreamingOutput(object):
+    '''
+    StreamingOutput as it was before the frame ring, for comparison.
+    '''
+    def __init__(self):
+        self.frame = None
+        self.buffer = io.BytesIO()
+        self.condition = Condition()
+
+    def write(self, buf):
+        if buf.startswith(b"\xff\xd8"):
+            self.buffer.truncate()
+            with self.condition:
+                self.frame = self.buffer.getvalue()
+                self.condition.notify_all()
+            self.buffer.seek(0)
+        return self.buffer.write(buf)
+
+
+#  Synthetic JPEG frames: the SOI marker, some noise, and the EOI marker.
+#  A few different frames, with slightly different sizes, like a real camera.
+def make_frames(frame_size, count = 8):
+    frames = []
+    for i in range(count):
+        size = frame_size + (i - count // 2) * frame_size // 50
+        frames.append(b"\xff\xd8" + os.urandom(size - 4) + b"\xff\xd9")
+    return frames
+
+
+def write_frames(output, frames, count, read_frames):
+    sink = 0
+    for i in range(count):
+        output.write(frames[i % len(frames)])
+        if read_frames:
+            frame = output.frame
+            if frame is not None:
+                sink += len(frame)
+    return sink
+
+
+#  Timing and memory are measured in separate passes, tracemalloc slows down every allocation.
+def run(make_output, frames, count, read_frames):
+    output = make_output()
+    start = perf_counter()
+    write_frames(output, frames, count, read_frames)
+    elapsed = perf_counter() - start
+
+    output = make_output()
+    write_frames(output, frames, len(frames), read_frames)  #  warm up, (first use of every slot)
+    tracemalloc.start()
+    start_memory = tracemalloc.get_traced_memory()[0]
+    write_frames(output, frames, count, read_frames)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "frames_per_sec": count / elapsed,
+        "mb_per_sec": count * len(frames[0]) / elapsed / 1e6,
+        "peak_allocated_kb": (peak - start_memory) / 1024.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark StreamingOutput")
+    parser.add_argument("--frames", type = int, default = 3000, help = "frames to write")
+    parser.add_argument("--frame-size", type = int, default = 60000, help = "bytes per frame")
+    parser.add_argument("--json", action = "store_true", help = "machine-readable output")
+    options = parser.parse_args()
+
+    robot_module = load_robot_module(spi_call_cost = 0)
+    frames = make_frames(options.frame_size)
+    results = {}
+    for read_frames in (False, True):
+        suffix = " + reader" if read_frames else ""
+        results["BytesIO" + suffix] = run(BytesIOStreamingOutput, frames, options.frames, read_frames)
+        results["frame ring" + suffix] = run(robot_module.StreamingOutput, frames, options.frames, read_frames)
+
+    report("StreamingOutput, {} frames of ~{} bytes".format(options.frames, options.frame_size),
+           results, options.json)
+
+
+if __name__ == "__main__":
+    main()
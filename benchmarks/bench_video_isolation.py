@@ -0,0 +1,124 @@
+#
+#  New Remote Camera Robot - video isolation benchmark
+#
+#  How much does the video hold up the driving?  A client sends joystick commands at a fixed rate
+#  to a real Flask server, (simulated GoPiGo3), with the drive control loop running, while viewers
+#  watch the video stream, (synthetic frames, see robot_camera.py).  For each mode it measures:
+#    * command latency, (p50/p95/p99), and its jitter, (p99 - p50)
+#    * the drive control loop's period, (p50/p99), and its worst and mean jitter
+#    * the frames per second each viewer received
+#
+#  Modes:
+#    * none       - no video at all, the baseline
+#    * in-process - the camera and the stream server in the same process as the driving
+#    * isolated   - the camera and the stream server in the video process, (ROBOT_VIDEO_PROCESS=1,
+#                   see robot_video_process.py)
+#
+#  Usage:  python3 benchmarks/bench_video_isolation.py [--modes none,in-process,isolated]
+#                  [--stream-clients 6] [--rate 50] [--seconds S] [--fps 30]
+#                  [--frame-size BYTES] [--spi-cost SECONDS] [--json]
+
+import argparse
+import logging
+import multiprocessing
+import os
+import socket
+from time import monotonic, sleep
+
+from bench_common import driving_session, load_robot_module, quiet, report, summarize
+from bench_control_load import run_client
+from bench_stream_fanout import run_viewers
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+#  Start the video for "mode".  Returns a function that stops it.
+def start_video(robot_module, mode, port):
+    if mode == "in-process":
+        robot_module.start_video_output()
+        robot_module.start_camera()
+        robot_module.start_stream_server(port)
+        return robot_module.shutdown_video
+    robot_module.start_video_process(port)
+    return robot_module.video_process.stop
+
+
+def run(robot_module, web_port, mode, stream_clients, rate, seconds):
+    stop_video = None
+    viewers = None
+    viewer_results = multiprocessing.Queue()
+    if mode != "none":
+        stream_port = free_port()
+        stop_video = start_video(robot_module, mode, stream_port)
+        viewers = multiprocessing.Process(target = run_viewers,
+                                          args = (stream_port, stream_clients, seconds + 1.0, viewer_results))
+        viewers.start()
+        sleep(0.5)  #  let the viewers connect
+
+    robot_module.start_control_loop()
+    results = multiprocessing.Queue()
+    start_at = monotonic() + 0.5
+    client = multiprocessing.Process(target = run_client,
+                                     args = (web_port, "post", driving_session(400), rate, start_at, seconds, results))
+    client.start()
+    latencies, service_times, errors = results.get()
+    client.join()
+    robot_module.control_loop.stop()
+    loop = robot_module.control_loop.stats()
+
+    result = summarize(latencies)
+    result["jitter_ms"] = result.get("p99_ms", 0.0) - result.get("p50_ms", 0.0)
+    result["errors"] = errors
+    for key in ("p50_period_ms", "p99_period_ms", "max_jitter_ms", "mean_jitter_ms", "overruns"):
+        result["loop_" + key] = loop.get(key, 0.0)
+    if viewers is not None:
+        frames = viewer_results.get()
+        viewers.join()
+        stop_video()
+        result["stream_fps_per_client"] = sum(viewer[0] for viewer in frames) / float(stream_clients) / (seconds + 1.0)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark the driving's jitter with the video in and out of process")
+    parser.add_argument("--modes", default = "none,in-process,isolated",
+                        help = "comma separated: none, in-process, isolated")
+    parser.add_argument("--stream-clients", type = int, default = 6, help = "video stream viewers")
+    parser.add_argument("--rate", type = float, default = 50, help = "commands per second")
+    parser.add_argument("--seconds", type = float, default = 5.0, help = "seconds per mode")
+    parser.add_argument("--fps", type = float, default = 30, help = "camera frame rate")
+    parser.add_argument("--frame-size", type = int, default = 60000, help = "bytes per frame")
+    parser.add_argument("--spi-cost", type = float, default = 0.0004,
+                        help = "simulated seconds per SPI call")
+    parser.add_argument("--json", action = "store_true", help = "machine-readable output")
+    options = parser.parse_args()
+
+    #  The video process reads these when it starts its camera
+    os.environ["ROBOT_CAMERA"] = "synthetic"
+    os.environ["ROBOT_CAMERA_FPS"] = str(options.fps)
+    os.environ["ROBOT_CAMERA_FRAME_SIZE"] = str(options.frame_size)
+    robot_module = load_robot_module(spi_call_cost = options.spi_cost)
+    logging.getLogger().setLevel(logging.ERROR)  #  every viewer leaving is logged as a warning
+
+    webserver = robot_module.WebServerThread(robot_module.app, "127.0.0.1", 0)
+    webserver.daemon = True
+    webserver.start()
+
+    results = {}
+    with quiet():
+        for mode in options.modes.split(","):
+            name = "{}, {} stream viewers".format(mode, options.stream_clients if mode != "none" else 0)
+            results[name] = run(robot_module, webserver.srv.server_port, mode,
+                                options.stream_clients, options.rate, options.seconds)
+    webserver.shutdown()
+
+    report("Video isolation, {:g} commands/s, {:g} fps of {} bytes, (simulated GoPiGo3, {} s/SPI call)".format(
+           options.rate, options.fps, options.frame_size, options.spi_cost), results, options.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+#
+#  New Remote Camera Robot - video recorder benchmark
+#
+#  Writes synthetic JPEG frames through StreamingOutput, with and without a VideoRecorder
+#  listening, (see robot_video_recorder.py), and measures:
+#    * the time StreamingOutput.write takes per frame, (the camera thread), in each case
+#    * the frames recorded and dropped, and the MB per second the recorder wrote
+#    * the time to open every recorded segment and find a frame by time, (playback)
+#
+#  The segments go in a temporary directory, (--directory to use somewhere else, e.g. the SD card).
+#
+#  Usage:  python3 benchmarks/bench_video_recorder.py [--frames N] [--frame-size BYTES]
+#                                                     [--fps N] [--directory DIR] [--json]
+
+import argparse
+import os
+import shutil
+import tempfile
+from time import perf_counter, sleep
+
+from bench_common import load_robot_module, report, summarize, time_calls
+from bench_streaming_output import make_frames
+
+
+def write_frames(output, frames, count, fps):
+    latencies = []
+    interval = 1.0 / fps if fps else 0.0
+    for i in range(count):
+        t0 = perf_counter()
+        output.write(frames[i % len(frames)])
+        latencies.append(perf_counter() - t0)
+        if interval:
+            sleep(interval)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark the video recorder")
+    parser.add_argument("--frames", type = int, default = 300, help = "frames to write")
+    parser.add_argument("--frame-size", type = int, default = 60000, help = "bytes per frame")
+    parser.add_argument("--fps", type = float, default = 30, help = "camera frame rate, (0 = as fast as possible)")
+    parser.add_argument("--directory", help = "where to put the segments")
+    parser.add_argument("--json", action = "store_true", help = "machine-readable output")
+    options = parser.parse_args()
+
+    robot_module = load_robot_module(spi_call_cost = 0)
+    from robot_video_recorder import VideoArchive, VideoRecorder
+
+    frames = make_frames(options.frame_size)
+    directory = options.directory or tempfile.mkdtemp(prefix = "bench_video_")
+    results = {}
+    try:
+        output = robot_module.StreamingOutput()
+        latencies = write_frames(output, frames, options.frames, options.fps)
+        results["not recording"] = {"write_" + key: value for key, value in summarize(latencies).items()}
+
+        output = robot_module.StreamingOutput()
+        recorder = VideoRecorder(directory, segment_seconds = 5)
+        recorder.start()
+        output.add_listener(recorder.publish)
+        start = perf_counter()
+        latencies = write_frames(output, frames, options.frames, options.fps)
+        recorder.stop(timeout = 60)
+        elapsed = perf_counter() - start
+        recorded_bytes = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+        results["recording"] = {"write_" + key: value for key, value in summarize(latencies).items()}
+        results["recording"].update(
+            frames_recorded = recorder.frames_recorded,
+            frames_dropped = recorder.frames_dropped,
+            recorded_mb_per_second = recorded_bytes / elapsed / 1e6,
+        )
+
+        archive = VideoArchive(directory)
+        segments = archive.describe()
+        times = [segment["start"] + (segment["end"] - segment["start"]) / 2 for segment in segments] * 20
+        latencies, elapsed = time_calls(archive.frame_at, times)
+        results["playback"] = {"segments": len(segments)}
+        results["playback"].update({"frame_at_" + key: value for key, value in summarize(latencies).items()})
+    finally:
+        if options.directory is None:
+            shutil.rmtree(directory)
+
+    report("Video recorder, {} frames of {} bytes".format(options.frames, options.frame_size), results, options.json)
+
+
+if __name__ == "__main__":
+    main()
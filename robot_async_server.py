@@ -0,0 +1,394 @@
+#
+#  New Remote Camera Robot - asyncio server
+#
+#  The robot normally runs two thread-per-connection servers: werkzeug for the page, the static
+#  files and /robot, (port 5000), and StreamingServer for the video, (port 5002, which nginx
+#  serves on 5001).  Every connection, (including every browser's keep-alive connections and
+#  /telemetry stream), costs a thread, and on a Pi Zero or Pi 3 those add up.
+#
+#  With ROBOT_ASYNC_SERVER=1, AsyncRobotServer serves all of it on the web server's port from one
+#  thread running an asyncio event loop:
+#    * the page and the static files, straight from their caches, (see robot_static.py)
+#    * /stream.mjpg and /stream_stats.json, from the camera's StreamingOutput
+#    * /telemetry, from the TelemetryPublisher
+#    * everything else, (/robot, /robot/lease, /ready, /metrics, ...), is passed to the Flask app,
+#      in a small pool of worker threads, so the hardware calls /robot makes never block the loop
+#
+#  Like the StreamBroadcaster, a viewer that can't keep up with the camera skips frames: a new
+#  frame is only started once the last one has been completely handed to the kernel.
+#
+#  Not served in this mode: the /robot_ws WebSocket, (the browser falls back to POSTing to
+#  /robot), and /snapshot.jpg and the recordings, (which need the threaded stream server).
+#  Only HTTP/1.0 and 1.1, without chunked request bodies, is understood.  That's all a browser,
+#  (or nginx in front of the robot), needs here.
+
+import asyncio
+import io
+import json
+import logging
+import socket
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from threading import Thread
+from time import monotonic
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from robot_metrics import registry
+from robot_stream_broadcaster import PART_TRAILER, part_header, send_seconds, frames_dropped_total, clients_gauge
+from robot_telemetry import sse_event
+
+request_seconds = {
+    route: registry.histogram("robot_async_request_seconds", "Time taken to answer each request to the asyncio server",
+                              labels = {"route": route})
+    for route in ("static", "page", "app")
+}
+connections_gauge = registry.gauge("robot_async_connections", "Open connections to the asyncio server")
+
+KEEPALIVE_TIMEOUT = 60.0  #  seconds an idle keep-alive connection is kept open
+MAX_HEADER_BYTES = 65536
+MAX_BODY_BYTES = 4096  #  a command is 22 bytes packed, and well under 1 KB as a query string
+TELEMETRY_POLL_INTERVAL = 0.05  #  seconds between checks for telemetry changes
+
+
+def status_line(code):
+    return "{} {}".format(code, HTTPStatus(code).phrase)
+
+
+class HTTPRequest(object):
+    '''
+    One parsed request.  Header names are lower case.
+    '''
+    __slots__ = ("method", "target", "path", "query", "version", "headers", "body")
+
+    def __init__(self, method, target, version, headers, body = b""):
+        self.method = method
+        self.target = target
+        url = urlsplit(target)
+        self.path = unquote(url.path)
+        self.query = url.query
+        self.version = version
+        self.headers = headers
+        self.body = body
+
+    def keep_alive(self):
+        connection = self.headers.get("connection", "").lower()
+        if self.version == "HTTP/1.0":
+            return connection == "keep-alive"
+        return connection != "close"
+
+
+class AsyncRobotServer(Thread):
+    '''
+    The page, static files, /robot, the video stream and telemetry on one port, from one event loop.
+    app        - the Flask app, for every request not answered directly
+    output     - the camera's StreamingOutput, (None: no /stream.mjpg)
+    static_assets and pages - the StaticAssetCaches for /static/... and the rendered pages
+    telemetry  - the TelemetryPublisher for /telemetry
+    workers    - threads for the Flask app
+    It has the same start(), shutdown() and join() as WebServerThread.
+    '''
+    def __init__(self, app, host, port, output = None, static_assets = None, pages = None, telemetry = None,
+                 telemetry_max_rate = 10.0, workers = 2, send_buffer_size = 65536):
+        Thread.__init__(self, name = "AsyncRobotServer", daemon = True)
+        self.app = app
+        self.output = output
+        self.static_assets = static_assets
+        self.pages = pages
+        self.telemetry = telemetry
+        self.telemetry_max_rate = telemetry_max_rate
+        self.send_buffer_size = send_buffer_size
+        self.executor = ThreadPoolExecutor(max_workers = workers, thread_name_prefix = "RobotWorker")
+        #  Listening now, so the port is known, (and taken), before the loop is running
+        self.sock = socket.create_server((host, port), reuse_port = False)
+        self.server_name, self.server_port = self.sock.getsockname()[:2]
+        self.loop = None
+        self.stopping = None
+        self.connections = {}  #  the task handling every open connection, by its writer
+
+        #  The newest frame, and an event that is set, (and replaced), whenever there's a newer one
+        self.latest = (0, None)
+        self.frame_event = None
+        self.stream_clients = {}  #  writer -> stats
+
+    def run(self):
+        logging.info("Starting asyncio server")
+        asyncio.run(self._serve())
+
+    def shutdown(self):
+        logging.info("Stopping asyncio server")
+        if self.loop is not None and self.stopping is not None:
+            self.loop.call_soon_threadsafe(self.stopping.set)
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        self.frame_event = asyncio.Event()
+        if self.output is not None:
+            self.output.add_listener(self._publish)
+        server = await asyncio.start_server(self._handle_connection, sock = self.sock, limit = MAX_HEADER_BYTES)
+        await self.stopping.wait()
+        server.close()
+        if self.output is not None:
+            self.output.listeners.remove(self._publish)
+        #  Wake the streams up so they notice, drop every connection, and let them all finish
+        self.frame_event.set()
+        for writer in list(self.connections):
+            writer.transport.abort()
+        await asyncio.gather(*self.connections.values(), return_exceptions = True)
+        self.executor.shutdown(wait = False)
+
+    #  Called by StreamingOutput, (in the camera thread), every time a frame is published.
+    def _publish(self, sequence, frame):
+        try:
+            self.loop.call_soon_threadsafe(self._frame_published, sequence, frame)
+        except RuntimeError:
+            pass  #  the loop has closed
+
+    def _frame_published(self, sequence, frame):
+        self.latest = (sequence, frame)
+        event, self.frame_event = self.frame_event, asyncio.Event()
+        event.set()
+
+    async def _handle_connection(self, reader, writer):
+        self.connections[writer] = asyncio.current_task()
+        connections_gauge.inc()
+        try:
+            while not self.stopping.is_set():
+                request = await self._read_request(reader, writer)
+                if request is None or not await self._dispatch(request, writer):
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            logging.error("Asyncio server connection failed: %s", str(e))
+        finally:
+            del self.connections[writer]
+            connections_gauge.dec()
+            writer.close()
+
+    #  The next request on the connection, or None if it was closed, (or the request was bad).
+    async def _read_request(self, reader, writer):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), KEEPALIVE_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+            return None
+        except asyncio.LimitOverrunError:
+            await self._send(writer, 431, b"Request headers too large", keep_alive = False)
+            return None
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, version = lines[0].split(" ", 2)
+        except ValueError:
+            await self._send(writer, 400, b"Bad request line", keep_alive = False)
+            return None
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                name = name.strip().lower()
+                value = value.strip()
+                headers[name] = headers[name] + ", " + value if name in headers else value
+        if "chunked" in headers.get("transfer-encoding", ""):
+            await self._send(writer, 501, b"Chunked request bodies are not supported", keep_alive = False)
+            return None
+        try:
+            length = int(headers.get("content-length", "0"))
+            if length < 0:
+                raise ValueError(length)
+        except ValueError:
+            await self._send(writer, 400, b"Bad Content-Length", keep_alive = False)
+            return None
+        #  Nothing the robot is sent is anywhere near this big, so don't wait for it, (or buffer it)
+        if length > MAX_BODY_BYTES:
+            await self._send(writer, 413, b"Request body too large", keep_alive = False)
+            return None
+        try:
+            body = await asyncio.wait_for(reader.readexactly(length), KEEPALIVE_TIMEOUT) if length > 0 else b""
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+            return None
+        return HTTPRequest(method, target, version, headers, body)
+
+    #  Answer one request.  Returns False if the connection should be closed afterwards.
+    async def _dispatch(self, request, writer):
+        path = request.path
+        if request.headers.get("upgrade", "").lower() == "websocket":
+            return await self._send(writer, 404, b"WebSockets are not supported by this server", request)
+        if request.method in ("GET", "HEAD"):
+            if path == "/stream.mjpg" and self.output is not None:
+                await self._send_stream(request, writer)
+                return False
+            if path == "/stream_stats.json" and self.output is not None:
+                body = json.dumps({"clients": list(self.stream_clients.values())}).encode("utf-8")
+                return await self._send(writer, 200, body, request, [("Content-Type", "application/json"),
+                                                                      ("Cache-Control", "no-cache, private")])
+            if path == "/telemetry" and self.telemetry is not None:
+                await self._send_telemetry(request, writer)
+                return False
+            #  Only what's already in the caches: a miss could read the SD card, so Flask does it
+            if path.startswith("/static/") and self.static_assets is not None:
+                asset = self.static_assets.assets.get(path[len("/static/"):])
+                if asset is not None:
+                    return await self._send_asset(self.static_assets, asset, request, writer, "static")
+            elif self.pages is not None:
+                asset = self.pages.assets.get("index.html" if path == "/" else path[1:])
+                if asset is not None:
+                    return await self._send_asset(self.pages, asset, request, writer, "page")
+        return await self._send_to_app(request, writer)
+
+    async def _send_asset(self, cache, asset, request, writer, route):
+        start = monotonic()
+        status, body, headers = cache.representation(asset, request.headers.get("accept-encoding", ""),
+                                                     request.headers.get("if-none-match", ""))
+        keep_alive = await self._send(writer, status, body, request, headers)
+        request_seconds[route].observe(monotonic() - start)
+        return keep_alive
+
+    #  Everything else is answered by the Flask app, in a worker thread.
+    async def _send_to_app(self, request, writer):
+        start = monotonic()
+        status, headers, body = await self.loop.run_in_executor(self.executor, self._call_app, request,
+                                                                writer.get_extra_info("peername"))
+        keep_alive = await self._send(writer, status, body, request,
+                                      [header for header in headers if header[0].lower() != "content-length"])
+        request_seconds["app"].observe(monotonic() - start)
+        return keep_alive
+
+    #  Call the WSGI app, (in a worker thread).  Returns (status, headers, body).
+    def _call_app(self, request, peer):
+        environ = {
+            "REQUEST_METHOD": request.method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": request.path.encode("utf-8").decode("latin-1"),
+            "QUERY_STRING": request.query,
+            "SERVER_NAME": str(self.server_name),
+            "SERVER_PORT": str(self.server_port),
+            "SERVER_PROTOCOL": request.version,
+            "REMOTE_ADDR": peer[0] if peer else "",
+            "REMOTE_PORT": str(peer[1]) if peer else "",
+            "CONTENT_TYPE": request.headers.get("content-type", ""),
+            "CONTENT_LENGTH": str(len(request.body)),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": io.BytesIO(request.body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        for name, value in request.headers.items():
+            if name not in ("content-type", "content-length"):
+                environ["HTTP_" + name.upper().replace("-", "_")] = value
+
+        response = []
+
+        def start_response(status, headers, exc_info = None):
+            response[:] = [int(status.split(" ", 1)[0]), headers]
+
+        result = self.app(environ, start_response)
+        try:
+            body = b"".join(result)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+        return response[0], response[1], body
+
+    #  Send a complete response.  Returns whether the connection can be kept open.
+    async def _send(self, writer, status, body, request = None, headers = (), keep_alive = True):
+        keep_alive = keep_alive and request is not None and request.keep_alive()
+        head = ["HTTP/1.1 " + status_line(status)]
+        head.extend("{}: {}".format(name, value) for name, value in headers)
+        if status != 304:
+            head.append("Content-Length: {}".format(len(body)))
+        head.append("Connection: keep-alive" if keep_alive else "Connection: close")
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+        if status != 304 and (request is None or request.method != "HEAD"):
+            writer.write(body)
+        await writer.drain()
+        return keep_alive
+
+    #  Start a response whose body goes on until the connection is closed.
+    async def _start_stream(self, writer, content_type, headers = ()):
+        head = ["HTTP/1.1 200 OK", "Content-Type: " + content_type, "Cache-Control: no-cache, private",
+                "X-Accel-Buffering: no", "Connection: close"]
+        head.extend("{}: {}".format(name, value) for name, value in headers)
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+        await writer.drain()
+
+    async def _send_stream(self, request, writer):
+        try:
+            max_fps = float(parse_qs(request.query).get("fps", ["0"])[0])
+        except ValueError:
+            await self._send(writer, 400, b"fps must be a number", request)
+            return
+        min_interval = 1.0 / max_fps if max_fps > 0 else 0.0
+        sock = writer.get_extra_info("socket")
+        if self.send_buffer_size and sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer_size)
+        #  drain() only returns once everything has been handed to the kernel
+        writer.transport.set_write_buffer_limits(high = 0)
+        await self._start_stream(writer, "multipart/x-mixed-replace; boundary=FRAME")
+
+        peer = writer.get_extra_info("peername") or ("", 0)
+        stats = {"address": "{}:{}".format(*peer[:2]), "max_fps": max_fps or None,
+                 "frames_sent": 0, "frames_dropped": 0, "bytes_sent": 0}
+        self.stream_clients[writer] = stats
+        clients_gauge.set(len(self.stream_clients))
+        sent_sequence = self.latest[0]
+        next_send_time = 0.0
+        try:
+            while not self.stopping.is_set():
+                event = self.frame_event
+                if self.latest[0] == sent_sequence:
+                    await event.wait()
+                    continue
+                now = monotonic()
+                if now < next_send_time:
+                    await asyncio.sleep(next_send_time - now)
+                sequence, frame = self.latest
+                if sent_sequence:
+                    dropped = sequence - sent_sequence - 1
+                    stats["frames_dropped"] += dropped
+                    frames_dropped_total.inc(dropped)
+                sent_sequence = sequence
+                started = monotonic()
+                next_send_time = started + min_interval
+                header = part_header(len(frame))
+                writer.write(header)
+                writer.write(frame)
+                writer.write(PART_TRAILER)
+                await writer.drain()
+                stats["frames_sent"] += 1
+                stats["bytes_sent"] += len(header) + len(frame) + len(PART_TRAILER)
+                send_seconds.observe(monotonic() - started)
+        finally:
+            del self.stream_clients[writer]
+            clients_gauge.set(len(self.stream_clients))
+
+    async def _send_telemetry(self, request, writer):
+        try:
+            max_rate = float(parse_qs(request.query).get("max_rate", [str(self.telemetry_max_rate)])[0])
+        except ValueError:
+            max_rate = self.telemetry_max_rate
+        min_interval = 1.0 / max_rate if max_rate > 0 else 0.0
+        await self._start_stream(writer, "text/event-stream", [("Access-Control-Allow-Origin", "*")])
+        sent, version = self.telemetry.subscribe()
+        try:
+            writer.write(sse_event(sent, "state").encode("utf-8"))
+            await writer.drain()
+            last_write = monotonic()
+            while not self.stopping.is_set():
+                #  Polled rather than waited for, the publisher's lock is for threads
+                await asyncio.sleep(max(min_interval, TELEMETRY_POLL_INTERVAL))
+                version, delta = self.telemetry.changes(sent, version)
+                if delta:
+                    writer.write(sse_event(delta).encode("utf-8"))
+                elif monotonic() - last_write > self.telemetry.keepalive:
+                    writer.write(b": keepalive\n\n")
+                else:
+                    continue
+                await writer.drain()
+                last_write = monotonic()
+        finally:
+            self.telemetry.unsubscribe()
+
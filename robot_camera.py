@@ -0,0 +1,299 @@
+#
+#  New Remote Camera Robot - frame sources
+#
+#  The video used to come from picamera and nothing else, so StreamingOutput, the stream server
+#  and everything that watches them could only be tried out on a Raspberry Pi with a camera.
+#
+#  A "frame source" writes JPEG frames to StreamingOutput the same way picamera does.
+#  Three are provided:
+#    * PiCameraSource       - the real camera, (picamera recording MJPEG)
+#    * SyntheticFrameSource - generated frames of a given resolution, frame rate and size.
+#                             Each is a real, (plain grey), JPEG that a browser can show, and
+#                             carries its sequence number and the monotonic() time it was
+#                             written, (see frame_timestamp), so a benchmark can work out latency.
+#    * ReplayFrameSource    - frames from a file: an MJPEG file, (JPEGs one after the other, or a
+#                             saved /stream.mjpg), played at a given frame rate, or a recording
+#                             made by robot_video_recorder.py, played at the recorded pace.
+#
+#  The frame source is selected with the ROBOT_CAMERA environment variable:
+#    ROBOT_CAMERA=picamera   (default) the real camera
+#    ROBOT_CAMERA=synthetic  generated frames
+#    ROBOT_CAMERA=replay     frames from the file or recording directory in ROBOT_CAMERA_REPLAY
+#  ROBOT_CAMERA_RESOLUTION, ROBOT_CAMERA_FPS and ROBOT_CAMERA_FRAME_SIZE, (synthetic only),
+#  change the defaults.
+
+import logging
+import os
+import struct
+from threading import Event, Thread
+from time import monotonic
+
+#  The camera only exists on the robot.
+try:
+    import picamera
+except ImportError:
+    picamera = None
+
+#  Frame source names accepted by create_frame_source() and the ROBOT_CAMERA environment variable
+SOURCE_PICAMERA = "picamera"
+SOURCE_SYNTHETIC = "synthetic"
+SOURCE_REPLAY = "replay"
+
+DEFAULT_RESOLUTION = "800x600"
+DEFAULT_FPS = 30
+
+JPEG_START = b"\xff\xd8"
+JPEG_END = b"\xff\xd9"
+
+#  The comment segment at the start of every synthetic frame
+SYNTHETIC_TAG = b"NRCRSYN\0"
+SYNTHETIC_INFO = struct.Struct(">8sQd")  #  tag, sequence number, monotonic() time written
+SYNTHETIC_INFO_OFFSET = 6  #  after the start of image marker and the comment segment's marker and length
+
+
+class FrameSource(object):
+    '''
+    The interface every frame source provides.
+    start() begins writing frames to "output", (anything with a write method, like
+    StreamingOutput), and stop() stops.  "recording" is True in between.
+    '''
+    recording = False
+
+    def start(self, output):
+        raise NotImplementedError
+
+    def stop(self):
+        raise NotImplementedError
+
+
+class PiCameraSource(FrameSource):
+    '''
+    The Raspberry Pi camera.
+    '''
+    def __init__(self, resolution = DEFAULT_RESOLUTION, fps = DEFAULT_FPS):
+        if picamera is None:
+            raise IOError("The picamera module is not installed.")
+        self.resolution = resolution
+        self.fps = fps
+        self.camera = None
+
+    @property
+    def recording(self):
+        return self.camera is not None and self.camera.recording
+
+    def start(self, output):
+        self.camera = picamera.PiCamera()
+        self.camera.resolution = self.resolution
+        self.camera.framerate = self.fps
+#        self.camera.rotation=180
+        self.camera.meter_mode = "average"
+        self.camera.awb_mode = "auto"
+        self.camera.start_recording(output, format = "mjpeg")
+
+    def stop(self):
+        if self.recording:
+            self.camera.stop_recording()
+
+
+class FrameThreadSource(FrameSource):
+    '''
+    A frame source that writes its frames from its own thread.
+    Subclasses provide frames(), which yields (frame, seconds to wait before the next one).
+    '''
+    name = "FrameSource"
+
+    def __init__(self):
+        self.thread = None
+        self.stopping = Event()
+        self.frames_written = 0
+
+    @property
+    def recording(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, output):
+        self.stopping.clear()
+        self.thread = Thread(target = self.run, args = (output,), name = self.name, daemon = True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self, output):
+        next_frame = monotonic()
+        try:
+            for frame, interval in self.frames():
+                if self.stopping.is_set():
+                    break
+                output.write(frame)
+                self.frames_written += 1
+                #  Keep to the frame rate, without drifting if a write was slow
+                next_frame = max(next_frame + interval, monotonic() - interval)
+                if self.stopping.wait(max(0.0, next_frame - monotonic())):
+                    break
+        except Exception as e:
+            logging.error("Frame source %s failed: %s", self.name, str(e))
+        #  StreamingOutput only publishes a frame when the next one starts
+        output.write(JPEG_START)
+
+    def frames(self):
+        raise NotImplementedError
+
+
+#  A baseline JPEG of a plain grey image, "width" by "height", as (the part before the
+#  comment segments, the part after).  Every 8x8 block is coded as "no change from grey", which
+#  takes 2 bits with the one-code Huffman tables below, so the scan is all zero bytes.
+def grey_jpeg(width, height):
+    def segment(marker, payload):
+        return b"\xff" + marker + struct.pack(">H", len(payload) + 2) + payload
+
+    blocks = ((width + 7) // 8) * ((height + 7) // 8)
+    bits = blocks * 2
+    scan = bytes(bits // 8)
+    if bits % 8:
+        scan += bytes([(1 << (8 - bits % 8)) - 1])  #  the last byte is padded with 1 bits
+    one_code_table = bytes([1] + [0] * 15) + b"\x00"  #  one code, 1 bit long, for the value 0
+    after = (segment(b"\xdb", b"\x00" + bytes([1] * 64))  #  quantization table
+             + segment(b"\xc0", struct.pack(">BHHB3B", 8, height, width, 1, 1, 0x11, 0))  #  one component
+             + segment(b"\xc4", b"\x00" + one_code_table)  #  DC Huffman table
+             + segment(b"\xc4", b"\x10" + one_code_table)  #  AC Huffman table
+             + segment(b"\xda", b"\x01\x01\x00\x00\x3f\x00")  #  start of scan
+             + scan + JPEG_END)
+    return JPEG_START, after
+
+
+#  The (sequence number, monotonic() time written) carried by a synthetic frame, or None.
+def frame_timestamp(frame):
+    if len(frame) < SYNTHETIC_INFO_OFFSET + SYNTHETIC_INFO.size:
+        return None
+    tag, sequence, written = SYNTHETIC_INFO.unpack_from(frame, SYNTHETIC_INFO_OFFSET)
+    if tag != SYNTHETIC_TAG:
+        return None
+    return sequence, written
+
+
+class SyntheticFrameSource(FrameThreadSource):
+    '''
+    Generated frames, "resolution" pixels, "fps" a second.
+    frame_size pads every frame to that many bytes, (a real 800x600 camera frame is 40-80KB),
+    otherwise they are as small as the resolution allows.
+    '''
+    name = "SyntheticFrameSource"
+
+    def __init__(self, resolution = DEFAULT_RESOLUTION, fps = DEFAULT_FPS, frame_size = None):
+        FrameThreadSource.__init__(self)
+        width, height = (int(n) for n in resolution.lower().split("x"))
+        self.fps = fps
+        self.before, self.after = grey_jpeg(width, height)
+        size = len(self.before) + 4 + SYNTHETIC_INFO.size + len(self.after)
+        self.padding = b""
+        if frame_size is not None and frame_size > size:
+            #  more comment segments, 4 to 65535 bytes each, (including the marker)
+            padding = frame_size - size
+            while padding >= 4:
+                length = min(padding, 65535)
+                if 0 < padding - length < 4:
+                    length -= 4
+                self.padding += b"\xff\xfe" + struct.pack(">H", length - 2) + bytes(length - 4)
+                padding -= length
+
+    def frame(self, sequence):
+        info = SYNTHETIC_INFO.pack(SYNTHETIC_TAG, sequence, monotonic())
+        return (self.before + b"\xff\xfe" + struct.pack(">H", len(info) + 2) + info
+                + self.padding + self.after)
+
+    def frames(self):
+        sequence = 0
+        while True:
+            sequence += 1
+            yield self.frame(sequence), 1.0 / self.fps
+
+
+#  The JPEGs in an MJPEG file, (JPEGs one after the other, with or without
+#  multipart headers in between), as a list of bytes objects.
+def read_mjpeg(path):
+    with open(path, "rb") as mjpeg_file:
+        data = mjpeg_file.read()
+    frames = []
+    start = data.find(JPEG_START)
+    while start >= 0:
+        end = data.find(JPEG_END, start + 2)
+        if end < 0:
+            break
+        frames.append(data[start:end + 2])
+        start = data.find(JPEG_START, end + 2)
+    return frames
+
+
+class ReplayFrameSource(FrameThreadSource):
+    '''
+    Frames from "path": an MJPEG file, played at "fps", or a video recording, (a directory
+    or segment file written by robot_video_recorder.py), played at the recorded pace.
+    With "loop" it starts again from the beginning at the end.
+    '''
+    name = "ReplayFrameSource"
+
+    def __init__(self, path, fps = DEFAULT_FPS, loop = True):
+        FrameThreadSource.__init__(self)
+        self.path = path
+        self.fps = fps
+        self.loop = loop
+        self.recorded = os.path.isdir(path) or path.endswith(".mjseg")
+        if not self.recorded:
+            self.mjpeg_frames = read_mjpeg(path)
+            if not self.mjpeg_frames:
+                raise ValueError("{} has no JPEG frames in it".format(path))
+
+    def recorded_frames(self):
+        from robot_video_recorder import VideoArchive, VideoSegment
+        if os.path.isdir(self.path):
+            frames = VideoArchive(self.path).frames(0)
+        else:
+            with VideoSegment(self.path) as segment:
+                frames = [segment.frame(index) for index in range(len(segment))]
+        previous = None
+        for timestamp, frame in frames:
+            if previous is not None:
+                #  gaps of more than a second, where nothing was recorded, are skipped
+                yield previous[1], min(max(timestamp - previous[0], 0.0), 1.0)
+            previous = (timestamp, frame)
+        if previous is not None:
+            yield previous[1], 1.0 / self.fps
+
+    def frames(self):
+        while True:
+            if self.recorded:
+                played = 0
+                for frame, interval in self.recorded_frames():
+                    played += 1
+                    yield frame, interval
+                if not played:
+                    raise ValueError("{} has no recorded frames in it".format(self.path))
+            else:
+                for frame in self.mjpeg_frames:
+                    yield frame, 1.0 / self.fps
+            if not self.loop:
+                break
+
+
+#  Create the frame source selected by "name", or by the ROBOT_CAMERA environment variable.
+def create_frame_source(name = None):
+    if name is None:
+        name = os.environ.get("ROBOT_CAMERA", SOURCE_PICAMERA)
+    name = name.strip().lower()
+    resolution = os.environ.get("ROBOT_CAMERA_RESOLUTION", DEFAULT_RESOLUTION)
+    fps = float(os.environ.get("ROBOT_CAMERA_FPS", DEFAULT_FPS))
+
+    if name == SOURCE_PICAMERA:
+        return PiCameraSource(resolution, fps)
+    elif name == SOURCE_SYNTHETIC:
+        frame_size = os.environ.get("ROBOT_CAMERA_FRAME_SIZE")
+        return SyntheticFrameSource(resolution, fps, int(frame_size) if frame_size else None)
+    elif name == SOURCE_REPLAY:
+        if not os.environ.get("ROBOT_CAMERA_REPLAY"):
+            raise ValueError("ROBOT_CAMERA_REPLAY must be set to the file to replay")
+        return ReplayFrameSource(os.environ["ROBOT_CAMERA_REPLAY"], fps)
+    else:
+        raise ValueError("Unknown camera: {}".format(name))
@@ -0,0 +1,186 @@
+#
+#  New Remote Camera Robot - command log
+#
+#  Once process_robot_commands has handled a joystick message, it's gone.  That makes it
+#  impossible to profile a change against a real driving session, (a pilot never drives
+#  the same way twice).
+#
+#  CommandRecorder appends every command to a file of fixed-size binary records:
+#    * a 16 byte header, (magic, format version, record size)
+#    * one 64 byte record per command: the time it arrived, the browser's time_stamp,
+#      the joystick axes, force, triggers, and the controller/motion/direction strings
+#      as one-byte codes, (see the tables below)
+#  At 20 commands a second that's about 4.5MB an hour, and writing a record is one
+#  struct.pack and a buffered write.
+#
+#  CommandLog memory-maps a log file so that a replay, (see benchmarks/bench_replay_commands.py),
+#  can read it without loading it all or parsing text, and turns each record back into the
+#  same dict the browser sends.  A partly written record at the end of the file, (the robot
+#  was switched off), is ignored.
+#
+#  Set ROBOT_COMMAND_LOG=/path/to/file to record when the robot is running.
+
+import mmap
+import os
+import struct
+from threading import Lock
+from time import time
+
+MAGIC = b"NRCRCMD\0"
+VERSION = 1
+HEADER = struct.Struct("<8sHH4x")  #  magic, version, record size
+
+#  arrival time, (seconds since the epoch), time_stamp, x_axis, y_axis, head_x_axis, head_y_axis,
+#  force, trigger_1, trigger_2, head_enable, controller_status, motion_state, angle_dir
+RECORD = struct.Struct("<dq5d6B2x")
+
+#  The strings the browser sends, coded as their position in these tables.
+#  Anything else is recorded as UNKNOWN_CODE and replayed as "unknown", which
+#  process_robot_commands treats the same as any other key it doesn't know.
+CONTROLLER_STATUS = ("Disconnected", "Connected")
+MOTION_STATE = ("Waiting for Joystick", "Stopped", "Moving", "Moving quicly",
+                "ArrowUp", "ArrowDown", "ArrowLeft", "ArrowRight", "Home", "Escape")
+ANGLE_DIR = ("None", "Stopped", "Directly Forward", "Forward-Right", "Forward-Left",
+             "Directly Backward", "Backward-Right", "Backward-Left")
+UNKNOWN_CODE = 255
+
+#  string -> code, for the recorder
+CONTROLLER_STATUS_CODES = {name: code for code, name in enumerate(CONTROLLER_STATUS)}
+MOTION_STATE_CODES = {name: code for code, name in enumerate(MOTION_STATE)}
+ANGLE_DIR_CODES = {name: code for code, name in enumerate(ANGLE_DIR)}
+
+
+class CommandLogError(Exception):
+    '''
+    The file is not a command log, or was written by an incompatible version.
+    '''
+
+
+def decode_string(table, code):
+    return table[code] if code < len(table) else "unknown"
+
+
+class CommandRecorder(object):
+    '''
+    Appends commands to a command log, creating it if necessary.
+    Records are buffered and written to the file every "flush_every" commands.
+    '''
+    def __init__(self, path, flush_every = 50):
+        self.path = path
+        self.flush_every = flush_every
+        self.lock = Lock()
+        self.records = 0
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            check_header(path)
+            #  Drop a partly written last record, or everything after it would be out of step.
+            size = os.path.getsize(path)
+            os.truncate(path, size - (size - HEADER.size) % RECORD.size)
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+
+    #  Record one command, (the dict process_robot_commands was given).
+    def record(self, args, arrival_time = None):
+        record = RECORD.pack(
+            time() if arrival_time is None else arrival_time,
+            int(args["time_stamp"]),
+            float(args["x_axis"]),
+            float(args["y_axis"]),
+            float(args["head_x_axis"]),
+            float(args["head_y_axis"]),
+            float(args["force"]),
+            int(args["trigger_1"]),
+            int(args["trigger_2"]),
+            int(args["head_enable"]),
+            CONTROLLER_STATUS_CODES.get(str(args["controller_status"]), UNKNOWN_CODE),
+            MOTION_STATE_CODES.get(str(args["motion_state"]), UNKNOWN_CODE),
+            ANGLE_DIR_CODES.get(str(args["angle_dir"]), UNKNOWN_CODE),
+        )
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(record)
+            self.records += 1
+            if self.records % self.flush_every == 0:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+#  Raise CommandLogError unless "path" starts with a command log header this version can read.
+def check_header(path):
+    with open(path, "rb") as log_file:
+        header = log_file.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise CommandLogError("{} is too short to be a command log".format(path))
+    magic, version, record_size = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise CommandLogError("{} is not a command log".format(path))
+    if version != VERSION or record_size != RECORD.size:
+        raise CommandLogError("{} is command log version {}, expected {}".format(path, version, VERSION))
+
+
+class CommandLog(object):
+    '''
+    A memory-mapped command log, for replay.
+    len() is the number of complete records, and iterating gives (arrival_time, command) pairs,
+    where "command" is a dict in the same form the browser sends to /robot.
+    '''
+    def __init__(self, path):
+        check_header(path)
+        self.path = path
+        self.file = open(path, "rb")
+        size = os.fstat(self.file.fileno()).st_size
+        self.count = (size - HEADER.size) // RECORD.size
+        self.map = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ) if self.count else None
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("command log index out of range")
+        return to_command(RECORD.unpack_from(self.map, HEADER.size + index * RECORD.size))
+
+    def __iter__(self):
+        unpack_from = RECORD.unpack_from
+        for offset in range(HEADER.size, HEADER.size + self.count * RECORD.size, RECORD.size):
+            yield to_command(unpack_from(self.map, offset))
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+#  Turn an unpacked record back into (arrival_time, command).
+def to_command(record):
+    (arrival_time, time_stamp, x_axis, y_axis, head_x_axis, head_y_axis, force,
+     trigger_1, trigger_2, head_enable, controller_status, motion_state, angle_dir) = record
+    return arrival_time, {
+        "controller_status": decode_string(CONTROLLER_STATUS, controller_status),
+        "motion_state": decode_string(MOTION_STATE, motion_state),
+        "angle_dir": decode_string(ANGLE_DIR, angle_dir),
+        "time_stamp": time_stamp,
+        "x_axis": x_axis,
+        "y_axis": y_axis,
+        "head_x_axis": head_x_axis,
+        "head_y_axis": head_y_axis,
+        "force": force,
+        "trigger_1": trigger_1,
+        "trigger_2": trigger_2,
+        "head_enable": head_enable,
+    }
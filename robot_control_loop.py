@@ -0,0 +1,127 @@
+#
+#  New Remote Camera Robot - drive control loop
+#
+#  Without a control loop, the wheels only change when a web request arrives.  If the browser
+#  stalls or the network drops in the middle of a move, the last speed sent to the motors
+#  stays in effect and the robot keeps going. . . and going. . . .
+#
+#  DriveControlLoop is a thread that runs at a fixed rate, (50 times a second by default).
+#  Every tick it:
+#    * checks how long it has been since the last command arrived from the browser and, if that
+#      is longer than the timeout, stops the motors, (a "dead-man" watchdog, armed by the first
+#      command, so it doesn't trip at boot before any browser has connected)
+#    * otherwise calls "step", which works out the wheel speeds from the latest joystick state
+#  It also keeps track of how regular its own timing is, (period jitter and overruns),
+#  so the rate can be tuned on a busy robot.  The step times and overruns are in /metrics too.
+
+import logging
+from collections import deque
+from threading import Event, Thread
+from time import monotonic
+
+from robot_metrics import registry
+
+step_seconds = registry.histogram("robot_control_loop_step_seconds",
+                                  "Time taken by each tick of the drive control loop")
+overruns_total = registry.counter("robot_control_loop_overruns_total",
+                                  "Drive control loop ticks missed because a tick ran late")
+watchdog_trips_total = registry.counter("robot_control_loop_watchdog_trips_total",
+                                        "Times the robot was stopped because commands stopped arriving")
+
+
+class DriveControlLoop(Thread):
+    '''
+    Fixed-rate drive loop with a dead-man watchdog.
+    step()              - called every tick while commands are fresh
+    on_timeout()        - called once when the commands go stale
+    last_command_time() - returns the monotonic() time the latest command arrived,
+                          (0 or None until the first one, and the watchdog isn't armed until then)
+    '''
+    def __init__(self, step, on_timeout, last_command_time, rate = 50, timeout = 0.75, history = 500):
+        Thread.__init__(self, name = "DriveControlLoop", daemon = True)
+        self.step = step
+        self.on_timeout = on_timeout
+        self.last_command_time = last_command_time
+        self.period = 1.0 / rate
+        self.timeout = timeout
+        self.stopping = Event()
+
+        self.watchdog_tripped = False
+        self.watchdog_trips = 0
+        self.ticks = 0
+        self.overruns = 0  #  ticks that started a full period or more late
+        self.max_jitter = 0.0  #  largest difference between the actual and the nominal period
+        self.total_jitter = 0.0
+        self.max_step_time = 0.0
+        self.periods = deque(maxlen = history)  #  the most recent actual periods, for percentiles
+
+    def stop(self, timeout = None):
+        self.stopping.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        next_tick = monotonic()
+        last_tick = None
+        while not self.stopping.is_set():
+            now = monotonic()
+            if last_tick is not None:
+                actual_period = now - last_tick
+                jitter = abs(actual_period - self.period)
+                self.periods.append(actual_period)
+                self.total_jitter += jitter
+                if jitter > self.max_jitter:
+                    self.max_jitter = jitter
+            last_tick = now
+            self.ticks += 1
+
+            try:
+                last_command_time = self.last_command_time()
+                if not last_command_time:
+                    #  No command has arrived yet, so there's nothing to drive, or to stop
+                    pass
+                elif now - last_command_time > self.timeout:
+                    if not self.watchdog_tripped:
+                        self.watchdog_tripped = True
+                        self.watchdog_trips += 1
+                        watchdog_trips_total.inc()
+                        self.on_timeout()
+                else:
+                    self.watchdog_tripped = False
+                    self.step()
+            except Exception as e:
+                logging.error("Drive control loop step failed: %s", str(e))
+
+            step_time = monotonic() - now
+            step_seconds.observe(step_time)
+            if step_time > self.max_step_time:
+                self.max_step_time = step_time
+
+            #  Schedule against absolute deadlines so the rate doesn't drift.
+            #  If we've fallen a whole period or more behind, count it and skip the missed ticks.
+            next_tick += self.period
+            now = monotonic()
+            if now - next_tick >= self.period:
+                missed = int((now - next_tick) / self.period)
+                self.overruns += missed
+                overruns_total.inc(missed)
+                next_tick += missed * self.period
+            self.stopping.wait(max(0.0, next_tick - now))
+
+    def stats(self):
+        periods = sorted(self.periods)
+        intervals = max(1, self.ticks - 1)
+        result = {
+            "rate_hz": 1.0 / self.period,
+            "ticks": self.ticks,
+            "overruns": self.overruns,
+            "watchdog_trips": self.watchdog_trips,
+            "watchdog_tripped": self.watchdog_tripped,
+            "mean_jitter_ms": self.total_jitter / intervals * 1000.0,
+            "max_jitter_ms": self.max_jitter * 1000.0,
+            "max_step_ms": self.max_step_time * 1000.0,
+        }
+        if periods:
+            result["p50_period_ms"] = periods[len(periods) // 2] * 1000.0
+            result["p99_period_ms"] = periods[min(len(periods) - 1, int(len(periods) * 0.99))] * 1000.0
+        return result
@@ -0,0 +1,91 @@
+#
+#  New Remote Camera Robot - packed binary control payload
+#
+#  The browser normally sends each joystick command as a query string built by jQuery's
+#  $.param, (or the same fields as JSON over the WebSocket).  That's about 250 bytes of text
+#  like "controller_status=Connected&motion_state=Moving&...", which process_robot_commands
+#  then has to turn back into numbers with str()/int()/float() every time.
+#
+#  This is a second encoding of the same command, 22 bytes with a fixed layout:
+#
+#    offset  size  field
+#         0     1  format version, (PAYLOAD_VERSION)
+#         1     1  flags: trigger_1, trigger_2, head_enable, controller connected, (FLAG_*)
+#         2     4  sequence number, (unsigned, increases with every command sent)
+#         6     4  time_stamp, (unsigned, milliseconds)
+#        10    10  x_axis, y_axis, head_x_axis, head_y_axis, force
+#                  as signed 16 bit integers, (-1.0 .. 1.0 scaled by AXIS_SCALE)
+#        20     1  motion_state code  \  the same code tables as the command log,
+#        21     1  angle_dir code     /  (see robot_command_log.py)
+#
+#  All little-endian.  It is sent as the body of a POST to /robot with the content type
+#  PAYLOAD_MIMETYPE, or as a binary WebSocket frame on /robot_ws.  The browser only uses it
+#  if the page is opened with "?binary=1".
+
+import struct
+
+from robot_command_log import (ANGLE_DIR, ANGLE_DIR_CODES, MOTION_STATE, MOTION_STATE_CODES,
+                               UNKNOWN_CODE, decode_string)
+
+PAYLOAD_VERSION = 1
+PAYLOAD_MIMETYPE = "application/x-robot-command"
+PAYLOAD = struct.Struct("<BBII5hBB")
+AXIS_SCALE = 32767
+
+FLAG_TRIGGER_1 = 0x01
+FLAG_TRIGGER_2 = 0x02
+FLAG_HEAD_ENABLE = 0x04
+FLAG_CONNECTED = 0x08
+
+
+def axis_to_int(value):
+    return max(-AXIS_SCALE, min(AXIS_SCALE, int(round(float(value) * AXIS_SCALE))))
+
+
+#  Pack a command, (a dict in the form the browser sends), with sequence number "seq".
+def encode_command(args, seq):
+    flags = 0
+    if int(args["trigger_1"]):
+        flags |= FLAG_TRIGGER_1
+    if int(args["trigger_2"]):
+        flags |= FLAG_TRIGGER_2
+    if int(args["head_enable"]):
+        flags |= FLAG_HEAD_ENABLE
+    if str(args["controller_status"]) == "Connected":
+        flags |= FLAG_CONNECTED
+    return PAYLOAD.pack(
+        PAYLOAD_VERSION, flags, seq & 0xffffffff, int(args["time_stamp"]) & 0xffffffff,
+        axis_to_int(args["x_axis"]), axis_to_int(args["y_axis"]),
+        axis_to_int(args["head_x_axis"]), axis_to_int(args["head_y_axis"]),
+        axis_to_int(args["force"]),
+        MOTION_STATE_CODES.get(str(args["motion_state"]), UNKNOWN_CODE),
+        ANGLE_DIR_CODES.get(str(args["angle_dir"]), UNKNOWN_CODE),
+    )
+
+
+#  Unpack a payload into the same dict process_robot_commands gets from the query string,
+#  (already converted to numbers), plus "seq".  The browser rounds the axes to 2 decimal places,
+#  so rounding them to 4 here gives back exactly what it sent.
+#  Raises ValueError if it isn't a payload this version understands.
+def decode_command(payload):
+    if len(payload) != PAYLOAD.size:
+        raise ValueError("control payload must be {} bytes, not {}".format(PAYLOAD.size, len(payload)))
+    (version, flags, seq, time_stamp, x_axis, y_axis, head_x_axis, head_y_axis, force,
+     motion_state, angle_dir) = PAYLOAD.unpack(payload)
+    if version != PAYLOAD_VERSION:
+        raise ValueError("unknown control payload version {}".format(version))
+    return {
+        "seq": seq,
+        "controller_status": "Connected" if flags & FLAG_CONNECTED else "Disconnected",
+        "motion_state": decode_string(MOTION_STATE, motion_state),
+        "angle_dir": decode_string(ANGLE_DIR, angle_dir),
+        "time_stamp": time_stamp,
+        "x_axis": round(x_axis / AXIS_SCALE, 4),
+        "y_axis": round(y_axis / AXIS_SCALE, 4),
+        "head_x_axis": round(head_x_axis / AXIS_SCALE, 4),
+        "head_y_axis": round(head_y_axis / AXIS_SCALE, 4),
+        "force": round(force / AXIS_SCALE, 4),
+        "trigger_1": 1 if flags & FLAG_TRIGGER_1 else 0,
+        "trigger_2": 1 if flags & FLAG_TRIGGER_2 else 0,
+        "head_enable": 1 if flags & FLAG_HEAD_ENABLE else 0,
+    }
@@ -0,0 +1,118 @@
+#
+#  New Remote Camera Robot - controller lease
+#
+#  Any browser that could reach /robot could drive the robot, and commands were applied in the
+#  order they arrived.  Two open tabs would fight over the motors, and a POST that was delayed,
+#  (or retried), on a bad Wi-Fi link could arrive after a newer "stop" and start the robot again.
+#
+#  The ControllerLease makes one browser the "owner":
+#    * the browser asks for the lease, (POST /robot/lease), and gets a random token
+#    * every command it sends carries the token and a sequence number that goes up by at
+#      least one for every command, (the packed binary payload and the WebSocket frames
+#      already have one, the query string POST sends "seq")
+#    * check() accepts a command only from the owner, and only if its sequence number is
+#      higher than the last one accepted, so a late command can never undo a newer one,
+#      (a command with a token but no sequence number is an error, it can't be ordered)
+#
+#  The lease lasts as long as the owner keeps sending commands.  After "timeout" seconds
+#  without one it has expired, and another browser may take it.  A browser can also take the
+#  lease from a current owner on purpose, ("takeover", e.g. the pilot moved to another device),
+#  after which the old owner's commands are rejected.
+#
+#  Until a lease has been issued, commands without a token are accepted as they always were,
+#  so scripts and the benchmarks still work.  Once one has, (a browser has opened the page),
+#  every command must come from the owner, even after the lease expires or is given up:
+#  a token-less command can't be ordered against the owner's, so a delayed one could
+#  restart the robot after a stop.  A script can ask for the lease like a browser does.
+#  Every rejected command is counted in /metrics.
+
+import secrets
+from threading import Lock
+from time import monotonic
+
+from robot_metrics import registry
+
+#  Why a command was rejected
+STALE = "stale"  #  older than, (or the same as), the last command accepted from the owner
+NOT_OWNER = "not_owner"  #  someone else holds the lease
+
+commands_rejected_total = {
+    reason: registry.counter("robot_commands_rejected_total", "Joystick commands dropped before being processed",
+                             labels = {"reason": reason})
+    for reason in (STALE, NOT_OWNER)
+}
+takeovers_total = registry.counter("robot_lease_takeovers_total", "Times the controller lease was taken from its owner")
+
+
+class ControllerLease(object):
+    '''
+    Which browser may drive the robot, and the last command accepted from it.
+    '''
+    def __init__(self, timeout = 10.0):
+        self.timeout = timeout
+        self.lock = Lock()
+        self.token = None  #  the owner's token, None if nobody holds the lease
+        self.issued = False  #  True once a lease has been issued, (token-less commands are refused from then on)
+        self.last_seq = None  #  sequence number of the last command accepted from the owner
+        self.last_used = 0.0  #  monotonic() time the owner last acquired the lease or sent a command
+
+    def expired(self):
+        return self.token is None or monotonic() - self.last_used > self.timeout
+
+    #  Returns a new token if the lease is free, (or "takeover" is set), otherwise None.
+    def acquire(self, takeover = False):
+        with self.lock:
+            if not self.expired():
+                if not takeover:
+                    return None
+                takeovers_total.inc()
+            self.token = secrets.token_hex(16)
+            self.issued = True
+            self.last_seq = None
+            self.last_used = monotonic()
+            return self.token
+
+    #  Give up the lease.  Returns False if "token" doesn't hold it.
+    def release(self, token):
+        with self.lock:
+            if token is None or token != self.token:
+                return False
+            self.token = None
+            self.last_seq = None
+            return True
+
+    #  Check a command with the lease token "token", (None if it had none), and sequence
+    #  number "seq".  Returns None if it should be processed, otherwise the reason it
+    #  should be dropped, (STALE or NOT_OWNER).
+    #  Raises ValueError if there is a token but no sequence number.
+    def check(self, token, seq):
+        if token is not None and seq is None:
+            raise ValueError("a command sent with a lease token must have a seq")
+        with self.lock:
+            if token is None:
+                if not self.issued:
+                    return None
+                reason = NOT_OWNER
+            elif token != self.token:
+                reason = NOT_OWNER
+            elif self.last_seq is not None and seq <= self.last_seq:
+                reason = STALE
+            else:
+                #  The owner keeps the lease even if it had expired, as long as nobody took it.
+                self.last_seq = seq
+                self.last_used = monotonic()
+                return None
+        commands_rejected_total[reason].inc()
+        return reason
+
+    #  Everything the /robot/lease route reports.  "token" is the caller's token, if any.
+    def status(self, token = None):
+        with self.lock:
+            status = {
+                "held": not self.expired(),
+                "owner": token is not None and token == self.token,
+                "timeout": self.timeout,
+            }
+            if self.token is not None:
+                status["idle_seconds"] = round(monotonic() - self.last_used, 3)
+            return status
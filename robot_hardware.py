@@ -0,0 +1,277 @@
+#
+#  New Remote Camera Robot - hardware backends
+#
+#  New_Remote_Camera_Robot.py never talks to the GoPiGo3 directly.  Instead it talks to a
+#  "backend" object that provides the small part of the EasyGoPiGo3 API the robot actually uses:
+#  set_motor_dps, stop, set_speed, init_servo, (rotate_servo/disable_servo), get_voltage_battery,
+#  and the eye colors.
+#
+#  Two backends are provided:
+#    * GoPiGo3Backend - the real robot, a thin wrapper around EasyGoPiGo3(use_mutex = True)
+#    * SimulatedGoPiGo3 - an in-process simulator that records every call with a timestamp
+#      and models the cost of the SPI transaction, so that the command processing code
+#      can be profiled and benchmarked on any Linux machine without a robot attached.
+#
+#  The backend is selected with the ROBOT_BACKEND environment variable:
+#    ROBOT_BACKEND=gopigo3    (default) use the real robot
+#    ROBOT_BACKEND=simulated  use the simulator
+#
+#  The simulated SPI cost, (in seconds per call), can be changed with ROBOT_SIM_SPI_COST.
+#
+#  Talking to the GoPiGo3 for the first time takes a while, so it shouldn't happen just because
+#  the program was imported.  LazyHardware stands in for a backend, (or a servo), and only
+#  creates it the first time it is actually used, (or when get() is called, e.g. at startup).
+
+import os
+import sys
+from collections import deque, namedtuple
+from threading import Lock
+from time import monotonic, perf_counter, sleep
+
+#  This grabs my modified version of EasyGoPiGo3 instead of the standard package
+sys.path.insert(0, "/home/pi/Project_Files/Projects/GoPiGo3/Software/Python")
+
+#  The GoPiGo3 libraries only exist on the robot.  If they are not installed,
+#  only the simulated backend is available.
+try:
+    from gopigo3 import FirmwareVersionError
+    from easygopigo3 import EasyGoPiGo3
+except ImportError:
+    EasyGoPiGo3 = None
+
+    class FirmwareVersionError(Exception):
+        pass
+
+#  Backend names accepted by create_backend() and the ROBOT_BACKEND environment variable
+BACKEND_GOPIGO3 = "gopigo3"
+BACKEND_SIMULATED = "simulated"
+
+#  A reasonable guess at the time one mutex-guarded SPI transaction takes on a Raspberry Pi.
+DEFAULT_SPI_CALL_COST = 0.0004
+
+#  The simulated battery, (8 AA cells), and how fast it runs down, in volts per hour of driving.
+SIMULATED_BATTERY_VOLTS = 11.8
+SIMULATED_BATTERY_DRAIN = 1.0
+
+
+class RobotBackend(object):
+    '''
+    The interface every hardware backend provides.
+    The motor port constants have the same values as the GoPiGo3 so that
+    MOTOR_LEFT + MOTOR_RIGHT addresses both motors at once.
+    '''
+    MOTOR_LEFT = 0x01
+    MOTOR_RIGHT = 0x02
+
+    left_eye_color = (0, 0, 0)
+    right_eye_color = (0, 0, 0)
+
+    def set_motor_dps(self, port, dps):
+        raise NotImplementedError
+
+    def stop(self):
+        raise NotImplementedError
+
+    def set_speed(self, speed):
+        raise NotImplementedError
+
+    def init_servo(self, port):
+        raise NotImplementedError
+
+    def get_voltage_battery(self):
+        raise NotImplementedError
+
+
+class GoPiGo3Backend(RobotBackend):
+    '''
+    The real robot.
+    Everything is passed straight through to EasyGoPiGo3.
+    '''
+    def __init__(self):
+        if EasyGoPiGo3 is None:
+            raise IOError("The GoPiGo3 libraries are not installed")
+        self.gopigo3 = EasyGoPiGo3(use_mutex = True)
+        self.MOTOR_LEFT = self.gopigo3.MOTOR_LEFT
+        self.MOTOR_RIGHT = self.gopigo3.MOTOR_RIGHT
+
+    #  EasyGoPiGo3 reads the eye colors from its own attributes when the eyes are opened.
+    @property
+    def left_eye_color(self):
+        return self.gopigo3.left_eye_color
+
+    @left_eye_color.setter
+    def left_eye_color(self, color):
+        self.gopigo3.left_eye_color = color
+
+    @property
+    def right_eye_color(self):
+        return self.gopigo3.right_eye_color
+
+    @right_eye_color.setter
+    def right_eye_color(self, color):
+        self.gopigo3.right_eye_color = color
+
+    def set_motor_dps(self, port, dps):
+        self.gopigo3.set_motor_dps(port, dps)
+
+    def stop(self):
+        self.gopigo3.stop()
+
+    def set_speed(self, speed):
+        self.gopigo3.set_speed(speed)
+
+    def init_servo(self, port):
+        return self.gopigo3.init_servo(port)
+
+    def get_voltage_battery(self):
+        return self.gopigo3.get_voltage_battery()
+
+
+#  One entry in the simulator's call log.
+#  timestamp is time.perf_counter() when the call started, duration is how long it took.
+SimulatedCall = namedtuple("SimulatedCall", ["timestamp", "name", "args", "duration"])
+
+
+class SimulatedServo(object):
+    '''
+    A servo attached to a SimulatedGoPiGo3.
+    '''
+    def __init__(self, robot, port):
+        self.robot = robot
+        self.port = port
+        self.position = None
+        self.enabled = False
+
+    def rotate_servo(self, degrees):
+        self.robot._spi_call("rotate_servo", (self.port, degrees))
+        self.position = degrees
+        self.enabled = True
+
+    def disable_servo(self):
+        self.robot._spi_call("disable_servo", (self.port,))
+        self.enabled = False
+
+
+class SimulatedGoPiGo3(RobotBackend):
+    '''
+    An in-process stand-in for the GoPiGo3.
+    Every hardware call takes the (simulated) mutex, waits spi_call_cost seconds
+    to model the SPI transaction, and is appended to the call log.
+    The current motor speeds and servo positions are kept so they can be checked.
+    '''
+    def __init__(self, spi_call_cost = DEFAULT_SPI_CALL_COST, max_calls = 100000):
+        self.spi_call_cost = spi_call_cost
+        self.calls = deque(maxlen = max_calls)
+        self.call_count = 0
+        self.spi_time = 0.0
+        self.motor_dps = {self.MOTOR_LEFT: 0, self.MOTOR_RIGHT: 0}
+        self.speed = 0
+        self.servos = {}
+        self.battery_volts = SIMULATED_BATTERY_VOLTS
+        self.battery_read_at = perf_counter()
+        self._mutex = Lock()
+
+    def _spi_call(self, name, args):
+        with self._mutex:
+            start = perf_counter()
+            if self.spi_call_cost > 0:
+                sleep(self.spi_call_cost)
+            duration = perf_counter() - start
+            self.calls.append(SimulatedCall(start, name, args, duration))
+            self.call_count += 1
+            self.spi_time += duration
+
+    def set_motor_dps(self, port, dps):
+        self._spi_call("set_motor_dps", (port, dps))
+        for motor in (self.MOTOR_LEFT, self.MOTOR_RIGHT):
+            if port & motor:
+                self.motor_dps[motor] = dps
+
+    def stop(self):
+        self._spi_call("stop", ())
+        self.motor_dps[self.MOTOR_LEFT] = 0
+        self.motor_dps[self.MOTOR_RIGHT] = 0
+
+    def set_speed(self, speed):
+        self._spi_call("set_speed", (speed,))
+        self.speed = speed
+
+    def init_servo(self, port):
+        servo = SimulatedServo(self, port)
+        self.servos[port] = servo
+        return servo
+
+    #  The battery runs down while the motors are turning, (roughly, it's only a simulation).
+    def get_voltage_battery(self):
+        self._spi_call("get_voltage_battery", ())
+        now = perf_counter()
+        if self.motor_dps[self.MOTOR_LEFT] or self.motor_dps[self.MOTOR_RIGHT]:
+            self.battery_volts -= SIMULATED_BATTERY_DRAIN * (now - self.battery_read_at) / 3600.0
+        self.battery_read_at = now
+        return self.battery_volts
+
+    #  Forget everything recorded so far, (used between benchmark runs).
+    def reset(self):
+        with self._mutex:
+            self.calls.clear()
+            self.call_count = 0
+            self.spi_time = 0.0
+
+    #  Return the recorded calls, optionally only those with a given name.
+    def recorded_calls(self, name = None):
+        with self._mutex:
+            calls = list(self.calls)
+        if name is None:
+            return calls
+        return [call for call in calls if call.name == name]
+
+
+class LazyHardware(object):
+    '''
+    Calls "factory" to create the real object the first time it is needed.
+    Attributes are passed on to the real object, so this can be used in its place.
+    Errors from "factory" are raised to whoever first used it, and it is tried again next time.
+    '''
+    def __init__(self, factory, name):
+        self._factory = factory
+        self._name = name
+        self._lock = Lock()
+        self._target = None
+        self.init_seconds = None  #  how long "factory" took
+
+    #  The real object, created if necessary.
+    def get(self):
+        target = self._target
+        if target is None:
+            with self._lock:
+                if self._target is None:
+                    start = monotonic()
+                    self._target = self._factory()
+                    self.init_seconds = monotonic() - start
+                target = self._target
+        return target
+
+    def initialized(self):
+        return self._target is not None
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+    def __repr__(self):
+        return "<LazyHardware {} ({})>".format(self._name, "initialized" if self.initialized() else "not initialized")
+
+
+#  Create the backend selected by "name", or by the ROBOT_BACKEND environment variable.
+#  Errors from the real hardware, (IOError, FirmwareVersionError), are passed to the caller.
+def create_backend(name = None):
+    if name is None:
+        name = os.environ.get("ROBOT_BACKEND", BACKEND_GOPIGO3)
+    name = name.strip().lower()
+
+    if name == BACKEND_GOPIGO3:
+        return GoPiGo3Backend()
+    elif name == BACKEND_SIMULATED:
+        spi_call_cost = float(os.environ.get("ROBOT_SIM_SPI_COST", DEFAULT_SPI_CALL_COST))
+        return SimulatedGoPiGo3(spi_call_cost = spi_call_cost)
+    else:
+        raise ValueError("Unknown robot backend: {}".format(name))
@@ -0,0 +1,170 @@
+#
+#  New Remote Camera Robot - metrics
+#
+#  Until now the only way to see what the robot was doing was to read the print() output.
+#  That doesn't tell us where the time goes when the robot is busy, (is it the web request,
+#  the command processing, the SPI calls to the motors, or sending video?)
+#
+#  This is a very small Prometheus-style metrics library:
+#    * Counter   - a number that only goes up, (frames published, writes issued)
+#    * Gauge     - a number that goes up and down, (connected stream clients)
+#    * Histogram - counts of values in fixed buckets, plus their sum, (latencies)
+#  The metrics are created once, when a module is imported, and are shared through "registry".
+#  render() formats all of them in the Prometheus text format for the /metrics route.
+#
+#  Updating a metric is on the hot path, (every command, every frame, every SPI call), so it is
+#  kept as cheap as possible: no allocation, a bisect for the bucket, and one uncontended lock.
+#  The cumulative bucket counts Prometheus wants are only worked out when /metrics is read.
+
+from bisect import bisect_left
+from threading import Lock
+
+#  Latency buckets, in seconds, from 50 microseconds to a second.
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+#  Numbers the way Prometheus writes them.
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+#  {name="value",...} for a dict of labels.
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = ['{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+               for key, value in labels.items()]
+    return "{" + ",".join(escaped) + "}"
+
+
+class Counter(object):
+    '''
+    A value that only ever increases.
+    '''
+    def __init__(self, name, labels = None):
+        self.name = name
+        self.labels = labels or {}
+        self.lock = Lock()
+        self.value = 0
+
+    def inc(self, amount = 1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, self.labels, self.value)]
+
+
+class Gauge(object):
+    '''
+    A value that can go up and down.
+    If "function" is given, it is called to get the value whenever the metrics are read.
+    '''
+    def __init__(self, name, labels = None, function = None):
+        self.name = name
+        self.labels = labels or {}
+        self.function = function
+        self.lock = Lock()
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount = 1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount = 1):
+        with self.lock:
+            self.value -= amount
+
+    def samples(self):
+        value = self.function() if self.function is not None else self.value
+        return [(self.name, self.labels, value)]
+
+
+class Histogram(object):
+    '''
+    Counts observed values in fixed buckets, (upper bounds, in increasing order).
+    '''
+    def __init__(self, name, labels = None, buckets = DEFAULT_BUCKETS):
+        self.name = name
+        self.labels = labels or {}
+        self.buckets = tuple(buckets)
+        self.lock = Lock()
+        self.counts = [0] * (len(self.buckets) + 1)  #  the last one is for values above every bucket
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        result = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            result.append((self.name + "_bucket", dict(self.labels, le = format_value(bound)), cumulative))
+        result.append((self.name + "_sum", self.labels, total))
+        result.append((self.name + "_count", self.labels, cumulative))
+        return result
+
+
+class MetricsRegistry(object):
+    '''
+    All the metrics, by name.  Several metrics can share a name if their labels differ,
+    (e.g. one latency histogram for each kind of hardware call).
+    Asking for a metric that already exists returns the existing one.
+    '''
+    def __init__(self):
+        self.lock = Lock()
+        self.families = {}  #  name -> [kind, help, {label items: metric}]
+
+    def _register(self, factory, kind, name, help_text, labels, **kwargs):
+        key = tuple(sorted((labels or {}).items()))
+        with self.lock:
+            family = self.families.setdefault(name, [kind, help_text, {}])
+            if family[0] != kind:
+                raise ValueError("Metric {} is already registered as a {}".format(name, family[0]))
+            metric = family[2].get(key)
+            if metric is None:
+                metric = factory(name, labels = labels, **kwargs)
+                family[2][key] = metric
+            return metric
+
+    def counter(self, name, help_text, labels = None):
+        return self._register(Counter, "counter", name, help_text, labels)
+
+    def gauge(self, name, help_text, labels = None, function = None):
+        return self._register(Gauge, "gauge", name, help_text, labels, function = function)
+
+    def histogram(self, name, help_text, labels = None, buckets = DEFAULT_BUCKETS):
+        return self._register(Histogram, "histogram", name, help_text, labels, buckets = buckets)
+
+    #  All the metrics in the Prometheus text exposition format.
+    def render(self):
+        with self.lock:
+            families = sorted((name, family[0], family[1], list(family[2].values()))
+                              for name, family in self.families.items())
+        lines = []
+        for name, kind, help_text, metrics in families:
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for metric in metrics:
+                for sample_name, labels, value in metric.samples():
+                    lines.append("{}{} {}".format(sample_name, format_labels(labels), format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+#  The metrics for the whole robot.
+registry = MetricsRegistry()
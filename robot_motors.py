@@ -0,0 +1,113 @@
+#
+#  New Remote Camera Robot - motor output stage
+#
+#  Every joystick message used to end in two set_motor_dps calls, (or a stop), even when the
+#  wheel speeds were exactly the same as the last time.  On the robot each of those calls is
+#  a mutex-guarded SPI transaction, so while cruising at a steady speed we were keeping the
+#  SPI bus and the mutex busy for nothing.
+#
+#  MotorOutput sits between the command processing and the hardware backend:
+#    * it remembers the last speed sent to each wheel and skips writes that wouldn't change anything
+#    * both wheels are updated together under one lock, so two web requests can't interleave
+#      their left and right wheel writes
+#    * if both wheels get the same speed, it is sent as one call to MOTOR_LEFT + MOTOR_RIGHT
+#    * it counts the writes issued and the writes suppressed
+#    * it times every call to the hardware, (robot_hardware_call_seconds in /metrics)
+
+from threading import Lock
+from time import monotonic
+
+from robot_metrics import registry
+
+set_motor_dps_seconds = registry.histogram("robot_hardware_call_seconds",
+                                           "Time taken by each call to the motors or servos",
+                                           labels = {"call": "set_motor_dps"})
+stop_seconds = registry.histogram("robot_hardware_call_seconds",
+                                  "Time taken by each call to the motors or servos",
+                                  labels = {"call": "stop"})
+
+
+class MotorOutput(object):
+    '''
+    Deduplicating, atomic wheel speed output.
+    "backend" is anything with the EasyGoPiGo3 set_motor_dps/stop interface.
+    '''
+    def __init__(self, backend):
+        self.backend = backend
+        self.lock = Lock()
+        self.left_dps = None  #  None means "unknown", the next write always goes through
+        self.right_dps = None
+        self.stopped = False  #  True after stop(), (the motors are floating, not holding 0 dps)
+        self.writes_issued = 0
+        self.writes_suppressed = 0
+
+    #  Set both wheel speeds, in degrees per second.
+    #  Returns True if anything was sent to the motors.
+    def set_wheels(self, left_dps, right_dps):
+        with self.lock:
+            left_changed = self.stopped or left_dps != self.left_dps
+            right_changed = self.stopped or right_dps != self.right_dps
+
+            if left_changed and right_changed and left_dps == right_dps:
+                self._set_motor_dps(self.backend.MOTOR_LEFT + self.backend.MOTOR_RIGHT, left_dps)
+                self.writes_suppressed += 1
+            else:
+                if left_changed:
+                    self._set_motor_dps(self.backend.MOTOR_LEFT, left_dps)
+                else:
+                    self.writes_suppressed += 1
+                if right_changed:
+                    self._set_motor_dps(self.backend.MOTOR_RIGHT, right_dps)
+                else:
+                    self.writes_suppressed += 1
+
+            self.left_dps = left_dps
+            self.right_dps = right_dps
+            self.stopped = False
+            return left_changed or right_changed
+
+    #  Stop both motors.
+    #  "force" sends the stop even if the motors are already stopped,
+    #  (used for shutdown and other "make absolutely sure" cases).
+    def stop(self, force = False):
+        with self.lock:
+            if self.stopped and not force:
+                self.writes_suppressed += 1
+                return False
+            start = monotonic()
+            self.backend.stop()
+            stop_seconds.observe(monotonic() - start)
+            self.writes_issued += 1
+            self.left_dps = 0
+            self.right_dps = 0
+            self.stopped = True
+            return True
+
+    #  The lock must be held.
+    def _set_motor_dps(self, port, dps):
+        start = monotonic()
+        self.backend.set_motor_dps(port, dps)
+        set_motor_dps_seconds.observe(monotonic() - start)
+        self.writes_issued += 1
+
+    #  Forget the remembered speeds, (use if something else has written to the motors).
+    def invalidate(self):
+        with self.lock:
+            self.left_dps = None
+            self.right_dps = None
+            self.stopped = False
+
+    def reset_counters(self):
+        with self.lock:
+            self.writes_issued = 0
+            self.writes_suppressed = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "left_dps": self.left_dps,
+                "right_dps": self.right_dps,
+                "stopped": self.stopped,
+                "writes_issued": self.writes_issued,
+                "writes_suppressed": self.writes_suppressed,
+            }
@@ -0,0 +1,175 @@
+#
+#  New Remote Camera Robot - sampling profiler
+#
+#  When the robot gets sluggish in the field there was no way to see what it was doing without
+#  stopping it, (and the problem usually went away when it was restarted).
+#
+#  StackSampler looks at the Python stack of every thread, (the web server's request threads,
+#  the stream server and broadcaster, the camera, the drive control loop, the main loop...),
+#  "rate" times a second for "seconds", from the thread that asked for the profile, and counts
+#  how often each stack was seen.  Nothing is added to the code being profiled, so it costs nothing until it is used,
+#  and only the sampling itself while it runs, (reported as "sampler_seconds").
+#
+#  The result is:
+#    * "collapsed" - one line per distinct stack, "thread;outermost;...;innermost count", which
+#      is what flamegraph.pl, speedscope and most other flame graph tools read
+#    * "threads"   - the CPU time each thread used while the profile was running, (a thread can
+#      be seen in many samples while using no CPU, e.g. waiting for a socket), and the samples
+#      it was seen in
+#
+#  Only one profile runs at a time.  See the /debug/profile route and the SIGUSR1 handler in
+#  New_Remote_Camera_Robot.py.
+
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+from collections import Counter
+from threading import Lock, Thread
+from time import clock_gettime, monotonic, pthread_getcpuclockid, sleep, strftime
+
+MAX_SECONDS = 60
+MAX_RATE = 1000
+
+profile_lock = Lock()
+
+
+class ProfilerBusyError(Exception):
+    '''
+    Another profile is already running.
+    '''
+    pass
+
+
+#  {thread ident: CPU seconds used so far} for every thread started by the threading module.
+def thread_cpu_times():
+    times = {}
+    for thread in threading.enumerate():
+        try:
+            times[thread.ident] = clock_gettime(pthread_getcpuclockid(thread.ident))
+        except (OSError, TypeError):
+            pass  #  finished, or not started yet
+    return times
+
+
+#  "function (file:line)" for a stack frame, line being where the function starts, so every
+#  sample in a function is counted in the same place.
+def frame_label(frame):
+    code = frame.f_code
+    return "{} ({}:{})".format(getattr(code, "co_qualname", code.co_name),
+                               os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class StackSampler(object):
+    '''
+    Samples the stack of every thread "rate" times a second for "seconds".
+    '''
+    def __init__(self, seconds = 10.0, rate = 100.0):
+        if not 0 < seconds <= MAX_SECONDS:
+            raise ValueError("seconds must be more than 0 and at most {}".format(MAX_SECONDS))
+        if not 0 < rate <= MAX_RATE:
+            raise ValueError("rate must be more than 0 and at most {}".format(MAX_RATE))
+        self.seconds = seconds
+        self.rate = rate
+
+    #  Run the profile, (in the calling thread, which isn't sampled), and return the result.
+    #  Raises ProfilerBusyError if another profile is running.
+    def run(self):
+        if not profile_lock.acquire(blocking = False):
+            raise ProfilerBusyError("A profile is already running")
+        try:
+            return self._sample()
+        finally:
+            profile_lock.release()
+
+    def _sample(self):
+        me = threading.get_ident()
+        interval = 1.0 / self.rate
+        stacks = Counter()
+        thread_samples = Counter()
+        names = {}
+        samples = 0
+        sampler_seconds = 0.0
+
+        cpu_before = thread_cpu_times()
+        usage_before = resource.getrusage(resource.RUSAGE_SELF)
+        start = monotonic()
+        end = start + self.seconds
+        next_sample = start
+        while True:
+            now = monotonic()
+            if now >= end:
+                break
+            if next_sample > now:
+                sleep(next_sample - now)
+            sample_start = monotonic()
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            frames = sys._current_frames()
+            for ident, frame in frames.items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_label(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, "thread {}".format(ident)))
+                stack.reverse()
+                stacks[";".join(stack)] += 1
+                thread_samples[ident] += 1
+            del frames
+            samples += 1
+            sampler_seconds += monotonic() - sample_start
+            #  If a sample was late, carry on from now rather than catching up in a burst
+            next_sample = max(next_sample + interval, monotonic())
+        elapsed = monotonic() - start
+        usage_after = resource.getrusage(resource.RUSAGE_SELF)
+        cpu_after = thread_cpu_times()
+
+        threads = []
+        for ident in (set(cpu_after) | set(thread_samples)) - {me}:
+            cpu = cpu_after.get(ident, cpu_before.get(ident, 0.0)) - cpu_before.get(ident, 0.0)
+            threads.append({
+                "name": names.get(ident, "thread {}".format(ident)),
+                "ident": ident,
+                "cpu_seconds": round(cpu, 4),
+                "cpu_percent": round(cpu / elapsed * 100.0, 1),
+                "samples": thread_samples[ident],
+            })
+        threads.sort(key = lambda thread: thread["cpu_seconds"], reverse = True)
+        process_cpu = ((usage_after.ru_utime - usage_before.ru_utime)
+                       + (usage_after.ru_stime - usage_before.ru_stime))
+        return {
+            "seconds": round(elapsed, 3),
+            "rate_hz": self.rate,
+            "samples": samples,
+            "sampler_seconds": round(sampler_seconds, 4),
+            "process_cpu_percent": round(process_cpu / elapsed * 100.0, 1),
+            "threads": threads,
+            "collapsed": "".join("{} {}\n".format(stack, count) for stack, count in stacks.most_common()),
+        }
+
+
+#  Run a profile in the background and write it to "directory" as profile-<time>.collapsed,
+#  (the stacks), and profile-<time>.json, (everything).  For when the web server isn't answering.
+def save_profile_in_background(directory, seconds = 10.0, rate = 100.0):
+    def save():
+        try:
+            result = StackSampler(seconds, rate).run()
+        except ProfilerBusyError as e:
+            logging.warning("Not profiling: %s", str(e))
+            return
+        path = os.path.join(directory, strftime("profile-%Y%m%d-%H%M%S"))
+        try:
+            with open(path + ".collapsed", "w") as collapsed_file:
+                collapsed_file.write(result["collapsed"])
+            with open(path + ".json", "w") as json_file:
+                json.dump(result, json_file, indent = 1)
+        except OSError as e:
+            logging.error("Unable to save the profile: %s", str(e))
+            return
+        print("The profile was saved to", path + ".collapsed", "and", path + ".json")
+
+    Thread(target = save, name = "StackSampler", daemon = True).start()
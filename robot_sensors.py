@@ -0,0 +1,165 @@
+#
+#  New Remote Camera Robot - sensor sampler
+#
+#  The browser should be able to show the battery voltage and the processor's temperature, but
+#  reading the battery is an SPI transaction on the GoPiGo3, behind the same mutex as every
+#  set_motor_dps call.  Reading it whenever a browser asked would make the motors wait for it.
+#
+#  SensorSampler is a thread that reads each Sensor at its own interval, (e.g. the battery every
+#  2 seconds, the temperature every 5), and keeps:
+#    * the latest value, (and when it was read)
+#    * a short history, the last "history" readings, in a fixed-size ring
+#  Anything that wants the values, (the telemetry stream, /sensors, /metrics), gets them from
+#  here, so no request ever touches the hardware.
+#
+#  A sensor read over the SPI bus, ("uses_hardware"), never holds up a wheel speed change.
+#  Before reading, it checks the motors' lock, ("hardware_lock"): if the motors are being
+#  written, the read is put off and tried again retry_interval seconds later, (for up to
+#  max_defer seconds, then it reads anyway).  The lock isn't held during the read, so a wheel
+#  speed change only ever waits for the SPI transfer itself, not for the whole read.
+#  Every deferral is counted, and so is every failed read.  A read that raises anything at
+#  all is counted and logged, and the sampler carries on.
+
+import logging
+from collections import deque
+from threading import Event, Lock, Thread
+from time import monotonic, time
+
+from robot_metrics import registry
+
+read_errors_total = registry.counter("robot_sensor_read_errors_total", "Sensor reads that failed")
+deferred_reads_total = registry.counter("robot_sensor_reads_deferred_total",
+                                        "Sensor reads put off because the motors were being written")
+
+#  Where Linux, (and the Raspberry Pi), reports the processor's temperature, in thousandths of a degree
+CPU_TEMPERATURE_PATH = "/sys/class/thermal/thermal_zone0/temp"
+
+#  A failed read is logged the first time, then every this many failures
+ERROR_LOG_INTERVAL = 100
+
+
+#  The processor's temperature, in degrees Celsius.
+def read_cpu_temperature(path = CPU_TEMPERATURE_PATH):
+    with open(path) as temperature_file:
+        return int(temperature_file.read()) / 1000.0
+
+
+class Sensor(object):
+    '''
+    One value read every "interval" seconds by calling "read", (which returns None if there's
+    nothing to read yet, and raises an exception if the read failed).
+    "uses_hardware" means the read goes over the GoPiGo3's SPI bus.
+    '''
+    def __init__(self, name, read, interval, history = 60, uses_hardware = False, digits = 2):
+        self.name = name
+        self.read = read
+        self.interval = interval
+        self.uses_hardware = uses_hardware
+        self.digits = digits
+        self.value = None
+        self.read_at = None  #  time() of the latest reading
+        self.history = deque(maxlen = history)  #  (time(), value) of the latest readings
+        self.next_read = 0.0  #  monotonic() time the next reading is due
+        self.deferred_since = None  #  monotonic() time the motors first put off the current reading
+        self.errors = 0
+        self.read_seconds = registry.histogram("robot_sensor_read_seconds", "Time taken to read each sensor",
+                                               labels = {"sensor": name})
+        registry.gauge("robot_sensor_value", "The latest reading of each sensor", labels = {"sensor": name},
+                       function = lambda: self.value if self.value is not None else float("nan"))
+
+
+class SensorSampler(Thread):
+    '''
+    Reads every sensor in "sensors" at its own interval, and keeps the readings.
+    hardware_lock  - held while the motors are being written, (None: never defer)
+    max_defer      - the longest a hardware read is put off for it
+    retry_interval - how soon a read that was put off is tried again
+    on_update      - called with {name: value} after every successful reading
+    '''
+    def __init__(self, sensors, hardware_lock = None, max_defer = 0.5, retry_interval = 0.02, on_update = None):
+        Thread.__init__(self, name = "SensorSampler", daemon = True)
+        self.sensors = list(sensors)
+        self.hardware_lock = hardware_lock
+        self.max_defer = max_defer
+        self.retry_interval = retry_interval
+        self.on_update = on_update
+        self.lock = Lock()
+        self.stopping = Event()
+        self.deferred_reads = 0
+
+    def stop(self, timeout = None):
+        self.stopping.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        while not self.stopping.is_set():
+            for sensor in self.sensors:
+                if sensor.next_read <= monotonic():
+                    if self._motors_busy(sensor):
+                        sensor.next_read = monotonic() + self.retry_interval
+                        continue
+                    self._read(sensor)
+                    #  Keep to the interval, unless we've fallen behind it
+                    sensor.next_read = max(sensor.next_read + sensor.interval, monotonic())
+            next_read = min(sensor.next_read for sensor in self.sensors)
+            self.stopping.wait(max(0.0, next_read - monotonic()))
+
+    #  True if "sensor" should wait because the motors are being written right now,
+    #  (unless it has already waited max_defer seconds).
+    def _motors_busy(self, sensor):
+        if not sensor.uses_hardware or self.hardware_lock is None:
+            return False
+        if self.hardware_lock.acquire(blocking = False):
+            self.hardware_lock.release()
+        elif sensor.deferred_since is None or monotonic() - sensor.deferred_since < self.max_defer:
+            if sensor.deferred_since is None:
+                sensor.deferred_since = monotonic()
+            self.deferred_reads += 1
+            deferred_reads_total.inc()
+            return True
+        sensor.deferred_since = None
+        return False
+
+    def _read(self, sensor):
+        start = monotonic()
+        try:
+            value = sensor.read()
+            if value is not None:
+                value = round(value, sensor.digits)
+        except Exception as e:
+            sensor.errors += 1
+            read_errors_total.inc()
+            if sensor.errors % ERROR_LOG_INTERVAL == 1:
+                logging.warning("Unable to read the %s, (%d failed reads): %s: %s",
+                                sensor.name, sensor.errors, type(e).__name__, str(e))
+            return
+        sensor.read_seconds.observe(monotonic() - start)
+        if value is None:
+            return
+
+        with self.lock:
+            sensor.value = value
+            sensor.read_at = round(time(), 3)
+            sensor.history.append((sensor.read_at, value))
+        if self.on_update is not None:
+            self.on_update({sensor.name: value})
+
+    #  {name: latest value} for every sensor, (None if it hasn't been read yet).
+    def latest(self):
+        with self.lock:
+            return {sensor.name: sensor.value for sensor in self.sensors}
+
+    #  Everything about every sensor, including its history.
+    def status(self):
+        with self.lock:
+            return {
+                sensor.name: {
+                    "value": sensor.value,
+                    "read_at": sensor.read_at,
+                    "interval": sensor.interval,
+                    "errors": sensor.errors,
+                    "history": list(sensor.history),
+                }
+                for sensor in self.sensors
+            }
@@ -0,0 +1,126 @@
+#
+#  New Remote Camera Robot - head servo actuator
+#
+#  Moving Charlie's head used to be done inline: rotate both servos, sleep(0.25) to let them
+#  get there, then disable them so they don't buzz and waste power.  Doing that inside the
+#  /robot request handler tied the request up for a quarter of a second per keypress.
+#
+#  The ServoActuator is a thread that owns both head servos.  move_to() just records the new
+#  target and returns immediately.  If several targets arrive before the thread gets to them,
+#  only the latest one is used, so a burst of keypresses becomes one movement.
+#  The servos stay powered while the head is moving and are disabled once no new target
+#  has arrived for "hold_time" seconds.
+#  Every servo call is timed, (robot_hardware_call_seconds in /metrics).
+
+import logging
+from threading import Condition, Thread
+from time import monotonic
+
+from robot_metrics import registry
+
+rotate_servo_seconds = registry.histogram("robot_hardware_call_seconds",
+                                          "Time taken by each call to the motors or servos",
+                                          labels = {"call": "rotate_servo"})
+disable_servo_seconds = registry.histogram("robot_hardware_call_seconds",
+                                           "Time taken by each call to the motors or servos",
+                                           labels = {"call": "disable_servo"})
+
+
+class ServoActuator(Thread):
+    '''
+    Thread that moves the head servos.
+    hservo is the horizontal, (pan), servo and vservo the vertical, (tilt), servo.
+    '''
+    def __init__(self, hservo, vservo, hold_time = 0.25):
+        Thread.__init__(self, name = "ServoActuator", daemon = True)
+        self.hservo = hservo
+        self.vservo = vservo
+        self.hold_time = hold_time
+        self.condition = Condition()
+        self.pending = None  #  the latest (hpos, vpos) target not yet sent to the servos
+        self.position = None  #  the last (hpos, vpos) sent to the servos
+        self.powered = False  #  True while the servos are enabled
+        self.moved_at = 0.0  #  monotonic() time of the last movement
+        self.stopping = False
+
+        #  Every target gets a number so that callers can wait for "their" movement to finish.
+        self.requested = 0  #  number of targets requested
+        self.applied = 0  #  number of the last target sent to the servos
+        self.settled = 0  #  number of the last target that has finished moving
+        self.moves = 0  #  number of times the servos were actually moved
+
+    #  Ask for the head to be moved.  Returns immediately.
+    def move_to(self, hpos, vpos):
+        with self.condition:
+            self.pending = (hpos, vpos)
+            self.requested += 1
+            self.condition.notify_all()
+
+    #  Wait until the latest requested movement has finished and the servos are disabled.
+    #  Returns False if "timeout" seconds pass first.
+    def wait_settled(self, timeout = None):
+        with self.condition:
+            target = self.requested
+            return self.condition.wait_for(lambda: self.settled >= target or not self.is_alive(), timeout)
+
+    #  Finish any movement in progress, disable the servos and end the thread.
+    def stop(self, timeout = None):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        with self.condition:
+            while True:
+                if self.pending is not None:
+                    target = self.pending
+                    target_id = self.requested
+                    self.pending = None
+                    if target != self.position or not self.powered:
+                        self.condition.release()
+                        try:
+                            start = monotonic()
+                            self.hservo.rotate_servo(target[0])
+                            middle = monotonic()
+                            self.vservo.rotate_servo(target[1])
+                            rotate_servo_seconds.observe(middle - start)
+                            rotate_servo_seconds.observe(monotonic() - middle)
+                        except Exception as e:
+                            logging.warning("Unable to move head servos: %s", str(e))
+                        finally:
+                            self.condition.acquire()
+                        self.position = target
+                        self.moves += 1
+                    self.applied = target_id
+                    self.powered = True
+                    self.moved_at = monotonic()
+                    continue
+
+                if self.powered:
+                    remaining = self.moved_at + self.hold_time - monotonic()
+                    if remaining > 0:
+                        self.condition.wait(remaining)
+                        continue
+                    self.condition.release()
+                    try:
+                        start = monotonic()
+                        self.hservo.disable_servo()
+                        middle = monotonic()
+                        self.vservo.disable_servo()
+                        disable_servo_seconds.observe(middle - start)
+                        disable_servo_seconds.observe(monotonic() - middle)
+                    except Exception as e:
+                        logging.warning("Unable to disable head servos: %s", str(e))
+                    finally:
+                        self.condition.acquire()
+                    self.powered = False
+                    self.settled = self.applied
+                    self.condition.notify_all()
+                    continue
+
+                if self.stopping:
+                    self.condition.notify_all()
+                    return
+                self.condition.wait()
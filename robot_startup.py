@@ -0,0 +1,192 @@
+#
+#  New Remote Camera Robot - startup sequence
+#
+#  The robot used to start everything one after the other: restart nginx, (and wait for it),
+#  start the camera, sleep, start the stream server, sleep, start the web server, sleep,
+#  then shake the head for over a second, and only then say it was ready.  None of the
+#  sleeps checked anything, they just hoped that a quarter of a second was long enough.
+#
+#  StartupSequence runs each "phase" in its own thread, so everything that doesn't depend
+#  on something else starts at once.  A phase function returns when its service is really
+#  ready, (a web server answers a request, the camera has produced a frame), or raises.
+#  The time each phase waited for, and took, is kept for the startup report and /ready.
+#
+#  Some phases are marked "required": the robot is drivable, (/ready returns 200), as soon as
+#  all of those are ready, even if the video or the head shake are still getting going.
+
+import http.client
+import logging
+from threading import Condition, Thread
+from time import monotonic, sleep
+
+WAITING = "waiting"
+RUNNING = "running"
+READY = "ready"
+FAILED = "failed"
+
+
+class StartupError(Exception):
+    '''
+    A phase failed.  "exit_code" is what the program should exit with.
+    '''
+    def __init__(self, message, exit_code = 1):
+        Exception.__init__(self, message)
+        self.exit_code = exit_code
+
+
+class StartupPhase(object):
+    '''
+    One step of the startup sequence, and how it went.
+    '''
+    def __init__(self, name, function, after, required, exit_code):
+        self.name = name
+        self.function = function
+        self.after = tuple(after)  #  names of the phases that must be ready first
+        self.required = required  #  the robot isn't drivable until this phase is ready
+        self.exit_code = exit_code  #  used if the function raises something other than StartupError
+        self.state = WAITING
+        self.started = None  #  monotonic() times
+        self.finished = None
+        self.error = None
+
+    def status(self, sequence_start):
+        status = {"state": self.state, "required": self.required}
+        if self.started is not None:
+            status["started_at"] = round(self.started - sequence_start, 3)
+        if self.finished is not None:
+            status["seconds"] = round(self.finished - self.started, 3)
+        if self.error is not None:
+            status["error"] = str(self.error)
+        return status
+
+
+class StartupSequence(object):
+    '''
+    Runs the startup phases concurrently, each as soon as the phases it depends on are ready.
+    '''
+    def __init__(self):
+        self.phases = []
+        self.condition = Condition()
+        self.started = None
+        self.drivable_at = None  #  monotonic() time all the required phases were ready
+
+    def add(self, name, function, after = (), required = False, exit_code = 1):
+        self.phases.append(StartupPhase(name, function, after, required, exit_code))
+
+    def start(self):
+        self.started = monotonic()
+        names = {phase.name for phase in self.phases}
+        for phase in self.phases:
+            for dependency in phase.after:
+                if dependency not in names:
+                    raise ValueError("Startup phase {} depends on unknown phase {}".format(phase.name, dependency))
+        for phase in self.phases:
+            Thread(target = self._run, args = (phase,), name = "Startup " + phase.name, daemon = True).start()
+
+    #  Wait until every phase is ready or has failed.  Returns False on timeout.
+    def wait(self, timeout = None):
+        with self.condition:
+            return self.condition.wait_for(self.finished, timeout)
+
+    def finished(self):
+        return all(phase.state in (READY, FAILED) for phase in self.phases)
+
+    #  The first phase that failed, or None.
+    def failure(self):
+        failed = [phase for phase in self.phases if phase.state == FAILED]
+        return min(failed, key = lambda phase: phase.finished) if failed else None
+
+    #  Not until the sequence has started, and there's at least one required phase, (all ready).
+    def drivable(self):
+        required = [phase for phase in self.phases if phase.required]
+        return self.started is not None and len(required) > 0 and all(phase.state == READY for phase in required)
+
+    #  Everything /ready reports.
+    def status(self):
+        with self.condition:
+            start = self.started if self.started is not None else monotonic()
+            status = {
+                "drivable": self.drivable(),
+                "finished": self.finished(),
+                "uptime": round(monotonic() - start, 3),
+                "phases": {phase.name: phase.status(start) for phase in self.phases},
+            }
+            if self.drivable_at is not None:
+                status["drivable_after"] = round(self.drivable_at - start, 3)
+            return status
+
+    #  The per-phase timings, for printing.
+    def report(self):
+        status = self.status()
+        lines = ["Startup phases:"]
+        for name, phase in status["phases"].items():
+            line = "    {:<16} {:<8}".format(name, phase["state"])
+            if "seconds" in phase:
+                line += " started at {:6.3f}s, took {:6.3f}s".format(phase["started_at"], phase["seconds"])
+            if "error" in phase:
+                line += " - " + phase["error"]
+            lines.append(line)
+        if "drivable_after" in status:
+            lines.append("The robot was drivable {:.3f} seconds after startup began.".format(status["drivable_after"]))
+        return "\n".join(lines)
+
+    def _run(self, phase):
+        with self.condition:
+            self.condition.wait_for(lambda: self._dependencies_done(phase))
+            blocked = [name for name in phase.after if self._phase(name).state != READY]
+            phase.started = monotonic()
+            if blocked:
+                phase.state = FAILED
+                phase.error = "not started, {} failed".format(", ".join(blocked))
+                phase.finished = phase.started
+                self.condition.notify_all()
+                return
+            phase.state = RUNNING
+
+        try:
+            phase.function()
+            state, error = READY, None
+        except Exception as e:
+            logging.error("Startup phase %s failed: %s", phase.name, str(e))
+            state, error = FAILED, e
+
+        with self.condition:
+            phase.finished = monotonic()
+            phase.state = state
+            phase.error = error
+            if self.drivable_at is None and self.drivable():
+                self.drivable_at = phase.finished
+            self.condition.notify_all()
+
+    def _phase(self, name):
+        for phase in self.phases:
+            if phase.name == name:
+                return phase
+
+    def _dependencies_done(self, phase):
+        return all(self._phase(name).state in (READY, FAILED) for name in phase.after)
+
+    #  What the program should exit with, because of "phase" failing.
+    @staticmethod
+    def exit_code(phase):
+        if isinstance(phase.error, StartupError):
+            return phase.error.exit_code
+        return phase.exit_code
+
+
+#  Wait until an HTTP server on localhost answers a request for "path".
+#  Any response at all counts, it only has to be up.
+def wait_for_http(port, path = "/", timeout = 10.0, host = "127.0.0.1"):
+    deadline = monotonic() + timeout
+    while True:
+        connection = http.client.HTTPConnection(host, port, timeout = 1.0)
+        try:
+            connection.request("GET", path)
+            connection.getresponse().read()
+            return
+        except (OSError, http.client.HTTPException) as e:
+            if monotonic() > deadline:
+                raise StartupError("Nothing answering on port {}: {}".format(port, str(e)))
+        finally:
+            connection.close()
+        sleep(0.01)
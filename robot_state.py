@@ -0,0 +1,176 @@
+#
+#  New Remote Camera Robot - robot state
+#
+#  The robot's state used to be one module-level dict, ("robot"), read and written by the web
+#  server's request threads, the drive control loop, the head routines and the shutdown code,
+#  with no locking at all.  A reader could see a command half applied, (the new x_axis with the
+#  old y_axis), and every access was a string-keyed dict lookup.
+#
+#  RobotState splits the state into groups, each a small class with __slots__:
+#    * command  - what the browser last asked for, (CommandState)
+#    * drive    - what drive_robot worked out from it, (DriveState)
+#    * head     - where the head has been told to go, (HeadState)
+#    * settings - speeds and calibration that don't change while running, (RobotSettings)
+#
+#  Writers change the state inside "with robot.writing():".  Writers are serialized by a lock,
+#  and the state's "version" is odd while a write is in progress.  A write section only works
+#  out and stores new values: the motor and servo calls, file writes and anything else slow
+#  happen after it, so a write section never lasts longer than a few assignments.  Write
+#  sections don't nest, (the lock isn't re-entrant), and snapshot() can't be called inside one.
+#
+#  Readers that need several values that belong together, (telemetry, metrics), use snapshot().
+#  It never takes the lock: it copies each group's slots into a tuple, (a namedtuple, so the
+#  values are read as snapshot.command.x_axis), and if the version was odd or has changed in
+#  the meantime, it tries again, (a "seqlock").  So a slow reader can never hold up the drive
+#  control loop or a command.  Reading a single value is just an attribute access.
+#  The latest snapshot is kept along with its version, so until the next write, (the robot
+#  spends most of its time between commands), snapshot() just returns it again.
+#  The settings don't change while running, so they aren't part of the snapshot.
+
+from collections import namedtuple
+from operator import attrgetter
+from threading import Lock
+from time import sleep
+
+
+class CommandState(object):
+    '''
+    The latest joystick command from the browser.
+    '''
+    __slots__ = ("controller_status", "motion_state", "direction", "time_stamp",
+                 "x_axis", "y_axis", "head_x_axis", "head_y_axis", "force",
+                 "trigger_1", "trigger_2", "head_enable", "command_time", "seq")
+
+    def __init__(self):
+        self.controller_status = "Disconnected"
+        self.motion_state = "Waiting for Joystick"
+        self.direction = "None"
+        self.time_stamp = 0  # a large integer that, (sometimes), becomes a float (shrug shoulders)
+        self.x_axis = 0.00  #  x-axis < 0, joystick pushed left - x-axis > 0, joystick pushed right
+        self.y_axis = 0.00  # y-axis < 0, joystick pushed forward - y-axis > 0 , joystick pullled back
+        self.head_x_axis = 0.00  #  head x and y axes mirror the joystick x and y axes
+        self.head_y_axis = 0.00  #  if the pinky-switch, (head motion enable), is pressed
+        self.force = 0.00  #  force is the absolute value of the y-axis deflection
+        self.trigger_1 = 0   # Partial primary trigger press (motion enabled)
+        self.trigger_2 = 0   # Full primary trigger press enables a faster, (turbo), speed
+        self.head_enable = 0  #  The "pinky switch" is used as a head-motion-enable switch. The value is captured here.
+        self.command_time = 0.0  #  monotonic() time the last command arrived from the browser
+        self.seq = None  #  its sequence number, (None if it hadn't got one)
+
+
+class DriveState(object):
+    '''
+    The speeds drive_robot derived from the latest command, and when it did so.
+    '''
+    __slots__ = ("speed", "desired_speed", "differential_speed",
+                 "actuated_command_time", "actuated_seq", "actuated_time", "actuation_lag")
+
+    def __init__(self):
+        self.speed = 0  # this represents the currently selected maximum, either normal or turbo speed
+        self.desired_speed = 0  #  This is the adjusted speed based on joystick force.
+        self.differential_speed = 0  #  This is the fractional part of the desired speed used for making turns.
+        self.actuated_command_time = 0.0  #  command_time of the last command drive_robot applied to the motors
+        self.actuated_seq = None  #  and its sequence number
+        self.actuated_time = 0.0  #  monotonic() time it was applied
+        self.actuation_lag = 0.0  #  seconds from that command arriving to it being applied
+
+
+class HeadState(object):
+    '''
+    The position the head servos were last told to go to.
+    '''
+    __slots__ = ("vposition", "hposition")
+
+    def __init__(self):
+        self.vposition = 92  #  The current angular setting for the vertical angle servo
+        self.hposition = 88  #  The current angular setting for the horizontal angle servo
+
+
+class RobotSettings(object):
+    '''
+    Speeds and calibration.
+    '''
+    __slots__ = ("normal_speed", "turbo_speed", "reverse_speed_offset",
+                 "vcenter", "hcenter", "servo_step_size")
+
+    def __init__(self):
+        self.normal_speed = 150  #  Max speed if the trigger is pressed half-way
+        self.turbo_speed = 300  #  Max speed if the trigger is fully pressed
+        self.reverse_speed_offset = 0.50
+        self.vcenter = 95  #  The "calibrated" positions for Charlie's head
+        self.hcenter = 86  #  to be centered in both axes.
+        self.servo_step_size = 5
+
+
+class StateWriter(object):
+    '''
+    The context manager returned by RobotState.writing().
+    '''
+    __slots__ = ("state",)
+
+    def __init__(self, state):
+        self.state = state
+
+    def __enter__(self):
+        state = self.state
+        state.lock.acquire()
+        state.version += 1  #  odd: a write is in progress
+        return state
+
+    def __exit__(self, *exc_info):
+        state = self.state
+        state.version += 1  #  even: the state is consistent again
+        state.lock.release()
+        return False
+
+
+#  What snapshot() returns: a tuple of each group's values, (e.g. snapshot.command.x_axis).
+CommandValues = namedtuple("CommandValues", CommandState.__slots__)
+DriveValues = namedtuple("DriveValues", DriveState.__slots__)
+HeadValues = namedtuple("HeadValues", HeadState.__slots__)
+RobotSnapshot = namedtuple("RobotSnapshot", ("command", "drive", "head"))
+
+#  Each of these reads every slot of a group at once, as a plain tuple
+get_command_values = attrgetter(*CommandState.__slots__)
+get_drive_values = attrgetter(*DriveState.__slots__)
+get_head_values = attrgetter(*HeadState.__slots__)
+
+
+class RobotState(object):
+    '''
+    All of the robot's state, with a seqlock for consistent snapshots.
+    '''
+    __slots__ = ("command", "drive", "head", "settings", "version", "lock", "writer_context", "last_snapshot")
+
+    def __init__(self):
+        self.command = CommandState()
+        self.drive = DriveState()
+        self.head = HeadState()
+        self.settings = RobotSettings()
+        self.version = 0
+        self.lock = Lock()
+        self.writer_context = StateWriter(self)
+        self.last_snapshot = (-1, None)  #  (version, snapshot) of the latest snapshot taken
+
+    #  "with robot.writing():" around every change to the state.
+    def writing(self):
+        return self.writer_context
+
+    #  A consistent copy of the command, drive and head values, as a RobotSnapshot.
+    #  Retries, (without blocking the writer), if a write happens while copying.
+    def snapshot(self, new = tuple.__new__):
+        version, snapshot = self.last_snapshot
+        if version == self.version:
+            return snapshot
+        while True:
+            version = self.version
+            if not version & 1:
+                command = get_command_values(self.command)
+                drive = get_drive_values(self.drive)
+                head = get_head_values(self.head)
+                if self.version == version:
+                    snapshot = new(RobotSnapshot, (new(CommandValues, command), new(DriveValues, drive),
+                                                   new(HeadValues, head)))
+                    self.last_snapshot = (version, snapshot)
+                    return snapshot
+            sleep(0)  #  let the writer finish
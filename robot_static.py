@@ -0,0 +1,130 @@
+#
+#  New Remote Camera Robot - static asset cache
+#
+#  Every page load used to read jQuery, throttle.js, New_Remote_Camera_Robot.js, the style sheet
+#  and the icon from the SD card, and send all of them uncompressed, (the page asked not to be
+#  cached).  Over a phone's cellular connection that's a few hundred KB every time the browser
+#  reconnects, before the robot can be driven.
+#
+#  StaticAssetCache keeps each file in memory after it is first read, along with:
+#    * a gzip compressed copy, (for text files where that is smaller)
+#    * a strong ETag, (a hash of the contents)
+#  and answers a conditional GET, (If-None-Match), with "304 Not Modified" and no body.
+#  The browser is asked to check back every time, ("Cache-Control: no-cache"), which costs one
+#  small request per file instead of the file itself.
+#
+#  Rendered templates are cached the same way, (see add()), since they don't change either.
+
+import gzip
+import hashlib
+import mimetypes
+import os
+from threading import Lock
+
+from flask import Response, abort
+from werkzeug.http import parse_accept_header
+
+#  File types worth compressing
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml",
+                      "image/x-icon", "image/vnd.microsoft.icon")
+
+
+#  Whether an Accept-Encoding header allows gzip, (its q-value, or a "*" one, is more than 0).
+#  "gzip;q=0" is a refusal, not an acceptance.
+def accepts_gzip(accept_encoding):
+    return parse_accept_header(accept_encoding)["gzip"] > 0
+
+
+class StaticAsset(object):
+    '''
+    One file, ready to send.
+    '''
+    __slots__ = ("data", "gzip_data", "etag", "gzip_etag", "content_type")
+
+    def __init__(self, data, content_type, compress = True):
+        self.data = data
+        self.content_type = content_type
+        digest = hashlib.sha1(data).hexdigest()[:20]
+        self.etag = '"{}"'.format(digest)
+        self.gzip_data = None
+        self.gzip_etag = None
+        if compress and content_type.startswith(COMPRESSIBLE_TYPES):
+            compressed = gzip.compress(data, compresslevel = 9, mtime = 0)
+            if len(compressed) < len(data):
+                self.gzip_data = compressed
+                #  A different representation must have a different strong ETag
+                self.gzip_etag = '"{}-gz"'.format(digest)
+
+
+class StaticAssetCache(object):
+    '''
+    Files under "root", loaded the first time they are asked for and then kept in memory.
+    '''
+    def __init__(self, root, cache_control = "no-cache"):
+        self.root = os.path.abspath(root)
+        self.cache_control = cache_control
+        self.lock = Lock()
+        self.assets = {}
+
+    #  The asset for "path", (relative to root), or None if there is no such file.
+    def get(self, path):
+        asset = self.assets.get(path)
+        if asset is not None:
+            return asset
+
+        full_path = os.path.abspath(os.path.join(self.root, path))
+        if not full_path.startswith(self.root + os.sep) or not os.path.isfile(full_path):
+            return None
+        with open(full_path, "rb") as asset_file:
+            data = asset_file.read()
+        content_type = mimetypes.guess_type(full_path)[0] or "application/octet-stream"
+        if content_type.startswith("text/") or content_type == "application/javascript":
+            content_type += "; charset=utf-8"
+        return self.add(path, data, content_type)
+
+    #  Cache "data" under "name", (e.g. a rendered template).
+    def add(self, name, data, content_type):
+        asset = StaticAsset(data, content_type)
+        with self.lock:
+            return self.assets.setdefault(name, asset)
+
+    #  Load every file under root now, rather than on the first request for it.
+    def preload(self):
+        for directory, subdirectories, files in os.walk(self.root):
+            for name in files:
+                self.get(os.path.relpath(os.path.join(directory, name), self.root))
+
+    def clear(self):
+        with self.lock:
+            self.assets.clear()
+
+    #  What to send for "asset", given the request's Accept-Encoding and If-None-Match headers,
+    #  as (status code, body, headers): 304 if the browser already has it, otherwise the gzip
+    #  version if the browser accepts it, otherwise the file as it is.
+    def representation(self, asset, accept_encoding = "", if_none_match = ""):
+        use_gzip = asset.gzip_data is not None and accepts_gzip(accept_encoding)
+        etag = asset.gzip_etag if use_gzip else asset.etag
+        headers = [("ETag", etag), ("Cache-Control", self.cache_control), ("Vary", "Accept-Encoding")]
+
+        if etag in if_none_match:
+            return 304, b"", headers
+        headers.append(("Content-Type", asset.content_type))
+        if use_gzip:
+            headers.append(("Content-Encoding", "gzip"))
+        return 200, asset.gzip_data if use_gzip else asset.data, headers
+
+    #  The Flask response for "asset" to "request".
+    def response(self, asset, request):
+        status, body, headers = self.representation(asset, request.headers.get("Accept-Encoding", ""),
+                                                    request.headers.get("If-None-Match", ""))
+        resp = Response(body, status = status)
+        for name, value in headers:
+            resp.headers[name] = value
+        return resp
+
+    #  The response for the file at "path", or 404.
+    def send(self, path, request):
+        asset = self.get(path)
+        if asset is None:
+            abort(404)
+        return self.response(asset, request)
@@ -0,0 +1,313 @@
+#
+#  New Remote Camera Robot - MJPEG stream broadcaster
+#
+#  Originally every /stream.mjpg viewer had its own thread, waiting for the next frame and then
+#  sitting in a blocking write until the whole frame had been sent, formatting the part headers
+#  with send_header every time.  With a pilot, a few spectators and a recorder all watching,
+#  that's a lot of threads fighting over the GIL on a Raspberry Pi.
+#
+#  The StreamBroadcaster is one thread that owns all the stream sockets:
+#    * StreamingHandler sends the HTTP response headers and then hands its socket over
+#    * when the camera publishes a frame, the multipart header for it is built once
+#    * the same header and frame buffer, (no copies), are sent to every client with
+#      non-blocking writes whenever a client's socket can take more data
+#
+#  The frames are sent straight out of StreamingOutput's frame ring, so every client holds the
+#  frame it is sending, (and the one waiting), until it's done with it, and the camera writes
+#  the next frames around it instead of over it.
+#
+#  A viewer on a slow link must never fall behind the camera, otherwise the picture gets
+#  older and older and is useless for driving.  So each client only ever has:
+#    * the frame it is sending right now, and
+#    * the newest frame published since then, (a newer frame replaces it and it is "dropped")
+#  A client can also ask for a lower frame rate, (/stream.mjpg?fps=10), and the frames in
+#  between are dropped the same way.  Frames sent and dropped are counted for every client.
+#  The kernel's send buffer for each stream socket is kept small, otherwise a slow viewer's
+#  backlog just moves from here into the kernel, (where it can't be dropped).
+#  The time taken to send each frame to each client is in /metrics, (robot_stream_send_seconds).
+
+import logging
+import selectors
+import socket
+from threading import Lock, Thread
+from time import monotonic
+
+from robot_metrics import registry
+
+send_seconds = registry.histogram("robot_stream_send_seconds",
+                                  "Time from starting to send a frame to a stream client to finishing it")
+frames_dropped_total = registry.counter("robot_stream_frames_dropped_total",
+                                        "Frames skipped because a stream client was still busy")
+clients_gauge = registry.gauge("robot_stream_clients", "Connected stream clients")
+
+#  The end of each frame in the multipart stream
+PART_TRAILER = b"\r\n"
+
+
+#  The multipart header that goes in front of every frame.
+def part_header(length):
+    return (b"--FRAME\r\nContent-Type: image/jpeg\r\nContent-Length: "
+            + str(length).encode("ascii") + b"\r\n\r\n")
+
+
+class StreamClient(object):
+    '''
+    One connected viewer, and the data waiting to be sent to it.
+    max_fps of None or 0 means "as fast as the camera and the link allow".
+    '''
+    def __init__(self, sock, address, max_fps = None):
+        self.sock = sock
+        self.fileno = sock.fileno()
+        self.address = address
+        self.closed = False
+        self.events = selectors.EVENT_READ  #  what the selector is watching for
+        self.min_interval = 1.0 / max_fps if max_fps else 0.0
+        self.max_fps = max_fps
+        self.connected_at = monotonic()
+        self.next_send_time = 0.0  #  earliest monotonic() time the next frame may be started
+
+        self.sending = None  #  the buffers of the frame being sent right now
+        self.sending_sequence = 0
+        self.sending_started = 0.0  #  monotonic() time "sending" was started
+        self.next_frame = None  #  (sequence, buffers) of the newest frame waiting to be sent
+
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.bytes_sent = 0
+
+    def stats(self):
+        connected = monotonic() - self.connected_at
+        return {
+            "address": "{}:{}".format(*self.address[:2]),
+            "max_fps": self.max_fps,
+            "connected_seconds": round(connected, 1),
+            "frames_sent": self.frames_sent,
+            "frames_dropped": self.frames_dropped,
+            "bytes_sent": self.bytes_sent,
+            "fps": round(self.frames_sent / connected, 1) if connected > 0 else 0.0,
+        }
+
+
+class StreamBroadcaster(Thread):
+    '''
+    Sends the newest published frame to all the stream clients from a single thread.
+    output is the StreamingOutput whose frames are published, (to hold and release them),
+    or None if they are bytes that are never overwritten.
+    send_buffer_size is the SO_SNDBUF given to every stream socket, (None leaves it alone).
+    '''
+    def __init__(self, output = None, send_buffer_size = 65536):
+        Thread.__init__(self, name = "StreamBroadcaster", daemon = True)
+        self.output = output
+        self.send_buffer_size = send_buffer_size
+        self.selector = selectors.DefaultSelector()
+        self.clients = {}
+        self.lock = Lock()
+        self.new_clients = []
+        self.latest = None  #  (sequence, frame) published but not yet handed to the clients
+        self.latest_sequence = 0
+        self.stopping = False
+
+        #  The camera thread wakes us up by writing a byte to this socket pair.
+        self.wakeup_receive, self.wakeup_send = socket.socketpair()
+        self.wakeup_receive.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.wakeup_pending = False
+        self.selector.register(self.wakeup_receive, selectors.EVENT_READ, None)
+
+    #  Called by StreamingOutput, (in the camera thread), every time a frame is published.
+    def publish(self, sequence, frame):
+        with self.lock:
+            self.latest = (sequence, frame)
+            self._wakeup()
+
+    #  Called by StreamingHandler once the response headers have been sent.
+    #  From now on the socket belongs to the broadcaster.
+    def add_client(self, sock, address, max_fps = None):
+        with self.lock:
+            self.new_clients.append(StreamClient(sock, address, max_fps))
+            self._wakeup()
+
+    def client_count(self):
+        return len(self.clients)
+
+    #  Counters for every connected client.
+    def client_stats(self):
+        return [client.stats() for client in list(self.clients.values())]
+
+    def stop(self, timeout = None):
+        with self.lock:
+            self.stopping = True
+            self._wakeup()
+        if self.is_alive():
+            self.join(timeout)
+
+    #  The lock must be held.
+    def _wakeup(self):
+        if not self.wakeup_pending:
+            self.wakeup_pending = True
+            try:
+                self.wakeup_send.send(b"\0")
+            except BlockingIOError:
+                pass
+
+    def run(self):
+        while True:
+            for key, events in self.selector.select(self._select_timeout()):
+                client = key.data
+                if client is None:
+                    self._handle_wakeup()
+                    continue
+                if client.closed:
+                    continue
+                if events & selectors.EVENT_READ and not self._check_connected(client):
+                    continue
+                if events & selectors.EVENT_WRITE:
+                    self._send(client)
+            if self.stopping:
+                break
+            self._send_due_frames()
+
+        for client in list(self.clients.values()):
+            self._remove(client, "server shutting down")
+        self.selector.close()
+        self.wakeup_receive.close()
+        self.wakeup_send.close()
+
+    #  How long select() may wait: until the first rate-limited client is due its next frame.
+    def _select_timeout(self):
+        due = None
+        for client in self.clients.values():
+            if client.next_frame is not None and client.sending is None:
+                if due is None or client.next_send_time < due:
+                    due = client.next_send_time
+        if due is None:
+            return None
+        return max(0.0, due - monotonic())
+
+    def _send_due_frames(self):
+        now = monotonic()
+        for client in list(self.clients.values()):
+            if client.next_frame is not None and client.sending is None and now >= client.next_send_time:
+                self._send(client)
+
+    def _handle_wakeup(self):
+        try:
+            self.wakeup_receive.recv(4096)
+        except BlockingIOError:
+            pass
+        with self.lock:
+            self.wakeup_pending = False
+            new_clients, self.new_clients = self.new_clients, []
+            latest, self.latest = self.latest, None
+
+        for client in new_clients:
+            client.sock.setblocking(False)
+            if self.send_buffer_size:
+                client.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer_size)
+            self.clients[client.fileno] = client
+            self.selector.register(client.sock, selectors.EVENT_READ, client)
+            clients_gauge.set(len(self.clients))
+
+        if latest is not None and latest[0] != self.latest_sequence:
+            self.latest_sequence, frame = latest
+            buffers = [memoryview(part_header(len(frame))), frame, memoryview(PART_TRAILER)]
+            for client in list(self.clients.values()):
+                self._offer(client, self.latest_sequence, buffers)
+
+    #  Keep a frame in the frame ring, (False if it has already been overwritten).
+    def _hold(self, sequence):
+        return self.output is None or self.output.hold(sequence)
+
+    def _release(self, sequence):
+        if self.output is not None:
+            self.output.release(sequence)
+
+    #  Give a client a new frame.  It replaces any frame the client hasn't started sending yet.
+    def _offer(self, client, sequence, buffers):
+        if client.next_frame is not None:
+            self._release(client.next_frame[0])
+            client.next_frame = None
+            client.frames_dropped += 1
+            frames_dropped_total.inc()
+        #  If we were held up for so long that the camera has already reused the frame's slot,
+        #  it's dropped too, (there'll be a newer one along shortly).
+        if not self._hold(sequence):
+            client.frames_dropped += 1
+            frames_dropped_total.inc()
+            return
+        client.next_frame = (sequence, buffers)
+        self._send(client)
+
+    #  Send as much as the client's socket will take without blocking.
+    def _send(self, client):
+        try:
+            while True:
+                if client.sending is None:
+                    if client.next_frame is None or monotonic() < client.next_send_time:
+                        break
+                    client.sending_sequence, buffers = client.next_frame
+                    client.next_frame = None
+                    client.sending = list(buffers)
+                    client.sending_started = monotonic()
+                    client.next_send_time = client.sending_started + client.min_interval
+                buffer = client.sending[0]
+                sent = client.sock.send(buffer)
+                client.bytes_sent += sent
+                if sent < len(buffer):
+                    client.sending[0] = buffer[sent:]
+                    break
+                del client.sending[0]
+                if not client.sending:
+                    client.sending = None
+                    self._release(client.sending_sequence)
+                    client.frames_sent += 1
+                    send_seconds.observe(monotonic() - client.sending_started)
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            self._remove(client, str(e))
+            return
+
+        #  Only ask to be told about writability while in the middle of sending a frame.
+        events = selectors.EVENT_READ
+        if client.sending is not None:
+            events |= selectors.EVENT_WRITE
+        if events != client.events:
+            client.events = events
+            self.selector.modify(client.sock, events, client)
+
+    #  A stream client never sends anything after its request, so if its socket becomes
+    #  readable it has almost certainly gone away.
+    def _check_connected(self, client):
+        try:
+            if client.sock.recv(4096):
+                return True
+            reason = "connection closed"
+        except BlockingIOError:
+            return True
+        except OSError as e:
+            reason = str(e)
+        self._remove(client, reason)
+        return False
+
+    def _remove(self, client, reason):
+        if client.closed:
+            return
+        client.closed = True
+        if client.sending is not None:
+            self._release(client.sending_sequence)
+        if client.next_frame is not None:
+            self._release(client.next_frame[0])
+        stats = client.stats()
+        logging.warning("Removed streaming client %s: %s (%d frames sent, %d dropped)",
+                        client.address, reason, stats["frames_sent"], stats["frames_dropped"])
+        self.clients.pop(client.fileno, None)
+        clients_gauge.set(len(self.clients))
+        try:
+            self.selector.unregister(client.sock)
+        except (KeyError, ValueError):
+            pass
+        try:
+            client.sock.close()
+        except OSError:
+            pass
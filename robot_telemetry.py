@@ -0,0 +1,111 @@
+#
+#  New Remote Camera Robot - telemetry publisher
+#
+#  The status panel in the browser used to show only what the browser itself thought the robot
+#  was doing.  The TelemetryPublisher holds what the robot *actually* is doing, (motion state,
+#  wheel speeds, head position, timestamps), and streams it to any number of browsers as
+#  Server-Sent Events, (see the /telemetry route in New_Remote_Camera_Robot.py).
+#
+#  To keep the stream small:
+#    * the first event for a subscriber is the complete state, ("event: state")
+#    * after that, each event only has the fields that changed since the last one sent
+#    * changes are coalesced so a subscriber never gets more than "max_rate" events a second,
+#      no matter how fast the robot's state changes
+#  A comment line is sent every "keepalive" seconds when nothing changes so that proxies
+#  don't close the connection and a browser that has gone away is noticed.
+
+import json
+from threading import Condition
+from time import monotonic, sleep, time
+
+
+#  Format one Server-Sent Event.
+def sse_event(data, event = None):
+    text = ""
+    if event is not None:
+        text += "event: {}\n".format(event)
+    return text + "data: {}\n\n".format(json.dumps(data, separators = (",", ":")))
+
+
+class TelemetryPublisher(object):
+    '''
+    The latest robot state, and the Server-Sent Event streams that follow it.
+    '''
+    def __init__(self, keepalive = 15.0):
+        self.keepalive = keepalive
+        self.condition = Condition()
+        self.state = {}
+        self.version = 0
+        self.subscribers = 0
+
+    #  Merge "fields" into the state.  Subscribers are only woken if something changed,
+    #  in which case "server_time", (seconds since the epoch), is updated too.
+    def update(self, fields):
+        with self.condition:
+            changed = False
+            for key, value in fields.items():
+                if self.state.get(key, self) != value:
+                    self.state[key] = value
+                    changed = True
+            if changed:
+                self.state["server_time"] = round(time(), 3)
+                self.version += 1
+                self.condition.notify_all()
+            return changed
+
+    def snapshot(self):
+        with self.condition:
+            return dict(self.state)
+
+    #  A new subscriber.  Returns (the complete state, its version), to pass to changes().
+    def subscribe(self):
+        with self.condition:
+            self.subscribers += 1
+            return dict(self.state), self.version
+
+    def unsubscribe(self):
+        with self.condition:
+            self.subscribers -= 1
+
+    #  What has changed since a subscriber was last sent "sent", (at "version").
+    #  Returns the new version and the changed fields, (which are merged into "sent").
+    #  The lock must be held.
+    def _changes(self, sent, version):
+        if self.version == version:
+            return version, {}
+        delta = {key: value for key, value in self.state.items() if sent.get(key, self) != value}
+        sent.update(delta)
+        return self.version, delta
+
+    #  The same, without waiting, (for servers that can't block, e.g. robot_async_server.py).
+    def changes(self, sent, version):
+        with self.condition:
+            return self._changes(sent, version)
+
+    #  A generator of Server-Sent Events for one subscriber.
+    #  It runs until the subscriber disconnects, (the web server then closes the generator).
+    def stream(self, max_rate = 10.0):
+        min_interval = 1.0 / max_rate if max_rate > 0 else 0.0
+        sent, version = self.subscribe()
+        try:
+            yield sse_event(sent, "state")
+            last_sent = monotonic()
+            while True:
+                #  Coalesce: anything that changes while we wait is sent in the next event.
+                wait = last_sent + min_interval - monotonic()
+                if wait > 0:
+                    sleep(wait)
+
+                with self.condition:
+                    if not self.condition.wait_for(lambda: self.version != version, self.keepalive):
+                        delta = None
+                    else:
+                        version, delta = self._changes(sent, version)
+
+                if delta is None:
+                    yield ": keepalive\n\n"
+                elif delta:
+                    yield sse_event(delta)
+                    last_sent = monotonic()
+        finally:
+            self.unsubscribe()
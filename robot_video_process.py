@@ -0,0 +1,222 @@
+#
+#  New Remote Camera Robot - video process
+#
+#  The camera thread, (StreamingOutput.write), the stream broadcaster, every stream handler and
+#  the Flask threads that drive the robot all share one interpreter, and so one GIL.  When a lot
+#  of video is going out, the drive control loop and the motor calls have to wait their turn
+#  behind it, and the robot's response to the joystick gets jerky.
+#
+#  With ROBOT_VIDEO_PROCESS=1 the camera, the stream server and the video recorder run in a child
+#  process instead, (see run_video_process in New_Remote_Camera_Robot.py), and the main process
+#  only drives the robot.  The viewers get the frames straight from the child's stream server, so
+#  the main process never needs the frames themselves, only to know that they're still coming.
+#  The two processes share a SharedVideoStatus, (a few bytes of multiprocessing.shared_memory):
+#    * the sequence number of the latest frame and the time it was published, which the child
+#      updates for every frame
+#    * a heartbeat, which the child's main thread updates twice a second
+#
+#  VideoProcess starts the child and watches it.  The child is restarted, (after a delay that
+#  doubles every time it fails again, up to max_restart_delay), if it:
+#    * exits
+#    * stops updating the heartbeat for stall_timeout seconds, (it's hung)
+#    * hasn't produced a frame within start_timeout seconds of starting, or then stops producing
+#      them for stall_timeout seconds, (the camera has hung)
+#  Every restart is counted in /metrics.  The sequence numbers carry on across restarts,
+#  so anything waiting for a frame newer than N still gets the next one.
+#
+#  The times are monotonic(), which is the same clock in every process on Linux.
+
+import logging
+import multiprocessing
+import struct
+from multiprocessing import shared_memory
+from threading import Event, Thread
+from time import monotonic, sleep
+
+from robot_metrics import registry
+
+restarts_total = registry.counter("robot_video_process_restarts_total",
+                                  "Times the video process was restarted after exiting or hanging")
+
+STATUS_MAGIC = b"NRCRVID\0"
+STATUS_LAYOUT = struct.Struct("<8sQdd")  #  magic, latest sequence, monotonic() time it was published, heartbeat
+LATEST_OFFSET = 8
+FRAME_TIME_OFFSET = 16
+HEARTBEAT_OFFSET = 24
+SEQUENCE = struct.Struct("<Q")
+TIME = struct.Struct("<d")
+
+#  How often the child updates the heartbeat
+HEARTBEAT_INTERVAL = 0.5
+
+#  How often a frame is looked for by SharedVideoStatus.wait
+POLL_INTERVAL = 0.005
+
+
+class SharedVideoStatus(object):
+    '''
+    The latest frame's sequence number and time, and a heartbeat, in shared memory.
+    SharedVideoStatus.create() makes a new one, SharedVideoStatus(name) attaches to it in
+    another process.  One process writes them, (publish and beat), any number read them.
+    '''
+    def __init__(self, name):
+        self.memory = shared_memory.SharedMemory(name)
+        self.buffer = self.memory.buf
+        magic, self.sequence, frame_time, heartbeat = STATUS_LAYOUT.unpack_from(self.buffer, 0)
+        if magic != STATUS_MAGIC:
+            self.close()
+            raise ValueError("{} is not a shared video status".format(name))
+
+    @classmethod
+    def create(cls):
+        memory = shared_memory.SharedMemory(create = True, size = STATUS_LAYOUT.size)
+        STATUS_LAYOUT.pack_into(memory.buf, 0, STATUS_MAGIC, 0, 0.0, 0.0)
+        name = memory.name
+        memory.close()
+        return cls(name)
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    #  Called by StreamingOutput, (in the camera thread), for every published frame.
+    #  The frames are numbered here, so the numbers carry on when the writer is restarted.
+    def publish(self, sequence, frame):
+        self.sequence += 1
+        TIME.pack_into(self.buffer, FRAME_TIME_OFFSET, monotonic())
+        SEQUENCE.pack_into(self.buffer, LATEST_OFFSET, self.sequence)
+
+    def beat(self):
+        TIME.pack_into(self.buffer, HEARTBEAT_OFFSET, monotonic())
+
+    #  monotonic() time of the writer's last heartbeat, (0.0 if it has never had one).
+    def heartbeat(self):
+        return TIME.unpack_from(self.buffer, HEARTBEAT_OFFSET)[0]
+
+    def latest_sequence(self):
+        return SEQUENCE.unpack_from(self.buffer, LATEST_OFFSET)[0]
+
+    #  monotonic() time the latest frame was published, (0.0 if none has been).
+    def latest_frame_time(self):
+        return TIME.unpack_from(self.buffer, FRAME_TIME_OFFSET)[0]
+
+    #  Wait up to "timeout" seconds for a frame newer than "after".
+    #  Returns the latest sequence number, (no newer than "after" if none arrived in time).
+    def wait(self, after = 0, timeout = None):
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            sequence = self.latest_sequence()
+            if sequence > after or (deadline is not None and monotonic() >= deadline):
+                return sequence
+            sleep(POLL_INTERVAL)
+
+    def close(self):
+        self.buffer = None
+        self.memory.close()
+
+    #  Remove the shared memory, (once every process has finished with it).
+    def unlink(self):
+        self.memory.unlink()
+
+
+class VideoProcess(Thread):
+    '''
+    Runs target(status name, *args) in a child process, and restarts it if it exits, hangs or
+    stops producing frames.  The child must publish its frames to the SharedVideoStatus of that
+    name, and call beat() on it every HEARTBEAT_INTERVAL seconds.  It is stopped with SIGTERM.
+    '''
+    def __init__(self, target, args = (), start_timeout = 10.0, stall_timeout = 5.0, restart_delay = 1.0, max_restart_delay = 30.0):
+        Thread.__init__(self, name = "VideoProcess", daemon = True)
+        self.target = target
+        self.args = tuple(args)
+        self.start_timeout = start_timeout
+        self.stall_timeout = stall_timeout
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.shared = SharedVideoStatus.create()
+        #  A fresh interpreter, rather than a fork of this one with all its threads
+        self.context = multiprocessing.get_context("spawn")
+        self.process = None
+        self.stopping = Event()
+        self.restarts = 0
+        self.last_failure = None  #  why the child was last restarted
+
+    def run(self):
+        delay = self.restart_delay
+        while not self.stopping.is_set():
+            started = monotonic()
+            self._start_child()
+            reason = self._watch()
+            self._stop_child()
+            if reason is None:
+                break
+            self.restarts += 1
+            self.last_failure = reason
+            restarts_total.inc()
+            #  A child that ran for a while before failing gets restarted straight away
+            if monotonic() - started > self.max_restart_delay:
+                delay = self.restart_delay
+            logging.error("The video process %s, restarting it in %.1f seconds", reason, delay)
+            if self.stopping.wait(delay):
+                break
+            delay = min(delay * 2, self.max_restart_delay)
+
+    def stop(self, timeout = None):
+        self.stopping.set()
+        if self.is_alive():
+            self.join(timeout)
+        else:
+            self._stop_child()
+        self.shared.close()
+        self.shared.unlink()
+
+    def _start_child(self):
+        self.process = self.context.Process(target = self.target, args = (self.shared.name,) + self.args,
+                                            name = "VideoProcess", daemon = True)
+        self.process.start()
+
+    #  Wait until the child has to be restarted, and return why, (None if we are stopping).
+    def _watch(self):
+        started = monotonic()
+        first_sequence = self.shared.latest_sequence()
+        last_sequence = first_sequence
+        last_frame = started
+        while not self.stopping.wait(HEARTBEAT_INTERVAL):
+            now = monotonic()
+            if not self.process.is_alive():
+                return "exited with code {}".format(self.process.exitcode)
+            sequence = self.shared.latest_sequence()
+            if sequence != last_sequence:
+                last_sequence = sequence
+                last_frame = now
+            if now - started < self.start_timeout:
+                continue
+            if now - max(self.shared.heartbeat(), started) > self.stall_timeout:
+                return "stopped responding"
+            if last_sequence == first_sequence:
+                return "produced no frames"
+            if now - last_frame > self.stall_timeout:
+                return "stopped producing frames"
+        return None
+
+    def _stop_child(self):
+        if self.process is None:
+            return
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(5.0)
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.process = None
+
+    def status(self):
+        process = self.process
+        frame_time = self.shared.latest_frame_time()
+        return {
+            "running": process is not None and process.is_alive(),
+            "restarts": self.restarts,
+            "last_failure": self.last_failure,
+            "latest_frame": self.shared.latest_sequence(),
+            "latest_frame_age": round(monotonic() - frame_time, 3) if frame_time else None,
+        }
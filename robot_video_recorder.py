@@ -0,0 +1,376 @@
+#
+#  New Remote Camera Robot - video recorder
+#
+#  The frames StreamingOutput publishes used to be thrown away as soon as the viewers had them.
+#  The VideoRecorder keeps them on the SD card, so that what the robot saw can be looked at later.
+#
+#  Recording must never hold up the camera or the viewers, so:
+#    * publish(), (called in the camera thread for every frame), only copies the frame out of the
+#      frame ring and puts it on a queue.  If the queue is full, (the SD card has stalled),
+#      the frame is dropped and counted instead of waiting.
+#    * the recorder's own thread takes everything on the queue at once and writes it with
+#      large buffered writes.
+#
+#  Frames are written to "segment" files, a new one every "segment_seconds":
+#
+#    header     24 bytes   magic, format version, time the segment was started
+#    frames                for each frame: 16 byte frame header, (time, length), and the JPEG
+#    index                 for each frame: 16 bytes, (offset of its frame header, time)
+#    trailer    24 bytes   offset of the index, number of frames, end magic
+#
+#  The index and trailer are written when a segment is closed.  A segment without them, (the one
+#  being written now, or the last one if the robot was switched off), can still be read by
+#  walking the frame headers, and is given its index the next time the recorder starts.
+#
+#  The oldest segments are deleted to keep all of them under "max_bytes".
+#
+#  VideoSegment memory-maps a segment for playback and finds frames by time, and VideoArchive
+#  does the same across all the segments in the directory.  See StreamingHandler for the
+#  /recordings.json, /recording.jpg and /recording.mjpg routes.
+#
+#  Set ROBOT_VIDEO_DIR=/path/to/directory to record when the robot is running.
+
+from bisect import bisect_right
+from collections import deque
+import logging
+import mmap
+import os
+import struct
+from threading import Condition, Thread
+from time import monotonic, time
+
+from robot_metrics import registry
+
+MAGIC = b"NRCRVID\0"
+END_MAGIC = b"NRCRIDX\0"
+VERSION = 1
+HEADER = struct.Struct("<8sHH4xd")  #  magic, version, frame header size, start time
+FRAME = struct.Struct("<dI4x")  #  time, (seconds since the epoch), JPEG length
+INDEX_ENTRY = struct.Struct("<Qd")  #  offset of the frame header, time
+TRAILER = struct.Struct("<QI4x8s")  #  offset of the index, number of frames, end magic
+
+SEGMENT_PREFIX = "video-"
+SEGMENT_SUFFIX = ".mjseg"
+
+frames_recorded_total = registry.counter("robot_video_frames_recorded_total", "Camera frames written to the video recording")
+frames_not_recorded_total = registry.counter("robot_video_frames_dropped_total",
+                                             "Camera frames not recorded because the recorder was behind")
+write_seconds = registry.histogram("robot_video_write_seconds", "Time taken to write each batch of frames to the recording")
+
+
+class VideoRecordingError(Exception):
+    '''
+    The file is not a video segment, or was written by an incompatible version.
+    '''
+
+
+#  The name of the segment started at "start_time", (they sort oldest first).
+def segment_name(start_time):
+    return "{}{:015d}{}".format(SEGMENT_PREFIX, int(start_time * 1000), SEGMENT_SUFFIX)
+
+
+#  The segment files in "directory", oldest first.
+def list_segments(directory):
+    names = sorted(name for name in os.listdir(directory)
+                   if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX))
+    return [os.path.join(directory, name) for name in names]
+
+
+#  When the segment at "path" was started, from its name.
+def segment_start(path):
+    return int(os.path.basename(path)[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]) / 1000.0
+
+
+class SegmentWriter(object):
+    '''
+    One segment file, being written.
+    '''
+    def __init__(self, path, start_time, buffer_size = 1024 * 1024):
+        self.path = path
+        self.start_time = start_time
+        self.file = open(path, "wb", buffering = buffer_size)
+        self.file.write(HEADER.pack(MAGIC, VERSION, FRAME.size, start_time))
+        self.size = HEADER.size
+        self.index = []
+
+    def write_frame(self, timestamp, data):
+        self.index.append(INDEX_ENTRY.pack(self.size, timestamp))
+        self.file.write(FRAME.pack(timestamp, len(data)))
+        self.file.write(data)
+        self.size += FRAME.size + len(data)
+
+    #  Write the index and trailer and close the file.
+    def close(self):
+        self.file.write(b"".join(self.index))
+        self.file.write(TRAILER.pack(self.size, len(self.index), END_MAGIC))
+        self.file.close()
+        self.size += len(self.index) * INDEX_ENTRY.size + TRAILER.size
+
+
+class VideoRecorder(Thread):
+    '''
+    Writes every published frame to segment files in "directory", from its own thread.
+    max_bytes is the most all the segments may use, (the oldest are deleted).
+    max_queue_bytes is how much can be waiting to be written before frames are dropped.
+    max_fps of None or 0 records every frame.
+    '''
+    def __init__(self, directory, max_bytes = 1024 * 1024 * 1024, segment_seconds = 60,
+                 max_queue_bytes = 8 * 1024 * 1024, max_fps = None):
+        Thread.__init__(self, name = "VideoRecorder", daemon = True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_seconds = segment_seconds
+        self.max_queue_bytes = max_queue_bytes
+        self.min_interval = 1.0 / max_fps if max_fps else 0.0
+        self.condition = Condition()
+        self.queue = deque()
+        self.queued_bytes = 0
+        self.next_frame_time = 0.0
+        self.stopping = False
+        self.segment = None
+        self.frames_recorded = 0
+        self.frames_dropped = 0
+        os.makedirs(directory, exist_ok = True)
+
+    #  Called by StreamingOutput, (in the camera thread), every time a frame is published.
+    def publish(self, sequence, frame):
+        now = monotonic()
+        if now < self.next_frame_time:
+            return
+        self.next_frame_time = now + self.min_interval
+        #  The frame is a view of a slot in the frame ring, which will be reused.
+        data = bytes(frame)
+        with self.condition:
+            if self.stopping:
+                return
+            if self.queued_bytes + len(data) > self.max_queue_bytes:
+                self.frames_dropped += 1
+                frames_not_recorded_total.inc()
+                return
+            self.queue.append((time(), data))
+            self.queued_bytes += len(data)
+            self.condition.notify()
+
+    #  Write what is queued, close the segment and stop the thread.
+    def stop(self, timeout = 5.0):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        for path in list_segments(self.directory):
+            try:
+                repair_segment(path)
+            except (OSError, VideoRecordingError) as e:
+                logging.warning("Can't repair video segment %s: %s", path, str(e))
+        self.evict()
+
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.queue or self.stopping)
+                batch = self.queue
+                self.queue = deque()
+                self.queued_bytes = 0
+                stopping = self.stopping
+            if batch:
+                try:
+                    self.write(batch)
+                except OSError as e:
+                    logging.error("Video recording failed: %s", str(e))
+                    self.close_segment()
+            if stopping:
+                break
+        self.close_segment()
+
+    def write(self, batch):
+        started = monotonic()
+        for timestamp, data in batch:
+            if self.segment is not None and timestamp - self.segment.start_time >= self.segment_seconds:
+                self.close_segment()
+                self.evict()
+            if self.segment is None:
+                self.segment = SegmentWriter(os.path.join(self.directory, segment_name(timestamp)), timestamp)
+            self.segment.write_frame(timestamp, data)
+        self.frames_recorded += len(batch)
+        frames_recorded_total.inc(len(batch))
+        write_seconds.observe(monotonic() - started)
+
+    def close_segment(self):
+        if self.segment is not None:
+            try:
+                self.segment.close()
+            except OSError as e:
+                logging.error("Can't close video segment %s: %s", self.segment.path, str(e))
+            self.segment = None
+
+    #  Delete the oldest segments until they all fit in max_bytes.
+    def evict(self):
+        segments = [(path, os.path.getsize(path)) for path in list_segments(self.directory)]
+        total = sum(size for path, size in segments)
+        for path, size in segments:
+            if total <= self.max_bytes:
+                break
+            if self.segment is not None and path == self.segment.path:
+                break
+            os.remove(path)
+            total -= size
+
+
+#  Give a segment that was never closed its index and trailer.
+#  A partly written last frame is removed first.
+def repair_segment(path):
+    with VideoSegment(path) as segment:
+        if segment.indexed:
+            return
+        offsets, timestamps, end = segment.offsets, segment.timestamps, segment.data_end
+    with open(path, "r+b") as segment_file:
+        segment_file.truncate(end)
+        segment_file.seek(end)
+        segment_file.write(b"".join(INDEX_ENTRY.pack(offset, timestamp)
+                                    for offset, timestamp in zip(offsets, timestamps)))
+        segment_file.write(TRAILER.pack(end, len(offsets), END_MAGIC))
+
+
+class VideoSegment(object):
+    '''
+    A memory-mapped segment, for playback.
+    len() is the number of frames, and frame(i) gives (time, JPEG) for frame i.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        size = os.fstat(self.file.fileno()).st_size
+        if size < HEADER.size:
+            self.file.close()
+            raise VideoRecordingError("{} is too short to be a video segment".format(path))
+        self.map = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+        magic, version, frame_header_size, self.start_time = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            self.close()
+            raise VideoRecordingError("{} is not a video segment".format(path))
+        if version != VERSION or frame_header_size != FRAME.size:
+            self.close()
+            raise VideoRecordingError("{} is video segment version {}, expected {}".format(path, version, VERSION))
+
+        self.offsets = []
+        self.timestamps = []
+        self.indexed = False
+        if size >= HEADER.size + TRAILER.size:
+            index_offset, count, end_magic = TRAILER.unpack_from(self.map, size - TRAILER.size)
+            if end_magic == END_MAGIC and index_offset + count * INDEX_ENTRY.size + TRAILER.size == size:
+                for offset in range(index_offset, index_offset + count * INDEX_ENTRY.size, INDEX_ENTRY.size):
+                    frame_offset, timestamp = INDEX_ENTRY.unpack_from(self.map, offset)
+                    self.offsets.append(frame_offset)
+                    self.timestamps.append(timestamp)
+                self.indexed = True
+                self.data_end = index_offset
+        if not self.indexed:
+            #  No index, walk the frame headers.
+            offset = HEADER.size
+            while offset + FRAME.size <= size:
+                timestamp, length = FRAME.unpack_from(self.map, offset)
+                if offset + FRAME.size + length > size:
+                    break
+                self.offsets.append(offset)
+                self.timestamps.append(timestamp)
+                offset += FRAME.size + length
+            self.data_end = offset
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def frame(self, index):
+        offset = self.offsets[index]
+        timestamp, length = FRAME.unpack_from(self.map, offset)
+        return timestamp, self.map[offset + FRAME.size:offset + FRAME.size + length]
+
+    #  The index of the frame showing time "timestamp", (the last one taken at or before it),
+    #  or None if it is before the first frame, or more than a frame interval after the last.
+    def find(self, timestamp):
+        index = bisect_right(self.timestamps, timestamp) - 1
+        if index < 0 or timestamp - self.timestamps[-1] > self.frame_interval():
+            return None
+        return index
+
+    #  The index of the frame to start playing from at time "timestamp", (the first frame if
+    #  it is before the segment, len() if it is after it).
+    def playback_start(self, timestamp):
+        index = bisect_right(self.timestamps, timestamp) - 1
+        if index < 0:
+            return 0
+        if timestamp - self.timestamps[-1] > self.frame_interval():
+            return len(self.timestamps)
+        return index
+
+    #  The average time between frames, (0 if there are fewer than two).
+    def frame_interval(self):
+        if len(self.timestamps) < 2:
+            return 0.0
+        return (self.timestamps[-1] - self.timestamps[0]) / (len(self.timestamps) - 1)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class VideoArchive(object):
+    '''
+    All the segments in a recording directory.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+
+    #  The start, end and size of every segment, oldest first.
+    def describe(self):
+        segments = []
+        for path in list_segments(self.directory):
+            try:
+                with VideoSegment(path) as segment:
+                    segments.append({
+                        "name": os.path.basename(path),
+                        "start": segment.start_time,
+                        "end": segment.timestamps[-1] if len(segment) else segment.start_time,
+                        "frames": len(segment),
+                        "bytes": os.path.getsize(path),
+                    })
+            except (OSError, VideoRecordingError):
+                continue  #  deleted or being created
+        return segments
+
+    #  (time, JPEG) for every frame from time "timestamp" onwards.
+    def frames(self, timestamp):
+        paths = list_segments(self.directory)
+        starts = [segment_start(path) for path in paths]
+        first = max(0, bisect_right(starts, timestamp) - 1)
+        for path in paths[first:]:
+            try:
+                segment = VideoSegment(path)
+            except (OSError, VideoRecordingError):
+                continue
+            with segment:
+                for index in range(segment.playback_start(timestamp) if path == paths[first] else 0, len(segment)):
+                    yield segment.frame(index)
+
+    #  (time, JPEG) of the frame showing time "timestamp", or None if nothing was recorded then.
+    def frame_at(self, timestamp):
+        paths = list_segments(self.directory)
+        index = bisect_right([segment_start(path) for path in paths], timestamp) - 1
+        if index < 0:
+            return None
+        try:
+            segment = VideoSegment(paths[index])
+        except (OSError, VideoRecordingError):
+            return None
+        with segment:
+            frame = segment.find(timestamp)
+            return None if frame is None else segment.frame(frame)
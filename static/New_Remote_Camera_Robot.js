@@ -8,6 +8,7 @@
 // Global variables
 var server_address = window.location.protocol + "//" + window.location.host + "/robot";
 var get_request_address = window.location.protocol + "//" + window.location.host;
+var websocket_address = (window.location.protocol == "https:" ? "wss://" : "ws://") + window.location.host + "/robot_ws";
 var joystick_data = [];
 var js = [];
 
@@ -58,9 +59,15 @@ var gopigo3_joystick = {
 //  old_event_context allows values for old_time_stamp and old_trigger_state to persist across functon calls
 var old_event_context = {
     old_time_stamp: 0,  // set sane initial values for both variables
-    old_trigger_state: 0
+    old_trigger_state: 0,
+    old_send_time: 0  // Date.now() when data was last sent to the robot
 };
 
+//  The robot stops by itself if it doesn't hear from us for a while, (its "dead-man" watchdog).
+//  While a trigger is held we re-send the joystick data at least this often, (in milliseconds),
+//  even if the joystick hasn't moved, so a perfectly steady hand doesn't stop the robot.
+var keepalive_interval = 250;
+
 //  Event Listeners
 
 window.addEventListener("gamepadconnected", (event) => {
@@ -252,7 +259,8 @@ function what_i_am_doing() {
 //  Otherwise, no data should be sent.
 function is_something_happening() {
     if (gopigo3_joystick.trigger_1 == 1 || gopigo3_joystick.head_enable == 1) {  //  Has an enabling trigger event happened?
-        if (old_event_context.old_time_stamp != Number.parseFloat((gopigo3_joystick.time_stamp).toFixed())) {  // and, has the timestamp changed?
+        if (old_event_context.old_time_stamp != Number.parseFloat((gopigo3_joystick.time_stamp).toFixed())  // and, has the timestamp changed?
+            || (Date.now() - old_event_context.old_send_time) >= keepalive_interval) {  // or is it time for a keepalive?
             send_data()  //  then, send data to the robot and. . .
             old_event_context.old_time_stamp = Number.parseFloat((gopigo3_joystick.time_stamp).toFixed())  //  Save current time_stamp to compare to future changes
             old_event_context.old_trigger_state = 1  // record trigger was pressed
@@ -266,18 +274,299 @@ function is_something_happening() {
     return;
 }
 
+//  The WebSocket control channel.
+//  If the robot accepts a WebSocket connection on /robot_ws, the joystick data is sent
+//  over that one long-lived connection instead of a new POST for every update.
+//  If the WebSocket can't be opened, (or closes), we fall back to POSTing to /robot
+//  and try to re-open the WebSocket every few seconds.
+var control_socket = {
+    socket: null,  //  the WebSocket object, if any
+    connected: false,  //  true when commands can be sent over the WebSocket
+    seq: 0,  //  sequence number of the last frame sent
+    last_ack: 0,  //  sequence number of the last frame the robot acknowledged
+    retry_delay: 5000  //  milliseconds to wait before trying to reconnect
+};
+
+function open_control_socket() {
+    if (!('WebSocket' in window)) {
+        return;  // Really old browser, POST will have to do.
+    }
+    var socket = new WebSocket(websocket_address + (controller_lease.token ? '?lease=' + controller_lease.token : ''));
+    socket.onopen = function() {
+        control_socket.connected = true;
+        console.log('Control WebSocket connected');
+    };
+    socket.onmessage = function(event) {
+        var ack = JSON.parse(event.data);
+        if (ack.rejected == 'not_owner') {
+            lease_lost();
+        } else if (ack.seq) {
+            control_socket.last_ack = ack.seq;
+            command_acknowledged(ack);
+        }
+    };
+    socket.onclose = function() {
+        control_socket.connected = false;
+        control_socket.socket = null;
+        setTimeout(open_control_socket, control_socket.retry_delay);
+    };
+    control_socket.socket = socket;
+    return;
+}
+
+//  The controller lease, (see robot_controller_lease.py).
+//  Only one browser at a time can drive the robot: the one holding the lease.
+//  Every command carries the lease's token and a sequence number, so the robot
+//  can drop commands from anyone else, and commands that arrive out of order.
+var controller_lease = {
+    token: null,  //  our token, if we hold the lease
+    lost: false  //  true once another browser has taken the lease from us
+};
+
+function set_lease_status(text) {
+    document.getElementById('robot_lease').innerHTML = "Control: " + text;
+    return;
+}
+
+function lease_headers() {
+    return controller_lease.token ? {'X-Robot-Lease': controller_lease.token} : {};
+}
+
+function acquire_lease(takeover) {
+    $.ajax({url: server_address + '/lease' + (takeover ? '?takeover=1' : ''), type: 'POST', dataType: 'json'})
+        .done(function(status) {
+            controller_lease.token = status.token;
+            controller_lease.lost = false;
+            set_lease_status("This browser is driving the robot");
+            //  The WebSocket has to be re-opened with the new token
+            if (control_socket.socket) {
+                control_socket.socket.close();
+            } else {
+                open_control_socket();
+            }
+        })
+        .fail(function(xhr) {
+            if (xhr.status != 409) {
+                set_lease_status("Unable to reach the robot");
+            } else if (confirm('Another browser is driving the robot.  Take control?')) {
+                acquire_lease(true);
+            } else {
+                set_lease_status("Another browser is driving the robot");
+            }
+        });
+    return;
+}
+
+//  Another browser has taken control.  Our commands are being ignored from now on.
+function lease_lost() {
+    if (controller_lease.lost) {
+        return;
+    }
+    controller_lease.lost = true;
+    controller_lease.token = null;
+    set_lease_status("Another browser has taken control of the robot");
+    if (confirm('Another browser has taken control of the robot.  Take it back?')) {
+        acquire_lease(true);
+    }
+    return;
+}
+
+function command_rejected(xhr) {
+    if (xhr.status == 409 && xhr.responseJSON && xhr.responseJSON.rejected == 'not_owner') {
+        lease_lost();
+    }
+    return;
+}
+
+acquire_lease(false);
+
+//  Give the lease up when the page is closed or reloaded, so the next browser, (or this one,
+//  reloaded), doesn't have to wait for it to expire.  "keepalive" lets the request outlive the page.
+window.addEventListener('pagehide', function() {
+    if (controller_lease.token) {
+        fetch(server_address + '/lease', {method: 'DELETE', headers: lease_headers(), keepalive: true});
+        controller_lease.token = null;
+    }
+    return;
+});
+
+//  A page restored from the back/forward cache gave its lease up when it was hidden.
+window.addEventListener('pageshow', function(event) {
+    if (event.persisted && !controller_lease.token) {
+        acquire_lease(false);
+    }
+    return;
+});
+
+//  How long the robot takes to respond to the joystick, measured on every command.
+//  The robot's acknowledgement, (the POST's response or the WebSocket's reply), says how long
+//  it spent handling the command, and which command last reached the motors and how long that
+//  took, (usually the previous command, so each command's motor time is only counted once).
+//  The last latency_window samples of each are kept, and their median and 95th percentile shown.
+var latency_window = 100;
+var latency_probe = {
+    sent: {},  //  performance.now() each command was sent, by sequence number
+    rtt: [],  //  milliseconds from sending a command to its acknowledgement
+    server: [],  //  milliseconds the robot spent handling a command
+    actuation: [],  //  milliseconds from the robot receiving a command to the motors being set
+    actuated_seq: 0,  //  sequence number of the last command counted in "actuation"
+    joystick: []  //  milliseconds from the joystick moving to the robot's acknowledgement
+};
+
+function add_latency_sample(samples, value) {
+    samples.push(value);
+    if (samples.length > latency_window) {
+        samples.shift();
+    }
+    return;
+}
+
+function latency_percentile(samples, fraction) {
+    var sorted = samples.slice().sort(function(a, b) { return a - b; });
+    return sorted[Math.min(sorted.length - 1, Math.floor(fraction * sorted.length))];
+}
+
+function command_sent(seq) {
+    latency_probe.sent[seq] = performance.now();
+    return;
+}
+
+function command_acknowledged(ack) {
+    var now = performance.now();
+    var sent = latency_probe.sent[ack.seq];
+    if (sent === undefined) {
+        return;
+    }
+    //  Anything older was throttled away, or its acknowledgement lost
+    for (var seq in latency_probe.sent) {
+        if (Number(seq) <= ack.seq) {
+            delete latency_probe.sent[seq];
+        }
+    }
+    add_latency_sample(latency_probe.rtt, now - sent);
+    add_latency_sample(latency_probe.server, (ack.processed - ack.received) * 1000);
+    if (typeof ack.actuated_seq === "number" && ack.actuated_seq > latency_probe.actuated_seq) {
+        latency_probe.actuated_seq = ack.actuated_seq;
+        add_latency_sample(latency_probe.actuation, ack.actuation_ms);
+    }
+    //  The gamepad's timestamp is on the same clock as performance.now()
+    var joystick_age = now - ack.time_stamp;
+    if (ack.time_stamp > 0 && joystick_age >= 0 && joystick_age < 10000) {
+        add_latency_sample(latency_probe.joystick, joystick_age);
+    }
+    set_latency_data();
+    return;
+}
+
+function latency_summary(samples) {
+    if (!samples.length) {
+        return "-";
+    }
+    return latency_percentile(samples, 0.5).toFixed(0) + " / " + latency_percentile(samples, 0.95).toFixed(0);
+}
+
+function set_latency_data() {
+    document.getElementById('robot_latency').innerHTML = "Latency ms, (p50 / p95): Round Trip " +
+        latency_summary(latency_probe.rtt) + ", Robot " + latency_summary(latency_probe.server) +
+        ", Motors " + latency_summary(latency_probe.actuation) + ", Joystick " + latency_summary(latency_probe.joystick);
+    return;
+}
+
 // @ts-ignore
-var send_throttled_data = throttle(function(server_address, query_string) {
-    $.post(server_address + query_string);
+var send_throttled_data = throttle(function(server_address, query_string, seq) {
+    command_sent(seq);
+    $.ajax({url: server_address + query_string, type: 'POST', headers: lease_headers(), dataType: 'json'})
+        .done(command_acknowledged).fail(command_rejected);
 }, 250);
 
+//  The joystick data can also be sent as a small packed binary payload instead of text,
+//  (see robot_control_payload.py for the layout).  Open the page with "?binary=1" to use it.
+var use_binary_payload = new URLSearchParams(window.location.search).get('binary') == '1';
+var payload_mimetype = 'application/x-robot-command';
+var payload_axis_scale = 32767;
+
+//  These must be in the same order as the tables in robot_command_log.py
+var motion_state_codes = ['Waiting for Joystick', 'Stopped', 'Moving', 'Moving quicly',
+    'ArrowUp', 'ArrowDown', 'ArrowLeft', 'ArrowRight', 'Home', 'Escape'];
+var angle_dir_codes = ['None', 'Stopped', 'Directly Forward', 'Forward-Right', 'Forward-Left',
+    'Directly Backward', 'Backward-Right', 'Backward-Left'];
+
+function encode_code(table, value) {
+    var code = table.indexOf(value);
+    return (code < 0) ? 255 : code;
+}
+
+function encode_axis(value) {
+    return Math.max(-payload_axis_scale, Math.min(payload_axis_scale, Math.round(value * payload_axis_scale)));
+}
+
+function encode_payload(seq) {
+    var payload = new ArrayBuffer(22);
+    var view = new DataView(payload);
+    var flags = (gopigo3_joystick.trigger_1 ? 0x01 : 0) | (gopigo3_joystick.trigger_2 ? 0x02 : 0) |
+        (gopigo3_joystick.head_enable ? 0x04 : 0) | (gopigo3_joystick.controller_status == 'Connected' ? 0x08 : 0);
+    view.setUint8(0, 1);  //  format version
+    view.setUint8(1, flags);
+    view.setUint32(2, seq >>> 0, true);
+    view.setUint32(6, gopigo3_joystick.time_stamp >>> 0, true);
+    view.setInt16(10, encode_axis(gopigo3_joystick.x_axis), true);
+    view.setInt16(12, encode_axis(gopigo3_joystick.y_axis), true);
+    view.setInt16(14, encode_axis(gopigo3_joystick.head_x_axis), true);
+    view.setInt16(16, encode_axis(gopigo3_joystick.head_y_axis), true);
+    view.setInt16(18, encode_axis(gopigo3_joystick.force), true);
+    view.setUint8(20, encode_code(motion_state_codes, gopigo3_joystick.motion_state));
+    view.setUint8(21, encode_code(angle_dir_codes, gopigo3_joystick.angle_dir));
+    return payload;
+}
+
+// @ts-ignore
+var send_throttled_payload = throttle(function(server_address, payload, seq) {
+    command_sent(seq);
+    $.ajax({url: server_address, type: 'POST', data: payload, processData: false, contentType: payload_mimetype,
+            headers: lease_headers(), dataType: 'json'}).done(command_acknowledged).fail(command_rejected);
+}, 250);
+
+//  WebSocket frames are much cheaper than a POST, so they can be sent more often.
+//  The throttle may send a frame up to 50 ms late, and the WebSocket may have closed by then.
+//  The command, (often the last one, a stop), mustn't be lost, so it is POSTed instead,
+//  with the same sequence number.
+// @ts-ignore
+var send_throttled_frame = throttle(function(frame, seq) {
+    if (control_socket.socket && control_socket.socket.readyState === WebSocket.OPEN) {
+        command_sent(seq);
+        control_socket.socket.send(frame);
+    } else if (typeof frame === 'string') {
+        send_throttled_data(server_address, '?' + $.param(JSON.parse(frame)), seq);
+    } else {
+        send_throttled_payload(server_address, frame, seq);
+    }
+}, 50);
+
 //  This is what actually serializes and sends the data to the robot.
 function send_data() {
+    old_event_context.old_send_time = Date.now();
+    control_socket.seq += 1;
+    if (control_socket.connected) {
+        var frame;
+        if (use_binary_payload) {
+            frame = encode_payload(control_socket.seq);
+        } else {
+            frame = JSON.stringify(Object.assign({seq: control_socket.seq}, gopigo3_joystick));
+        }
+        console.log('gpg_data =', gopigo3_joystick);
+        send_throttled_frame(frame, control_socket.seq);
+        return;
+    }
+    if (use_binary_payload) {
+        console.log('gpg_data =', gopigo3_joystick);
+        send_throttled_payload(server_address, encode_payload(control_socket.seq), control_socket.seq);
+        return;
+    }
     var query_string = '';
-    query_string = '?' + $.param(gopigo3_joystick);
+    query_string = '?' + $.param(Object.assign({seq: control_socket.seq}, gopigo3_joystick));
     console.log('gpg_data =', gopigo3_joystick);
     console.log('query_string =', query_string);
-    send_throttled_data(server_address, query_string);
+    send_throttled_data(server_address, query_string, control_socket.seq);
     return;
 }
 
@@ -290,6 +579,41 @@ function set_on_screen_data() {
     return;
 }
 
+//  What the robot itself says it is doing, as opposed to what the joystick is asking for.
+//  The robot sends its whole state once when we connect, then only the values that changed.
+var robot_telemetry = {};
+
+function set_telemetry_data() {
+    var moving = robot_telemetry.moving ? "Moving " + robot_telemetry.direction : "Stopped";
+    document.getElementById('robot_motion').innerHTML = "Robot Reports: " + moving;
+    document.getElementById('robot_wheels').innerHTML = "Wheel Speeds: " + robot_telemetry.left_dps + " / " + robot_telemetry.right_dps;
+    document.getElementById('robot_head').innerHTML = "Head Position: " + robot_telemetry.hposition + " / " + robot_telemetry.vposition;
+    //  The sensors are read by the robot every few seconds, so they may not be here yet
+    var battery = (robot_telemetry.battery_volts === undefined) ? "-" : robot_telemetry.battery_volts.toFixed(2) + " V";
+    var temperature = (robot_telemetry.cpu_temperature === undefined) ? "-" : robot_telemetry.cpu_temperature.toFixed(1) + " &deg;C";
+    document.getElementById('robot_sensors').innerHTML = "Battery: " + battery + ", CPU Temperature: " + temperature;
+    return;
+}
+
+function open_telemetry() {
+    if (!('EventSource' in window)) {
+        return;  //  No Server-Sent Events, the robot's status just isn't shown.
+    }
+    //  EventSource reconnects by itself if the connection drops.
+    var telemetry = new EventSource(get_request_address + "/telemetry");
+    telemetry.addEventListener('state', function(event) {
+        robot_telemetry = JSON.parse(event.data);
+        set_telemetry_data();
+    });
+    telemetry.onmessage = function(event) {
+        Object.assign(robot_telemetry, JSON.parse(event.data));
+        set_telemetry_data();
+    };
+    return;
+}
+
+open_telemetry();
+
 //  Function get_gamepad_data is the main "game loop" function that organizes and calls all the other
 //  functions that are needed to make this script work.
 function  get_gamepad_data() {